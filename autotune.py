@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import llama_cpp
+import logging
+import nlg
+import nlp_utils
+import os
+import platform
+import statistics
+import tempfile
+import time
+from llama_cpp import Llama
+
+# Options of `Llama` that are tuned, and stored in the `llm` block of the
+# configuration file
+PROFILE_KEYS = ('n_threads', 'n_batch', 'use_mmap', 'use_mlock')
+
+
+def _cpu_name():
+    """ Returns the model of the CPU, as precisely as the platform says. """
+    try:
+        with open('/proc/cpuinfo', 'r') as fp:
+            for line in fp:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def _memory_mb():
+    """ Returns the physical memory of the machine, in megabytes. """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') \
+            // (1024 * 1024)
+    except (ValueError, OSError):
+        return None
+
+
+def fingerprint(llm_path):
+    """ Describes the model and the machine that a profile was tuned for.
+
+    Parameters
+    ----------
+    llm_path : str
+        Path to the language model.
+
+    Returns
+    -------
+    dict
+        The model file (path, size and modification time), the version of
+        llama-cpp-python, the CPU, its number of cores and the memory.
+    """
+    stat = os.stat(llm_path)
+    return {'model': os.path.abspath(llm_path),
+            'model_size': stat.st_size,
+            'model_mtime': int(stat.st_mtime),
+            'llama_cpp': getattr(llama_cpp, '__version__', ''),
+            'cpu': _cpu_name(),
+            'cores': os.cpu_count(),
+            'memory_mb': _memory_mb()}
+
+
+def load_profile(json_config, llm_path):
+    """ Returns the tuned options of the language model.
+
+    Parameters
+    ----------
+    json_config : dict
+        Dictionary with general configuration options for the system. The
+        profile is stored in its `llm` block.
+    llm_path : str
+        Path to the language model.
+
+    Returns
+    -------
+    dict
+        Keyword arguments for `Llama`. Empty if there is no profile, or if
+        it was tuned for another model or machine, in which case a warning
+        asks for the tuning to be run again.
+    """
+    profile = json_config.get('llm')
+    if not profile:
+        return dict()
+    if profile.get('fingerprint') != fingerprint(llm_path):
+        logging.getLogger('radiobot').warning(
+            "The LLM profile in the configuration was tuned for another "
+            "model or machine, so it is ignored. Run autotune.py again.")
+        return dict()
+    return {key: profile[key] for key in PROFILE_KEYS if key in profile}
+
+
+def sample_prompts(json_config, count_tokens):
+    """ Builds prompts like the ones of dialog and radio mode.
+
+    Parameters
+    ----------
+    json_config : dict
+        Dictionary with general configuration options for the system.
+    count_tokens : function
+        Function that returns the number of tokens in a text.
+
+    Returns
+    -------
+    dict
+        The prompt of every mode.
+    """
+    dialog = nlp_utils.dialog_window(json_config, count_tokens)
+    dialog.append("What did you do today?")
+    monologue = nlp_utils.monologue_window(json_config, count_tokens)
+    return {'dialog': dialog.prompt(), 'radio': monologue.prompt()}
+
+
+def measure(llm_path, prompts, options, new_tokens=32, seed=0):
+    """ Measures the speed of the language model with some options.
+
+    Parameters
+    ----------
+    llm_path : str
+        Path to the language model.
+    prompts : dict
+        Prompts to evaluate, by name. See `sample_prompts`.
+    options : dict
+        Keyword arguments for `Llama`.
+    new_tokens : int
+        Tokens to generate after every prompt.
+    seed : int
+        Seed for the sampling of the language model.
+
+    Returns
+    -------
+    dict
+        The options, the load time, the prompt evaluation and generation
+        speeds (in tokens per second) of every prompt, and the mean time to
+        evaluate a prompt and generate `new_tokens` tokens, which is the
+        score to minimize.
+    """
+    load_start = time.time()
+    llm = Llama(model_path=llm_path, seed=seed, n_ctx=nlg.CONTEXT_TOKENS,
+                verbose=False, **options)
+    load_seconds = time.time() - load_start
+    # The first evaluation pages in the weights, like in the server
+    llm.eval(llm.tokenize(b' Hello'))
+    result = dict(options, load_seconds=load_seconds)
+    reply_seconds = []
+    for name, prompt in prompts.items():
+        # The prompts are built to fit in the context
+        tokens = llm.tokenize(b' ' + prompt.encode('utf-8'))
+        llm.reset()
+        start = time.time()
+        first_token = None
+        generated = 0
+        for token in llm.generate(tokens, top_k=40, top_p=0.95, temp=0.8,
+                                  repeat_penalty=1.1):
+            if first_token is None:
+                first_token = time.time()
+            else:
+                generated += 1
+            if generated >= new_tokens:
+                break
+        end = time.time()
+        first_token = first_token or end
+        eval_rate = len(tokens) / max(first_token - start, 1e-6)
+        generate_rate = generated / max(end - first_token, 1e-6)
+        result[f'{name}_prompt_tokens_per_second'] = eval_rate
+        result[f'{name}_generate_tokens_per_second'] = generate_rate
+        reply_seconds.append(len(tokens) / eval_rate +
+                             new_tokens / max(generate_rate, 1e-6))
+    result['reply_seconds'] = statistics.mean(reply_seconds)
+    del llm
+    return result
+
+
+def sweep(llm_path, prompts, thread_counts, batch_sizes, new_tokens=32):
+    """ Finds the fastest options, tuning one of them at a time: first the
+    threads, then the batch size and last how the weights are loaded.
+    Every measurement is printed as a JSON object.
+
+    Parameters
+    ----------
+    llm_path : str
+        Path to the language model.
+    prompts : dict
+        Prompts to evaluate, by name. See `sample_prompts`.
+    thread_counts : list(int)
+        Numbers of threads to try.
+    batch_sizes : list(int)
+        Batch sizes for the prompt evaluation to try.
+    new_tokens : int
+        Tokens to generate after every prompt.
+
+    Returns
+    -------
+    dict
+        The fastest options, with the keys in `PROFILE_KEYS`.
+    """
+    best = {'n_threads': thread_counts[0], 'n_batch': max(batch_sizes),
+            'use_mmap': True, 'use_mlock': False}
+    candidates = [('n_threads', thread_counts),
+                  ('n_batch', batch_sizes),
+                  (('use_mmap', 'use_mlock'),
+                   [(True, False), (True, True), (False, False)])]
+    for key, values in candidates:
+        scores = []
+        for value in values:
+            options = dict(best)
+            if isinstance(key, tuple):
+                options.update(zip(key, value))
+            else:
+                options[key] = value
+            result = measure(llm_path, prompts, options, new_tokens)
+            print(json.dumps(result), flush=True)
+            scores.append((result['reply_seconds'], value))
+        value = min(scores, key=lambda score: score[0])[1]
+        if isinstance(key, tuple):
+            best.update(zip(key, value))
+        else:
+            best[key] = value
+    return best
+
+
+def save_profile(config_path, profile):
+    """ Stores a profile in the `llm` block of a configuration file,
+    keeping everything else as it was. """
+    with open(config_path, 'r') as fp:
+        json_config = json.load(fp)
+    json_config['llm'] = profile
+    directory = os.path.dirname(os.path.abspath(config_path))
+    fd, tmp_name = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    with os.fdopen(fd, 'w') as fp:
+        json.dump(json_config, fp, indent='\t')
+        fp.write('\n')
+    os.replace(tmp_name, config_path)
+
+
+if __name__ == '__main__':
+    """ Measures the speed of the language model with different options on
+    this machine, and stores the fastest ones in the configuration file for
+    the LLM server to use.
+    """
+    parser = argparse.ArgumentParser(
+        description='Tunes the LLM options for this machine')
+    parser.add_argument('llm', help='LLM to tune')
+    parser.add_argument('-c', '--config', default='config.json',
+                        help='Configuration file to update')
+    parser.add_argument('--threads', type=int, nargs='+',
+                        help='Numbers of threads to try')
+    parser.add_argument('--batch', type=int, nargs='+',
+                        default=[8, 32, 128, 512],
+                        help='Batch sizes to try')
+    parser.add_argument('--tokens', type=int, default=32,
+                        help='Tokens to generate after every prompt')
+    parser.add_argument('--if-needed', action='store_true',
+                        help='Only tune if the profile in the configuration '
+                             'is missing or was made for another model or '
+                             'machine')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as fp:
+        app_config = json.load(fp)
+    if args.if_needed and app_config.get('llm', dict()).get(
+            'fingerprint') == fingerprint(args.llm):
+        print(json.dumps({'profile': app_config['llm'], 'tuned': False}))
+        raise SystemExit(0)
+    thread_counts = args.threads
+    if thread_counts is None:
+        cores = os.cpu_count()
+        thread_counts = sorted({max(1, cores // 4), max(1, cores // 2),
+                                max(1, 3 * cores // 4), cores})
+    prompts = sample_prompts(app_config, nlg.token_counter(args.llm))
+    profile = sweep(args.llm, prompts, thread_counts, args.batch,
+                    args.tokens)
+    profile['fingerprint'] = fingerprint(args.llm)
+    save_profile(args.config, profile)
+    print(json.dumps({'profile': profile, 'tuned': True}), flush=True)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+import argparse
+import broadcast
+import http.client
+import json
+import numpy
+import resource
+import statistics
+import threading
+import time
+
+
+def listen(url, sample_rate, seconds, results, slow=False, block_size=4096):
+    """ Reads the stream like a player would, and stores what it got.
+
+    Parameters
+    ----------
+    url : str
+        Address of the broadcast.
+    sample_rate : int
+        Sample rate of the stream.
+    seconds : float
+        How long to listen.
+    results : list
+        List where a dictionary with the measurements is appended.
+    slow : bool
+        If True, the client only reads half as fast as the audio is played,
+        like a player on a congested connection.
+    block_size : int
+        Bytes read at a time.
+    """
+    host, port = url.split('//')[1].strip('/').split(':')
+    start = time.monotonic()
+    connection = http.client.HTTPConnection(host, int(port), timeout=10)
+    connection.request('GET', '/')
+    response = connection.getresponse()
+    received = len(response.read(44))
+    first_byte = time.monotonic() - start
+    while time.monotonic() - start < seconds:
+        data = response.read(block_size)
+        if len(data) == 0:
+            break
+        received += len(data)
+        if slow:
+            # Twice the time it takes to play what was read
+            time.sleep(block_size / sample_rate)
+    connection.close()
+    results.append({'slow': slow,
+                    'first_byte_ms': 1000 * first_byte,
+                    'audio_seconds': received / 2 / sample_rate})
+
+
+def fake_speech(seconds, sample_rate, seed=0):
+    """ Generates a line of 16-bit audio that looks a bit like speech:
+    noise modulated by a syllable-rate envelope. """
+    rng = numpy.random.default_rng(seed)
+    t = numpy.arange(int(seconds * sample_rate)) / sample_rate
+    envelope = 0.5 * (1 + numpy.sin(2 * numpy.pi * 4 * t))
+    return (3000 * envelope * rng.standard_normal(len(t))).astype(
+        numpy.int16).tobytes()
+
+
+def speak(radio, sample_rate, stop, interval=2.0):
+    """ Queues a line of fake speech every `interval` seconds, as in radio
+    mode, until `stop` is set. """
+    idx = 0
+    while not stop.is_set():
+        radio.say(fake_speech(1.5, sample_rate, idx), sample_rate, 1)
+        idx += 1
+        stop.wait(interval)
+
+
+if __name__ == '__main__':
+    """ Load test for the broadcast: many local clients listen at once while
+    speech is queued, some of them reading too slowly. Prints one JSON
+    object per number of clients.
+    """
+    parser = argparse.ArgumentParser(
+        description='Load test for the audio broadcast')
+    parser.add_argument('-c', '--clients', type=int, nargs='+',
+                        default=[1, 10, 50, 200],
+                        help='Numbers of simultaneous clients to test')
+    parser.add_argument('-s', '--seconds', type=float, default=10.0,
+                        help='How long every client listens')
+    parser.add_argument('--slow', type=float, default=0.1,
+                        help='Fraction of clients that read too slowly')
+    parser.add_argument('-r', '--samplerate', type=int, default=22050,
+                        help='Sample rate of the stream')
+    parser.add_argument('--buffer-seconds', type=float, default=5.0,
+                        help='Audio buffered per client')
+    args = parser.parse_args()
+
+    for clients in args.clients:
+        radio = broadcast.Broadcast(args.samplerate, port=0,
+                                    buffer_seconds=args.buffer_seconds)
+        radio.start()
+        stop = threading.Event()
+        speaker = threading.Thread(target=speak,
+                                   args=(radio, args.samplerate, stop))
+        speaker.start()
+        n_slow = int(clients * args.slow)
+        results = []
+        threads = [threading.Thread(target=listen,
+                                    args=(radio.url, args.samplerate,
+                                          args.seconds, results,
+                                          idx < n_slow))
+                   for idx in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stop.set()
+        speaker.join()
+        radio.close()
+        normal = [r for r in results if not r['slow']]
+        slow = [r for r in results if r['slow']]
+        print(json.dumps({
+            'clients': clients,
+            'slow_clients': n_slow,
+            'connected': len(results),
+            'first_byte_ms': statistics.median(
+                r['first_byte_ms'] for r in results),
+            # Close to 1 when every client gets the audio in real time
+            'realtime_ratio': min(r['audio_seconds'] for r in normal) /
+            args.seconds if normal else None,
+            'slow_realtime_ratio': min(r['audio_seconds'] for r in slow) /
+            args.seconds if slow else None,
+            'dropped_blocks': radio.dropped_blocks,
+            'mixer_max_lag_ms': 1000 * radio.max_lag,
+            'max_rss_mb': resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss / 1024}), flush=True)
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+import argparse
+import itertools
+import json
+import numpy
+import os
+import statistics
+import sys
+import threading
+import time
+from multiprocessing import Pipe, Process
+
+# The benchmark runs without a screen or a sound card
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+import control  # noqa: E402
+import nlp_utils  # noqa: E402
+import protocol  # noqa: E402
+import pygame  # noqa: E402
+import tts  # noqa: E402
+
+# Replies of the stand-in LLM, one sentence per chunk
+REPLIES = [
+    ["That sounds like a great plan.", "I would go hiking first."],
+    ["The weather looks fine for today.", "Bring a jacket anyway.",
+     "It gets cold by the lake."],
+    ["I have no idea, to be honest."],
+]
+
+
+def run_stub_nlg(comm_pipe, first_token_delay=0.5, token_delay=0.05):
+    """ Stand-in for `nlg.run_nlg_server` that replies with canned text.
+
+    Parameters
+    ----------
+    comm_pipe : Pipe()
+        Pipe that will be used to receive new prompts and send responses.
+    first_token_delay : float
+        Time (in seconds) before the first word of every reply.
+    token_delay : float
+        Time (in seconds) to generate every following word.
+    """
+    replies = itertools.cycle(REPLIES)
+    comm_pipe.send(protocol.Ready(0.0))
+    while True:
+        message = comm_pipe.recv()
+        if isinstance(message, protocol.Quit):
+            break
+        elif not isinstance(message, protocol.Prompt):
+            continue
+        time.sleep(first_token_delay)
+        reply = next(replies)
+        said = []
+        for sentence in reply:
+            time.sleep(token_delay * len(sentence.split()))
+            # Prefills that arrive in the meantime are ignored
+            interruption = comm_pipe.recv() if comm_pipe.poll() else None
+            if isinstance(interruption, protocol.Quit):
+                return
+            elif isinstance(interruption, protocol.Cancel) and \
+                    interruption.request == message.request:
+                break
+            comm_pipe.send(protocol.Chunk(sentence, message.request))
+            said.append(sentence)
+        comm_pipe.send(protocol.Done(' '.join(said), message.request,
+                                     len(said) < len(reply)))
+
+
+def run_stub_stt(comm_pipe, delay=0.3):
+    """ Stand-in for `speech_to_text.run_speech_server` that "transcribes"
+    every recording into the same sentence.
+
+    Parameters
+    ----------
+    comm_pipe : Pipe()
+        Pipe that will be used to receive commands and send transcriptions.
+    delay : float
+        Time (in seconds) between the end of a recording and its
+        transcription.
+    """
+    comm_pipe.send(('ready', 0.0))
+    while True:
+        command = comm_pipe.recv()
+        if command == 'quit':
+            break
+        elif command == 'stop_recording':
+            time.sleep(delay)
+            comm_pipe.send("What should I do this weekend?")
+
+
+class FakeVoice:
+    """ Stand-in for `speech_cache.SpeechCache` that synthesizes a quiet
+    tone whose length depends on the text, and logs every call.
+
+    Parameters
+    ----------
+    seconds_per_char : float
+        Length of the speech per character of text.
+    delay : float
+        Time (in seconds) that every synthesis takes.
+    """
+    def __init__(self, seconds_per_char=0.06, delay=0.0):
+        self.seconds_per_char = seconds_per_char
+        self.delay = delay
+        # (time, seconds of speech) for every synthesized text
+        self.log = []
+
+    def synthesize(self, text):
+        time.sleep(self.delay)
+        sample_rate = pygame.mixer.get_init()[0]
+        seconds = self.seconds_per_char * len(text)
+        t = numpy.arange(int(seconds * sample_rate)) / sample_rate
+        pcm = (1000 * numpy.sin(2 * numpy.pi * 220 * t)).astype(numpy.int16)
+        self.log.append((time.time(), seconds))
+        return pcm.tobytes(), sample_rate, 1
+
+    def flush(self):
+        pass
+
+    def stats(self):
+        return {'utterances': len(self.log)}
+
+
+def speech_gaps(log, start, end):
+    """ Computes the silences between consecutive pieces of speech.
+
+    Parameters
+    ----------
+    log : list((float, float))
+        Time at which every piece of speech was synthesized and its length,
+        as recorded by `FakeVoice`.
+    start : float
+        Only speech synthesized after this time is considered.
+    end : float
+        Only speech synthesized before this time is considered.
+
+    Returns
+    -------
+    list(float)
+        Silence (in seconds) before every piece of speech but the first one.
+
+    Notes
+    -----
+    Speech is queued right after whatever is being said, so every piece
+    starts either when it is synthesized or when the previous one ends.
+    """
+    gaps = []
+    speech_end = None
+    for synth_time, seconds in log:
+        if not start <= synth_time <= end:
+            continue
+        if speech_end is None:
+            speech_end = synth_time
+        else:
+            gaps.append(max(0.0, synth_time - speech_end))
+        speech_end = max(speech_end, synth_time) + seconds
+    return gaps
+
+
+def post_key(event_type, key):
+    pygame.event.post(pygame.event.Event(event_type, key=key))
+
+
+def drive(marks, turns, hold_seconds, turn_seconds, radio_seconds):
+    """ Plays the role of the user: talks a few times in dialog mode, then
+    listens to the radio for a while and quits.
+
+    Parameters
+    ----------
+    marks : dict
+        Filled with the times at which every part of the script happens.
+    turns : int
+        Number of utterances in dialog mode.
+    hold_seconds : float
+        Time the space key is held for every utterance.
+    turn_seconds : float
+        Time between releasing the space key and the next utterance.
+    radio_seconds : float
+        Time spent in radio mode.
+    """
+    # Give the main loop time to draw the first frame
+    time.sleep(1.0)
+    marks['released'] = []
+    for _ in range(turns):
+        post_key(pygame.KEYDOWN, pygame.K_SPACE)
+        time.sleep(hold_seconds)
+        marks['released'].append(time.time())
+        post_key(pygame.KEYUP, pygame.K_SPACE)
+        time.sleep(turn_seconds)
+    marks['radio_start'] = time.time()
+    post_key(pygame.KEYUP, pygame.K_r)
+    time.sleep(radio_seconds)
+    marks['radio_end'] = time.time()
+    post_key(pygame.KEYUP, pygame.K_r)
+    time.sleep(0.5)
+    post_key(pygame.KEYUP, pygame.K_ESCAPE)
+
+
+if __name__ == '__main__':
+    """ Runs the GUI main loop headlessly against stand-ins of the LLM, the
+    speech-to-text and the text-to-speech, and prints one JSON object per
+    metric.
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the latency of the main loop')
+    parser.add_argument('-c', '--config', default='config.json.template',
+                        help='Configuration file with the prompts')
+    parser.add_argument('--turns', type=int, default=3,
+                        help='Utterances in dialog mode')
+    parser.add_argument('--radio-seconds', type=float, default=60.0,
+                        help='Time spent in radio mode')
+    parser.add_argument('--first-token', type=float, default=0.5,
+                        help='Delay of the stand-in LLM before every reply')
+    parser.add_argument('--token', type=float, default=0.05,
+                        help='Delay of the stand-in LLM for every word')
+    parser.add_argument('--stt', type=float, default=0.3,
+                        help='Delay of the stand-in speech-to-text')
+    parser.add_argument('--tts', type=float, default=0.0,
+                        help='Delay of the stand-in text-to-speech')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as fp:
+        app_config = json.load(fp)
+    # The synthetic turns must not end up in the conversation log of the
+    # user, where `--resume` would find them
+    app_config['conversation_log'] = False
+    llm_pipe = Pipe()
+    stt_pipe = Pipe()
+    tts_pipe = Pipe()
+    workers = [Process(target=run_stub_nlg,
+                       args=(llm_pipe[1], args.first_token, args.token)),
+               Process(target=run_stub_stt, args=(stt_pipe[1], args.stt))]
+    for worker in workers:
+        worker.start()
+
+    pygame.mixer.pre_init(**tts.mixer_settings(app_config['tts']))
+    pygame.init()
+    pygame.mixer.music.load('./sounds/gray_noise.ogg')
+    pygame.mixer.music.play(loops=-1)
+    pygame.mixer.set_reserved(1)
+    voice = FakeVoice(delay=args.tts)
+    # The text-to-speech server runs in a thread, so it can share the log of
+    # the voice with the benchmark
+    tts_server = threading.Thread(target=tts.run_tts_server,
+                                  args=(app_config, tts_pipe[1], voice))
+    tts_server.start()
+    marks = dict()
+    # Every turn lasts long enough for the longest reply to be said
+    longest = max((' '.join(reply) for reply in REPLIES), key=len)
+    turn_seconds = args.stt + args.first_token + \
+        args.token * len(longest.split()) + \
+        (voice.seconds_per_char + args.tts) * len(longest) + 1.0
+    driver = threading.Thread(target=drive,
+                              args=(marks, args.turns, 1.0, turn_seconds,
+                                    args.radio_seconds),
+                              daemon=True)
+    wall_start = time.time()
+    # Only the main loop runs in this thread: the TTS server and the driver
+    # have their own
+    cpu_start = time.thread_time()
+    driver.start()
+    control._run_main_loop_gui(llm_pipe[0], stt_pipe[0], tts_pipe[0],
+                               app_config, pygame.mixer.Channel(0),
+                               nlp_utils.estimate_tokens)
+    cpu_seconds = time.thread_time() - cpu_start
+    wall_seconds = time.time() - wall_start
+    llm_pipe[0].send(protocol.Quit())
+    stt_pipe[0].send('quit')
+    tts_pipe[0].send('quit')
+    tts_server.join()
+    for worker in workers:
+        # A stand-in that missed the message must not hang the benchmark
+        worker.join(timeout=5)
+        if worker.is_alive():
+            worker.terminate()
+    pygame.quit()
+
+    # Time between releasing the key and the first speech of the reply
+    first_audio = []
+    for released in marks.get('released', []):
+        after = [t for t, _ in voice.log if t > released]
+        if len(after) > 0:
+            first_audio.append(after[0] - released)
+    if len(first_audio) == 0:
+        sys.exit("No speech was produced in dialog mode")
+    print(json.dumps({
+        'metric': 'time_to_first_audio',
+        'turns': len(first_audio),
+        'mean_ms': 1000 * statistics.mean(first_audio),
+        'max_ms': 1000 * max(first_audio)}), flush=True)
+    gaps = speech_gaps(voice.log, marks['radio_start'], marks['radio_end'])
+    print(json.dumps({
+        'metric': 'radio_gap',
+        'gaps': len(gaps),
+        'mean_ms': 1000 * statistics.mean(gaps) if gaps else 0.0,
+        'max_ms': 1000 * max(gaps, default=0.0),
+        'silences': sum(1 for gap in gaps if gap > 0.05)}), flush=True)
+    print(json.dumps({
+        'metric': 'main_loop_cpu',
+        'cpu_seconds': cpu_seconds,
+        'wall_seconds': wall_seconds,
+        'cpu_fraction': cpu_seconds / wall_seconds}), flush=True)
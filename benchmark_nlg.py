@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+import argparse
+import autotune
+import json
+import nlg
+import nlg_daemon
+import nlp_utils
+import os
+import protocol
+import queue
+import statistics
+import tempfile
+import threading
+import time
+from multiprocessing import Pipe, Process
+
+# What the simulated users say in dialog sessions
+QUESTIONS = ["What did you do today?", "Tell me something about music.",
+             "What is your favourite place?", "Do you like the rain?"]
+
+
+def wait_for_daemon(address, timeout=600):
+    """ Waits until the daemon accepts connections. Loading the model and
+    its snapshots can take a while. """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            conn = nlg_daemon.connect(address, 'probe')
+            conn.recv()
+            conn.send(protocol.Quit())
+            conn.close()
+            return
+        except (FileNotFoundError, ConnectionRefusedError):
+            if time.time() > deadline:
+                raise
+            time.sleep(0.5)
+
+
+class SharedPipe:
+    """ Lets several sessions talk to a single `nlg.run_nlg_server`, the
+    way the daemon lets them share a model, by routing the replies to
+    whoever sent the prompt.
+
+    Parameters
+    ----------
+    pipe : Pipe()
+        Pipe of the server, after its `Ready` message.
+    """
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self._lock = threading.Lock()
+        self._inboxes = dict()
+        threading.Thread(target=self._route, daemon=True).start()
+
+    def _route(self):
+        while True:
+            try:
+                message = self.pipe.recv()
+            except (EOFError, OSError):
+                break
+            self._inboxes[message.request.split('-')[0]].put(message)
+
+    def session(self, tag):
+        """ Returns an object with the `send` and `recv` methods of a
+        connection, for the session whose requests start with `tag`. """
+        inbox = queue.Queue()
+        self._inboxes[tag] = inbox
+        shared = self
+
+        class Connection:
+            def send(self, message):
+                if not isinstance(message, protocol.Quit):
+                    with shared._lock:
+                        shared.pipe.send(message)
+
+            def recv(self):
+                return inbox.get()
+
+            def close(self):
+                pass
+
+        return Connection()
+
+
+def run_session(conn, tag, json_config, dialog, replies, count_tokens,
+                results):
+    """ Talks to the LLM like a frontend would, one prompt after the
+    other, and stores the latency of every reply.
+
+    Parameters
+    ----------
+    conn : multiprocessing.connection.Connection
+        Connection to the LLM, after its `Ready` message.
+    tag : str
+        Beginning of the requests of the session, which must be unique.
+    json_config : dict
+        Configuration with the prompts.
+    dialog : bool
+        Whether to simulate a dialog (interactive prompts) or the radio
+        (background prompts).
+    replies : int
+        Number of replies to ask for.
+    count_tokens : function
+        Function that returns the number of tokens in a text.
+    results : list
+        List where a dictionary per session is appended.
+    """
+    name = 'dialog' if dialog else 'radio'
+    if dialog:
+        conversation = nlp_utils.dialog_window(json_config, count_tokens)
+        priority = protocol.INTERACTIVE
+    else:
+        conversation = nlp_utils.monologue_window(json_config, count_tokens)
+        priority = protocol.BACKGROUND
+    first_chunk, totals, tokens = [], [], 0
+    for idx in range(replies):
+        if dialog:
+            conversation.append(QUESTIONS[idx % len(QUESTIONS)])
+        start = time.time()
+        conn.send(protocol.Prompt(conversation.prompt(), f'{tag}-{idx}',
+                                  priority))
+        message = conn.recv()
+        first_chunk.append(time.time() - start)
+        while not isinstance(message, protocol.Done):
+            message = conn.recv()
+        totals.append(time.time() - start)
+        tokens += count_tokens(message.text) - 1
+        conversation.append(message.text)
+    conn.send(protocol.Quit())
+    conn.close()
+    results.append({'session': name,
+                    'mean_first_chunk_seconds': statistics.mean(first_chunk),
+                    'mean_reply_seconds': statistics.mean(totals),
+                    'tokens': tokens})
+
+
+def run_sessions(connect, json_config, sessions, replies, count_tokens):
+    """ Runs several sessions at the same time.
+
+    Parameters
+    ----------
+    connect : function
+        Function that receives the number and the name of a session, and
+        returns its connection to the LLM, ready for prompts.
+    json_config : dict
+        Configuration with the prompts.
+    sessions : int
+        Number of sessions, half of them dialog.
+    replies : int
+        Number of replies per session.
+    count_tokens : function
+        Function that returns the number of tokens in a text.
+
+    Returns
+    -------
+    dict
+        The total throughput and the latency of every session.
+    """
+    results = []
+    threads = []
+    for idx in range(sessions):
+        dialog = idx % 2 == 0
+        conn = connect(idx, 'dialog' if dialog else 'radio')
+        threads.append(threading.Thread(
+            target=run_session,
+            args=(conn, str(idx), json_config, dialog, replies, count_tokens,
+                  results)))
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    return {'sessions': sessions,
+            'tokens_per_second': sum(r['tokens'] for r in results) / elapsed,
+            'seconds': elapsed,
+            'per_session': results}
+
+
+if __name__ == '__main__':
+    """ Compares the LLM server of a single program (`nlg.run_nlg_server`),
+    which answers the prompts of all sessions one after the other, against
+    the daemon decoding them at the same time in several slots. Prints one
+    JSON object for the server and one per number of slots.
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the shared NLG daemon')
+    parser.add_argument('llm', help='LLM to benchmark')
+    parser.add_argument('-c', '--config', default='config.json',
+                        help='Configuration file with the prompts')
+    parser.add_argument('--slots', type=int, nargs='+', default=[1, 2, 4],
+                        help='Numbers of slots to compare')
+    parser.add_argument('--sessions', type=int, default=4,
+                        help='Simultaneous sessions, half of them dialog')
+    parser.add_argument('--replies', type=int, default=5,
+                        help='Replies per session')
+    parser.add_argument('--threads', type=int,
+                        help='Threads used by the language model')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as fp:
+        app_config = json.load(fp)
+    count_tokens = nlg.token_counter(args.llm)
+
+    # The serial loop that every program used to run
+    llm_pipe = Pipe()
+    server = Process(target=nlg.run_nlg_server,
+                     args=(args.llm, llm_pipe[1]),
+                     kwargs={'username': app_config['username'],
+                             'prefixes': list(nlp_utils.persona_prefixes(
+                                 app_config).values()),
+                             'n_threads': args.threads,
+                             'profile': autotune.load_profile(app_config,
+                                                              args.llm)},
+                     daemon=True)
+    server.start()
+    llm_pipe[0].recv()
+    shared = SharedPipe(llm_pipe[0])
+    result = run_sessions(lambda idx, name: shared.session(str(idx)),
+                          app_config, args.sessions, args.replies,
+                          count_tokens)
+    llm_pipe[0].send(protocol.Quit())
+    server.join()
+    print(json.dumps(dict(server='serial', **result)), flush=True)
+
+    for slots in args.slots:
+        address = os.path.join(tempfile.mkdtemp(), 'nlg.sock')
+        daemon = Process(target=nlg_daemon.run_daemon,
+                         args=(args.llm, address, app_config),
+                         kwargs={'n_threads': args.threads, 'slots': slots},
+                         daemon=True)
+        daemon.start()
+        wait_for_daemon(address)
+
+        def connect(idx, name):
+            conn = nlg_daemon.connect(address, name, app_config['username'])
+            conn.recv()
+            return conn
+
+        result = run_sessions(connect, app_config, args.sessions,
+                              args.replies, count_tokens)
+        daemon.terminate()
+        daemon.join()
+        print(json.dumps(dict(server='daemon', slots=slots, **result)),
+              flush=True)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import numpy
+import os
+import soundfile as sf
+import speech_to_text
+import statistics
+import tempfile
+import time
+import whisper
+
+
+def file_pipeline(audio, samplerate):
+    """ Prepares a recording for Whisper the way we used to: the audio is
+    saved as a WAV file, which Whisper decodes and resamples with ffmpeg.
+
+    Parameters
+    ----------
+    audio : numpy.ndarray
+        Recorded audio.
+    samplerate : int
+        Sample rate of `audio`.
+
+    Returns
+    -------
+    torch.Tensor
+        Log-Mel spectrogram of the audio.
+    """
+    fd, filename = tempfile.mkstemp(suffix='.wav')
+    os.close(fd)
+    try:
+        sf.write(filename, audio, samplerate, subtype='PCM_24')
+        return whisper.log_mel_spectrogram(whisper.load_audio(filename))
+    finally:
+        os.unlink(filename)
+
+
+def memory_pipeline(audio, samplerate):
+    """ Prepares a recording for Whisper without leaving memory.
+
+    Parameters
+    ----------
+    audio : numpy.ndarray
+        Recorded audio.
+    samplerate : int
+        Sample rate of `audio`.
+
+    Returns
+    -------
+    torch.Tensor
+        Log-Mel spectrogram of the audio.
+    """
+    audio = speech_to_text.to_whisper_rate(audio, samplerate)
+    return whisper.log_mel_spectrogram(audio)
+
+
+def fake_speech(seconds, samplerate, seed=0):
+    """ Generates audio that looks a bit like speech: noise modulated by a
+    syllable-rate envelope.
+
+    Parameters
+    ----------
+    seconds : float
+        Length of the audio.
+    samplerate : int
+        Sample rate of the audio.
+    seed : int
+        Seed for the random generator.
+
+    Returns
+    -------
+    numpy.ndarray
+        Mono float32 audio.
+    """
+    rng = numpy.random.default_rng(seed)
+    t = numpy.arange(int(seconds * samplerate)) / samplerate
+    envelope = 0.5 * (1 + numpy.sin(2 * numpy.pi * 4 * t))
+    return (0.1 * envelope * rng.standard_normal(len(t))).astype(numpy.float32)
+
+
+def measure(pipeline, audio, samplerate, repeat, model=None):
+    """ Measures how long it takes to prepare (and optionally transcribe)
+    a recording.
+
+    Parameters
+    ----------
+    pipeline : function
+        Either `file_pipeline` or `memory_pipeline`.
+    audio : numpy.ndarray
+        Recorded audio.
+    samplerate : int
+        Sample rate of `audio`.
+    repeat : int
+        Number of measurements.
+    model : whisper.Whisper
+        If given, the spectrogram is also decoded with this model.
+
+    Returns
+    -------
+    list(float)
+        Time (in seconds) of every measurement.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        mel = pipeline(audio, samplerate)
+        if model is not None:
+            mel = whisper.pad_or_trim(mel, whisper.audio.N_FRAMES)
+            whisper.decode(model, mel.to(model.device),
+                           whisper.DecodingOptions(language='en', fp16=False))
+        times.append(time.perf_counter() - start)
+    return times
+
+
+if __name__ == '__main__':
+    """ Compares the per-utterance overhead of handing audio to Whisper
+    through a file against doing it in memory. Prints one JSON object per
+    measurement.
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the audio hand-off to Whisper')
+    parser.add_argument('-i', '--input',
+                        help='WAV file to use instead of generated audio')
+    parser.add_argument('-s', '--seconds', type=float, nargs='+',
+                        default=[2.0, 5.0, 15.0],
+                        help='Lengths of the generated utterances')
+    parser.add_argument('-r', '--samplerate', type=int, default=44100,
+                        help='Sample rate of the generated utterances')
+    parser.add_argument('-n', '--repeat', type=int, default=10,
+                        help='Measurements per utterance and pipeline')
+    parser.add_argument('-m', '--model',
+                        help='Whisper model to include the decoding time')
+    args = parser.parse_args()
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = ""
+    model = None if args.model is None else whisper.load_model(args.model)
+    if args.input is not None:
+        audio, samplerate = sf.read(args.input, dtype='float32',
+                                    always_2d=True)
+        utterances = [(audio[:, 0], samplerate)]
+    else:
+        utterances = [(fake_speech(seconds, args.samplerate), args.samplerate)
+                      for seconds in args.seconds]
+
+    for audio, samplerate in utterances:
+        for pipeline in (file_pipeline, memory_pipeline):
+            # Warm-up run, so imports and caches don't count
+            measure(pipeline, audio, samplerate, 1)
+            times = measure(pipeline, audio, samplerate, args.repeat, model)
+            print(json.dumps({
+                'pipeline': pipeline.__name__,
+                'audio_seconds': len(audio) / samplerate,
+                'samplerate': samplerate,
+                'decoded': model is not None,
+                'mean_ms': 1000 * statistics.mean(times),
+                'median_ms': 1000 * statistics.median(times),
+                'min_ms': 1000 * min(times)}), flush=True)
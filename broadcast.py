@@ -0,0 +1,328 @@
+import logging
+import numpy
+import socket
+import soundfile as sf
+import struct
+import threading
+import time
+import tts
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Bytes that the kernel may hold for every client
+SOCKET_BUFFER = 16 * 1024
+
+
+class Listener:
+    """ Audio waiting to be sent to a single client of the broadcast.
+
+    Parameters
+    ----------
+    max_blocks : int
+        Maximum number of blocks waiting to be sent. When the client falls
+        further behind, its oldest blocks are dropped.
+    """
+    def __init__(self, max_blocks):
+        self.blocks = deque(maxlen=max_blocks)
+        self.dropped = 0
+        self.closed = False
+        self._ready = threading.Condition()
+
+    def put(self, block):
+        """ Adds a block of audio to the end of the buffer. """
+        with self._ready:
+            if len(self.blocks) == self.blocks.maxlen:
+                self.dropped += 1
+            self.blocks.append(block)
+            self._ready.notify()
+
+    def get(self, timeout=1.0):
+        """ Returns the next block of audio, or None if there was none for
+        `timeout` seconds or the listener was closed. """
+        with self._ready:
+            if len(self.blocks) == 0 and not self.closed:
+                self._ready.wait(timeout)
+            if len(self.blocks) == 0:
+                return None
+            return self.blocks.popleft()
+
+    def close(self):
+        """ Wakes up whoever is waiting for audio, and makes `get` return
+        None from now on. """
+        with self._ready:
+            self.closed = True
+            self.blocks.clear()
+            self._ready.notify()
+
+
+class Broadcast:
+    """ Streams the speech of the system, mixed with the static noise, to
+    any number of clients over HTTP.
+
+    The stream is 16-bit mono WAV sent with chunked transfer encoding, so
+    any player that can open a URL can listen to it, for instance
+    `ffplay http://127.0.0.1:8000/`.
+
+    Parameters
+    ----------
+    sample_rate : int
+        Sample rate of the stream, in Hz.
+    host : str
+        Address the server listens on.
+    port : int
+        Port the server listens on.
+    noise : str
+        Sound file that is played in a loop under the speech. If None, the
+        stream is silent between lines.
+    noise_volume : float
+        Volume of the noise when nobody is speaking. It is lowered to a
+        twentieth of that while there is speech, the same way the local
+        mixer does it.
+    block_ms : int
+        Length of the blocks of audio that are sent to the clients.
+    buffer_seconds : float
+        Maximum amount of audio waiting to be sent to a single client.
+
+    Notes
+    -----
+    A single thread mixes the audio in real time and hands every block to
+    all the clients, so the cost of mixing doesn't grow with the number of
+    listeners. Every client has its own bounded buffer: a client that reads
+    too slowly loses the oldest audio instead of holding everyone back or
+    using more and more memory.
+    """
+    def __init__(self, sample_rate, host='127.0.0.1', port=8000,
+                 noise='./sounds/gray_noise.ogg', noise_volume=0.5,
+                 block_ms=100, buffer_seconds=5.0):
+        self.sample_rate = sample_rate
+        self.block_size = int(sample_rate * block_ms / 1000)
+        self.max_blocks = max(1, int(1000 * buffer_seconds / block_ms))
+        self.noise_volume = noise_volume
+        self.noise = numpy.zeros(self.block_size, dtype=numpy.int16)
+        if noise is not None:
+            data, noise_rate = sf.read(noise, dtype='int16', always_2d=True)
+            self.noise = tts.convert(data.tobytes(), noise_rate,
+                                     data.shape[1], sample_rate, 1)[:, 0]
+        self._noise_position = 0
+        # Speech waiting to be mixed, as arrays of samples, plus the number
+        # of samples of the first array that were already mixed
+        self._speech = deque()
+        self._speech_position = 0
+        self._speech_lock = threading.Lock()
+        self.listeners = set()
+        self._listeners_lock = threading.Lock()
+        self._running = False
+        # Largest delay of the mixer with respect to real time, in seconds,
+        # and blocks dropped by clients that were too slow
+        self.max_lag = 0.0
+        self.dropped_blocks = 0
+        self.server = ThreadingHTTPServer((host, port), _handler(self),
+                                          bind_and_activate=False)
+        self.server.daemon_threads = True
+        # The default backlog of 5 makes the clients that connect at the
+        # same time wait for a second
+        self.server.request_queue_size = 128
+        try:
+            self.server.server_bind()
+            self.server.server_activate()
+        except OSError:
+            self.server.server_close()
+            raise
+        self._threads = []
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    def start(self):
+        """ Starts mixing and accepting clients in background threads. """
+        self._running = True
+        self._threads = [threading.Thread(target=self._mix, daemon=True),
+                         threading.Thread(target=self.server.serve_forever,
+                                          daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        logging.getLogger('radiobot').info(f"Broadcasting on {self.url}")
+
+    def say(self, pcm, sample_rate, channels):
+        """ Queues speech to be broadcast right after the speech that is
+        already queued. The arguments are the ones returned by
+        `tts.synthesize`. """
+        samples = tts.convert(pcm, sample_rate, channels,
+                              self.sample_rate, 1)[:, 0]
+        if len(samples) == 0:
+            return
+        with self._speech_lock:
+            self._speech.append(samples)
+
+    def clear(self):
+        """ Drops all the speech that hasn't been broadcast yet. """
+        with self._speech_lock:
+            self._speech.clear()
+            self._speech_position = 0
+
+    def queued_seconds(self):
+        """ Returns how much speech is waiting to be broadcast. """
+        with self._speech_lock:
+            queued = sum(len(samples) for samples in self._speech) - \
+                self._speech_position
+        return queued / self.sample_rate
+
+    def _next_block(self):
+        """ Mixes the next block of audio. """
+        block = numpy.zeros(self.block_size, dtype=numpy.int32)
+        filled = 0
+        with self._speech_lock:
+            while filled < self.block_size and len(self._speech) > 0:
+                samples = self._speech[0]
+                taken = samples[self._speech_position:self._speech_position +
+                                self.block_size - filled]
+                block[filled:filled + len(taken)] = taken
+                filled += len(taken)
+                self._speech_position += len(taken)
+                if self._speech_position == len(samples):
+                    self._speech.popleft()
+                    self._speech_position = 0
+        volume = self.noise_volume / 20 if filled > 0 else self.noise_volume
+        positions = (self._noise_position + numpy.arange(self.block_size)) \
+            % len(self.noise)
+        self._noise_position = (positions[-1] + 1) % len(self.noise)
+        block += (volume * self.noise[positions]).astype(numpy.int32)
+        return numpy.clip(block, -32768, 32767).astype('<i2').tobytes()
+
+    def _mix(self):
+        """ Sends a block of audio to every client at the pace at which it
+        is played. """
+        block_seconds = self.block_size / self.sample_rate
+        deadline = time.monotonic()
+        while self._running:
+            block = self._next_block()
+            with self._listeners_lock:
+                listeners = list(self.listeners)
+            for listener in listeners:
+                listener.put(block)
+            deadline += block_seconds
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                self.max_lag = max(self.max_lag, -delay)
+                if -delay > 1.0:
+                    # Don't try to catch up with a pause this long, such as
+                    # the computer being suspended
+                    deadline = time.monotonic()
+
+    def wav_header(self):
+        """ Returns the header of the stream. Its length is unknown, so the
+        sizes are set to the largest possible value. """
+        return b'RIFF' + struct.pack('<I', 0xFFFFFFFF) + b'WAVEfmt ' + \
+            struct.pack('<IHHIIHH', 16, 1, 1, self.sample_rate,
+                        2 * self.sample_rate, 2, 16) + \
+            b'data' + struct.pack('<I', 0xFFFFFFFF)
+
+    def add_listener(self):
+        """ Registers a new client. See `Listener`. """
+        listener = Listener(self.max_blocks)
+        with self._listeners_lock:
+            self.listeners.add(listener)
+        return listener
+
+    def remove_listener(self, listener):
+        """ Unregisters a client. """
+        with self._listeners_lock:
+            if listener in self.listeners:
+                self.listeners.discard(listener)
+                self.dropped_blocks += listener.dropped
+        listener.close()
+
+    def close(self):
+        """ Disconnects every client and stops the server. """
+        self._running = False
+        self.server.shutdown()
+        with self._listeners_lock:
+            listeners = list(self.listeners)
+        for listener in listeners:
+            self.remove_listener(listener)
+        for thread in self._threads:
+            thread.join()
+        self.server.server_close()
+
+
+def _handler(broadcast):
+    """ Returns the class that serves the stream of a broadcast to a
+    client. """
+    class StreamHandler(BaseHTTPRequestHandler):
+        # Needed for chunked transfer encoding
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            # Keep the audio of slow clients in their bounded buffer rather
+            # than in the much larger buffers of the kernel
+            self.request.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                                    SOCKET_BUFFER)
+            super().setup()
+
+        def do_GET(self):
+            if self.path not in ('/', '/radio.wav'):
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'audio/wav')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('icy-name', 'radiobot')
+            self.end_headers()
+            listener = broadcast.add_listener()
+            try:
+                self._send_chunk(broadcast.wav_header())
+                while not listener.closed:
+                    block = listener.get()
+                    if block is not None:
+                        self._send_chunk(block)
+                self.wfile.write(b'0\r\n\r\n')
+            except (BrokenPipeError, ConnectionResetError):
+                # The client went away
+                pass
+            finally:
+                broadcast.remove_listener(listener)
+                if listener.dropped > 0:
+                    logging.getLogger('radiobot').debug(
+                        f"Broadcast: {self.address_string()} was too slow, "
+                        f"{listener.dropped} blocks dropped")
+                self.close_connection = True
+
+        def _send_chunk(self, data):
+            self.wfile.write(b'%X\r\n%s\r\n' % (len(data), data))
+
+        def log_message(self, format, *args):
+            logging.getLogger('radiobot').debug(
+                f"Broadcast: {self.address_string()} {format % args}")
+
+    return StreamHandler
+
+
+def from_config(json_config):
+    """ Creates the broadcast described in the configuration.
+
+    Parameters
+    ----------
+    json_config : dict
+        Dictionary with general configuration options for the system. The
+        optional `broadcast` block can set the `host`, `port`,
+        `noise_volume` and `buffer_seconds` of the broadcast (see
+        `Broadcast`).
+
+    Returns
+    -------
+    Broadcast or None
+        The configured broadcast, not started yet, or None if there is no
+        `broadcast` block or it is set to false.
+    """
+    config = json_config.get('broadcast', False)
+    if config is False:
+        return None
+    if config is True:
+        config = dict()
+    sample_rate = tts.mixer_settings(json_config['tts'])['frequency']
+    return Broadcast(sample_rate, **config)
@@ -1,109 +1,284 @@
 #!/usr/bin/env python3
+import broadcast
+import conversation_log
 import logging
-import math
 import nlp_utils
-import os
+import protocol
 import pygame
-import random
-import select
+import screen
 import sys
-import tempfile
+import threading
 import time
-from ovos_tts_plugin_mimic3 import Mimic3TTSPlugin
+import tracing
+import tts
+from collections import deque
+from multiprocessing import connection
 from pygame.mixer import music, Sound
 
+# PyGame events for the messages from the LLM, the speech-to-text and the
+# text-to-speech processes, and for the end of every sound in the voice
+# channel
+LLM_MESSAGE = pygame.USEREVENT + 1
+STT_MESSAGE = pygame.USEREVENT + 2
+VOICE_DONE = pygame.USEREVENT + 3
+TTS_MESSAGE = pygame.USEREVENT + 4
 
-def say(text, mimic, voice_file, text_output=False):
-    """ Synthesises a text as speech and plays it. The function returns
-    immediately and provides the time it will take for the audio to play.
+
+class SpeechQueue:
+    """ Speech that is being synthesized or waiting to be played.
+
+    Texts are sent to the text-to-speech server (see `tts.run_tts_server`),
+    and their speech is queued in the voice channel as soon as it comes back,
+    right after whatever the channel is already saying.
 
     Parameters
     ----------
-    text : str
-        Speech that will be read out loud.
-    mimic : Mimic3TTSPlugin
-        Pre-configured MIMIC-3 plugin
-    voice_file : str
-        Path to a temporary file that will be overwritten with a WAV file
-        containing the desired speech.
-    text_output : bool
-        If True, the text will also be printed out.
-
-    Returns
-    -------
-    float
-        Time (in seconds) that it will take the sound to end. Useful for doing
-        other tasks while the audio plays.
+    pipe_tts : Pipe()
+        Pipe to send and receive messages to and from the text-to-speech.
+    channel : pygame.mixer.Channel
+        Channel reserved for speech.
+    radio : broadcast.Broadcast
+        If given, the speech is also sent to everyone listening to the
+        broadcast.
+
+    Notes
+    -----
+    The server replies in the same order in which the texts were sent, so
+    the queue only needs to remember what it is waiting for.
     """
-    mimic.get_tts(text, voice_file)
-    if text_output:
-        print(text)
-    speech = Sound(voice_file)
-    Sound.play(speech)
-    # Time until the speech is done
-    return speech.get_length()
+    def __init__(self, pipe_tts, channel, radio=None):
+        self.pipe_tts = pipe_tts
+        self.channel = channel
+        self.radio = radio
+        # Speech waiting for its turn in the channel. See `feed_voice`.
+        self.pending = []
+        # (request, new_line, text_output) of every text being synthesized,
+        # plus how many replies must be thrown away when they arrive
+        self.jobs = deque()
+        self.stale = 0
+        # Time at which everything in the queue will be done playing
+        self.end_time = 0
+
+    def say(self, text, request=None, new_line=False, text_output=False):
+        """ Sends a text to be synthesized. The function returns immediately.
+
+        Parameters
+        ----------
+        text : str
+            Speech that will be read out loud.
+        request : str
+            Request that the speech belongs to. Only used for tracing.
+        new_line : bool
+            Whether the text starts a new line of radio. Returned by
+            `receive` along with the time at which the speech starts.
+        text_output : bool
+            If True, the text will also be printed out once it is played.
+        """
+        self.pipe_tts.send(('synthesize', text, request))
+        self.jobs.append((text, request, new_line, text_output))
 
+    def receive(self, message):
+        """ Queues the speech sent by the text-to-speech server.
 
-def draw_image(window, width, height, images, needle_hist, speak=True):
-    """ Draws the background image.
+        Parameters
+        ----------
+        message : tuple
+            Message received from the server.
+
+        Returns
+        -------
+        (float, bool) or None
+            Time at which the speech will start playing, and whether it
+            starts a new line of radio. None if nobody is waiting for this
+            speech anymore.
+        """
+        if self.stale > 0:
+            self.stale -= 1
+            return None
+        text, request, new_line, text_output = self.jobs.popleft()
+        speech = tts.to_sound(*message[1:])
+        if self.radio is not None:
+            self.radio.say(*message[1:])
+        if text_output:
+            print(text)
+        self.pending.append(speech)
+        self.feed()
+        start_time = max(self.end_time, time.time())
+        self.end_time = start_time + speech.get_length()
+        tracing.record('playback', start_time, self.end_time, request)
+        return start_time, new_line
+
+    def feed(self):
+        """ Keeps the voice channel busy. See `feed_voice`. """
+        feed_voice(self.channel, self.pending)
+
+    def busy(self):
+        """ Returns whether there is speech being played, queued or
+        synthesized. """
+        return self.channel.get_busy() or len(self.pending) > 0 or \
+            len(self.jobs) > 0
+
+    def clear(self):
+        """ Drops everything that hasn't been said yet, fading out the speech
+        that is playing. """
+        self.pending.clear()
+        self.channel.fadeout(250)
+        if self.radio is not None:
+            self.radio.clear()
+        self.stale += len(self.jobs)
+        self.jobs.clear()
+        self.end_time = time.time()
+
+
+def feed_voice(channel, pending):
+    """ Moves pending speech into the voice channel.
 
     Parameters
     ----------
-    window : pygame.Display
-        Display where all images are to be drawn.
-    width : int
-        Width of the screen.
-    height : int
-        Height of the screen.
-    images : dict
-        Dictionary containing all required images.
-    needle_hist : list(float)
-        History of last states of the needle - required to make the movement
-        more natural.
-    speak : bool
-        Whether to draw the image with or without the microphene.
+    channel : pygame.mixer.Channel
+        Channel reserved for speech.
+    pending : list(Sound)
+        Speech waiting for its turn, in order. Sounds are removed from the
+        list as they are handed to the channel.
+
+    Notes
+    -----
+    A PyGame channel can only queue a single sound, so this function must be
+    called regularly while there is pending speech.
     """
-    window.fill((0, 0, 0))
-    bg_w, bg_h = images['bg'].get_size()
-    window.blit(images['bg'], ((width - bg_w) / 2, (height - bg_h) / 2))
-    
-    # Draws the needle
-    radius = 50.0
-    min_angle = 3.141592/4.0
-    max_angle = 3.0*3.141592/4.0
-    # The larger this value, the slower the needle will move
-    history_steps = 4 
-    if music.get_volume() > 0.3:
-        # The static is high, so no one is talking
-        new_angle = random.gauss(min_angle, 0.07)
-    else:
-        # The static is low, so someone is talking
-        new_angle = random.gauss(max_angle, 0.07)
-    # Clamp the values to the valid range
-    new_angle = min(max(new_angle, min_angle), max_angle)
-    needle_hist.append(new_angle)
-    angle = sum(needle_hist[-history_steps:])/len(needle_hist[-history_steps:])
-    start = (377, 200)
-    # My favorite equations of all time: convert angles and radius
-    # into (x,y) coordinates.
-    # Also, we flip the angle around (min_angle + max_angle - angle) because
-    # otherwise the needle moves in the opposite direction
-    end = (start[0] + int(radius*math.cos(min_angle + (max_angle-angle))),
-           start[1] - int(radius*math.sin(min_angle + (max_angle-angle))))
-    pygame.draw.line(window, (200, 50, 50), start, end, 1)
-    window.blit(images['needle_thingy'], (365, 194))
-    # Draws the microphone and buttons
-    if speak:
-        window.blit(images['white_button'], (344, 239))
-        window.blit(images['mic'], (-5, 107))
-    else:
-        window.blit(images['red_button'], (386, 239))
-    pygame.display.flip()
-    pygame.display.update()
+    if len(pending) > 0 and not channel.get_busy():
+        channel.play(pending.pop(0))
+    if len(pending) > 0 and channel.get_queue() is None:
+        channel.queue(pending.pop(0))
+
+
+def send_prompt(pipe_llm, conversation, request=None,
+                priority=protocol.INTERACTIVE):
+    """ Builds the prompt for the next utterance and sends it to the LLM.
+
+    Parameters
+    ----------
+    pipe_llm : Pipe()
+        Pipe to send and receive messages to and from the LLM.
+    conversation : nlp_utils.ContextWindow
+        Conversation to continue.
+    request : str
+        Request that the reply belongs to. See `tracing.new_request`.
+    priority : int
+        Either `protocol.INTERACTIVE` or `protocol.BACKGROUND`.
+    """
+    with tracing.span('prompt', request):
+        prompt = conversation.prompt()
+    pipe_llm.send(protocol.Prompt(prompt, request, priority))
+
+
+def watch_pipes(pipes):
+    """ Receives the messages from other processes and posts them as PyGame
+    events, so the main loop can wait for all its inputs at once. It is meant
+    to run in its own thread.
+
+    Parameters
+    ----------
+    pipes : dict
+        Event type to use for the messages of every pipe. The message is
+        stored in the `message` attribute of the event.
+
+    Notes
+    -----
+    The function returns once all pipes are closed.
+    """
+    pipes = dict(pipes)
+    while len(pipes) > 0:
+        for pipe in connection.wait(list(pipes)):
+            try:
+                message = pipe.recv()
+            except (EOFError, OSError):
+                del pipes[pipe]
+            else:
+                pygame.event.post(pygame.event.Event(pipes[pipe],
+                                                     message=message))
+
+
+class RadioBuffer:
+    """ Lines of radio that have been generated and synthesized, but haven't
+    started playing yet.
+
+    Parameters
+    ----------
+    depth : int
+        Maximum number of lines in the buffer. The LLM keeps generating new
+        lines until the buffer is full.
+
+    Notes
+    -----
+    The speech of every line is queued in the voice channel as soon as it is
+    synthesized, so the buffer only needs to remember when each line starts.
+    """
+    def __init__(self, depth=1):
+        self.depth = depth
+        # Time at which every line in the buffer starts playing, in order
+        self.starts = deque()
+        self.lines = 0
+        self.underruns = 0
+        self.discarded = 0
+        self.depth_total = 0
+        self.max_depth = 0
+
+    def __len__(self):
+        return len(self.starts)
+
+    def full(self):
+        """ Returns whether the LLM should stop generating new lines. """
+        return len(self.starts) >= self.depth
+
+    def add(self, start_time):
+        """ Adds a new line to the buffer.
+
+        Parameters
+        ----------
+        start_time : float
+            Time at which the line starts playing.
+        """
+        self.starts.append(start_time)
+        self.max_depth = max(self.max_depth, len(self.starts))
+
+    def update(self, now):
+        """ Removes the lines that have started playing.
+
+        Parameters
+        ----------
+        now : float
+            Current time.
+
+        Returns
+        -------
+        bool
+            True if at least one line started playing.
+        """
+        started = False
+        while len(self.starts) > 0 and self.starts[0] <= now:
+            self.starts.popleft()
+            self.lines += 1
+            self.depth_total += len(self.starts)
+            started = True
+        return started
+
+    def clear(self):
+        """ Drops every line that hasn't started playing yet. """
+        self.discarded += len(self.starts)
+        self.starts.clear()
+
+    def stats(self):
+        """ Returns the counters of the buffer as a dictionary. """
+        return {'lines': self.lines,
+                'underruns': self.underruns,
+                'discarded': self.discarded,
+                'mean_depth': self.depth_total / max(self.lines, 1),
+                'max_depth': self.max_depth}
 
 
-def _run_main_loop_gui(pipe_llm, pipe_speech_to_text, json_config,
-                       mimic, voice_file):
+def _run_main_loop_gui(pipe_llm, pipe_speech_to_text, pipe_tts, json_config,
+                       voice_channel, count_tokens, resume=False, radio=None):
     """ Runs the main loop of the progran in GUI mode.
 
     Notes
@@ -119,18 +294,10 @@ def _run_main_loop_gui(pipe_llm, pipe_speech_to_text, json_config,
     window = pygame.display.set_mode((json_config['screen_width'],
                                       json_config['screen_height']))
     fullscreen = False
-    # Load all images
-    images = dict()
-    images['red_button'] = pygame.image.load("./images/red_button_on.png")
-    images['white_button'] = pygame.image.load("./images/white_button_on.png")
-    images['needle_thingy'] = pygame.image.load("./images/needle_support.png")
-    images['mic'] = pygame.image.load("./images/mic.png")
-    images['bg'] = pygame.image.load("./images/background.png")
-    # History of the needle - required for animation
-    needle_history = []
-    draw_image(window, json_config['screen_width'],
-               json_config['screen_height'], images, needle_history,
-               speak=True)
+    # Load all images and draw the radio. The needle follows the speech.
+    radio_screen = screen.RadioScreen(window)
+    voice_meter = screen.VoiceMeter(voice_channel)
+    radio_screen.draw(loading=True)
     # When did we draw the screen for the last time?
     last_redraw = time.time()
 
@@ -138,75 +305,196 @@ def _run_main_loop_gui(pipe_llm, pipe_speech_to_text, json_config,
     dialog_states = {'idle_dialog', 'recording', 'transcribing', 'thinking',
                      'speaking'}
     radio_states = {'idle_radio', 'thinking_radio', 'think_and_say',
-                    'slow_tongue', 'clear_queue', 'finish_talking'}
-    all_states = dialog_states.union(radio_states)
-    # Seed of the initial conversation
-    conversation = list(json_config['dialog_seed'])
-    # Initial state
-    state = 'idle_dialog'
+                    'slow_tongue'}
+    all_states = dialog_states.union(radio_states).union({'loading'})
+    # Seed of the initial conversation, or the end of the previous one.
+    # Every conversation is also kept on disk.
+    dialog_log = conversation_log.from_config(json_config, 'dialog')
+    monologue_log = conversation_log.from_config(json_config, 'monologue')
+    conversation = nlp_utils.dialog_window(json_config, count_tokens,
+                                           log=dialog_log, resume=resume)
+    # The radio also continues where it left off, the first time
+    resume_radio = resume
+    # Initial state. The servers are still loading their models.
+    state = 'loading'
+    loading = {'LLM', 'Speech-to-text', 'Text-to-speech'}
     # List of events that happen at every loop
     events = []
-    # Time until the current radio line is done playing
-    radio_end_time = 0
+    # Speech being synthesized or played, and whether there was any the last
+    # time we checked
+    speech = SpeechQueue(pipe_tts, voice_channel, radio)
+    voice_active = False
+    # Text of the last message from the LLM and the speech-to-text, plus
+    # whether the reply that is being streamed is complete
+    llm_text = ''
+    stt_text = ''
+    reply_done = True
+    # Radio lines that are waiting to be played, and whether the next chunk
+    # from the LLM starts a new line
+    radio_buffer = RadioBuffer(json_config.get('radio_lookahead', 2))
+    new_line = True
+    # Whether the LLM is generating a reply. Only the reply to the current
+    # request is listened to, the rest were cancelled.
+    llm_busy = False
+    # In hands-free mode the bot listens whenever it is not talking, and the
+    # speech-to-text tells when the user is done. Recordings that are
+    # cancelled are still transcribed, but nobody waits for them.
+    hands_free = json_config.get('vad', dict()).get('hands_free', False)
+    stale_transcriptions = 0
+    # Request that the LLM is working on, for tracing
+    request_id = None
+    # Messages from the other processes and the end of every sentence
+    # arrive as PyGame events, so the loop can sleep until something happens
+    watcher = threading.Thread(target=watch_pipes,
+                               args=({pipe_llm: LLM_MESSAGE,
+                                      pipe_speech_to_text: STT_MESSAGE,
+                                      pipe_tts: TTS_MESSAGE},),
+                               daemon=True)
+    watcher.start()
+    voice_channel.set_endevent(VOICE_DONE)
     # To know when to finish the loop. This should be part of the
     # state machine, but it's easier this way.
     running = True
     while running:
         assert state in all_states, f'Invalid state {state}'
         old_state = state
-        # First, collect all possible events.
+        # First, wait until something happens: a key press, a message from
+        # another process, the end of some speech or a timer. The next radio
+        # line and the next redraw are the only timers.
+        timeout = last_redraw + 0.2 - time.time()
+        if len(radio_buffer) > 0:
+            timeout = min(timeout, radio_buffer.starts[0] - time.time())
+        e = pygame.event.wait(max(1, int(1000 * timeout)))
         # Let's start with all types of key presses.
-        for e in pygame.event.get():
-            if e.type == pygame.KEYDOWN:
-                if e.key == pygame.K_SPACE:
-                    events.append('press_space')
-            elif e.type == pygame.KEYUP:
-                if e.key == pygame.K_SPACE:
-                    events.append('release_space')
-                elif e.key == pygame.K_r:
-                    events.append('release_r')
-                elif e.key == pygame.K_f:
-                    # Switch screen mode - this doesn't need to go through the
-                    # regular pipeline
-                    if fullscreen:
-                        window = pygame.display.set_mode(
-                            (json_config['screen_width'],
-                             json_config['screen_height']))
-                    else:
-                        window = pygame.display.set_mode(
-                            (json_config['screen_width'],
-                             json_config['screen_height']),
-                            pygame.FULLSCREEN | pygame.SCALED)
-                    fullscreen = not fullscreen
-                elif e.key == pygame.K_ESCAPE:
-                    # This is the one condition that doesn't go through the
-                    # state machine
-                    running = False
-            elif e.type == pygame.QUIT:
+        if e.type == pygame.KEYDOWN:
+            if e.key == pygame.K_SPACE:
+                events.append('press_space')
+        elif e.type == pygame.KEYUP:
+            if e.key == pygame.K_SPACE:
+                events.append('release_space')
+            elif e.key == pygame.K_r:
+                events.append('release_r')
+            elif e.key == pygame.K_f:
+                # Switch screen mode - this doesn't need to go through the
+                # regular pipeline
+                if fullscreen:
+                    window = pygame.display.set_mode(
+                        (json_config['screen_width'],
+                         json_config['screen_height']))
+                else:
+                    window = pygame.display.set_mode(
+                        (json_config['screen_width'],
+                         json_config['screen_height']),
+                        pygame.FULLSCREEN | pygame.SCALED)
+                fullscreen = not fullscreen
+                radio_screen.set_window(window)
+            elif e.key == pygame.K_ESCAPE:
+                # This is the one condition that doesn't go through the
+                # state machine
                 running = False
-        # Now, check whether we were talking but then finished.
-        # Note: this event could get lost
-        if 0 < time.time() - radio_end_time < 1:
+        elif e.type == pygame.QUIT:
+            running = False
+        elif e.type == LLM_MESSAGE:
+            # Replies arrive as a stream of chunks followed by the complete
+            # reply
+            message = e.message
+            if isinstance(message, protocol.Ready):
+                loading.discard('LLM')
+                logger.debug(f"LLM ready in {message.seconds:.1f}s")
+            elif message.request != request_id:
+                # Nobody is waiting for this reply anymore
+                pass
+            elif isinstance(message, protocol.Chunk):
+                llm_text = message.text
+                events.append('llm_streamed')
+            else:
+                llm_text = message.text
+                llm_busy = False
+                events.append('llm_uttered')
+        elif e.type == STT_MESSAGE:
+            if isinstance(e.message, tuple) and e.message[0] == 'ready':
+                loading.discard('Speech-to-text')
+                logger.debug(f"Speech-to-text ready in {e.message[1]:.1f}s")
+            elif isinstance(e.message, tuple):
+                # The user stopped talking in hands-free mode
+                events.append('endpointed')
+            elif stale_transcriptions > 0:
+                stale_transcriptions -= 1
+            else:
+                stt_text = e.message
+                events.append('transcribed')
+        elif e.type == TTS_MESSAGE:
+            # Speech is played as soon as it is synthesized
+            queued = None
+            if e.message[0] == 'ready':
+                loading.discard('Text-to-speech')
+                logger.debug(f"Text-to-speech ready in {e.message[1]:.1f}s")
+            else:
+                queued = speech.receive(e.message)
+            if queued is not None:
+                start_time, starts_line = queued
+                if starts_line:
+                    radio_buffer.add(start_time)
+                music.set_volume(0.025)
+                events.append('synthesized')
+        elif e.type == VOICE_DONE:
+            # Keep the voice channel busy
+            speech.feed()
+            voice_meter.level(time.time())
+        # Check whether we were talking but then finished
+        if voice_active and not speech.busy():
+            voice_active = False
             events.append('done_speaking')
-        # Check whether the LLM said something
-        if pipe_llm.poll():
-            events.append('llm_uttered')
-        if pipe_speech_to_text.poll():
-            events.append('transcribed')
+        # A radio line begins when everything before it has been said
+        if radio_buffer.update(time.time()):
+            events.append('line_started')
 
         # Now that I'm done with all the events, it is time to compare them
         # to my current state
-        if state == 'idle_dialog':
-            if 'press_space' in events:
-                # Start recording
+        if state in radio_states and 'release_r' in events:
+            # Change from radio to dialog mode. Whatever was queued or is
+            # being generated is dropped.
+            speech.clear()
+            radio_buffer.clear()
+            if llm_busy:
+                pipe_llm.send(protocol.Cancel(request_id))
+                llm_busy = False
+            request_id = None
+            logger.debug(f"Radio buffer: {radio_buffer.stats()}")
+            conversation = nlp_utils.dialog_window(json_config,
+                                                   count_tokens,
+                                                   log=dialog_log)
+            music.set_volume(0.5)
+            state = 'idle_dialog'
+        elif state == 'loading':
+            if len(loading) == 0:
+                # Every server is ready, so the user can start talking
+                state = 'idle_dialog'
+        elif state == 'idle_dialog':
+            if hands_free:
+                # Listen until the user says something
+                music.set_volume(0.025)
+                request_id = tracing.new_request()
+                pipe_speech_to_text.send(('listen', request_id))
+                pipe_llm.send(protocol.Prefill(conversation.prefix()))
+                state = 'recording'
+            elif 'press_space' in events:
+                # Start recording. The LLM would be idle until the user is
+                # done, so it can evaluate the conversation so far already.
                 music.set_volume(0.025)
                 Sound.play(button_on)
-                pipe_speech_to_text.send('start_recording')
+                request_id = tracing.new_request()
+                pipe_speech_to_text.send(('start_recording', request_id))
+                pipe_llm.send(protocol.Prefill(conversation.prefix()))
                 state = 'recording'
             elif 'release_r' in events:
                 # Change from dialog to radio mode
                 state = 'idle_radio'
-                conversation = list(json_config['monologue_seed'])
+                conversation = nlp_utils.monologue_window(json_config,
+                                                          count_tokens,
+                                                          log=monologue_log,
+                                                          resume=resume_radio)
+                resume_radio = False
                 music.set_volume(0.5)
         elif state == 'recording':
             if 'release_space' in events:
@@ -215,131 +503,133 @@ def _run_main_loop_gui(pipe_llm, pipe_speech_to_text, json_config,
                 Sound.play(button_off)
                 pipe_speech_to_text.send('stop_recording')
                 state = 'transcribing'
+            elif 'endpointed' in events:
+                # The speech-to-text stopped recording on its own
+                music.set_volume(0.5)
+                state = 'transcribing'
+            elif 'release_r' in events and hands_free:
+                # Stop listening and change to radio mode
+                pipe_speech_to_text.send('stop_recording')
+                stale_transcriptions += 1
+                state = 'idle_radio'
+                conversation = nlp_utils.monologue_window(json_config,
+                                                          count_tokens,
+                                                          log=monologue_log,
+                                                          resume=resume_radio)
+                resume_radio = False
+                music.set_volume(0.5)
         elif state == 'transcribing':
-            if 'transcribed' in events:
+            if 'transcribed' in events and not stt_text.strip():
+                # Nothing was said
+                state = 'idle_dialog'
+            elif 'transcribed' in events:
                 # Add this text to the prompt and send it to the LLM
-                new_utterance = pipe_speech_to_text.recv()
-                conversation.append(new_utterance)
-                response_prompt = nlp_utils.build_reply_prompt(
-                                       json_config['dialog_prompt'],
-                                       conversation,
-                                       context_turns=5,
-                                       username=json_config['username'])
-                pipe_llm.send(response_prompt)
+                conversation.append(stt_text)
+                send_prompt(pipe_llm, conversation, request_id)
+                llm_busy = True
+                reply_done = False
                 state = 'thinking'
         elif state == 'thinking':
-            if 'llm_uttered' in events:
-                # The LLM is done thinking and it is time to talk
-                response = pipe_llm.recv()
-                music.set_volume(0.025)
-                conversation.append(response)
-                play_time = say(response, mimic, voice_file)
-                radio_end_time = time.time() + play_time
+            if 'llm_streamed' in events:
+                # The LLM has the first sentence ready. It is synthesized
+                # while the LLM keeps generating.
+                speech.say(llm_text, request_id)
+            elif 'llm_uttered' in events:
+                conversation.append(llm_text)
+                reply_done = True
+                if not speech.busy():
+                    # The LLM had nothing to say
+                    state = 'idle_dialog'
+            if 'synthesized' in events:
+                # The first sentence is playing
                 state = 'speaking'
         elif state == 'speaking':
-            if 'done_speaking' in events:
+            if 'llm_streamed' in events:
+                # Say the next sentence once the previous one is done
+                speech.say(llm_text, request_id)
+            elif 'llm_uttered' in events:
+                conversation.append(llm_text)
+                reply_done = True
+                if not speech.busy():
+                    # We were already done speaking when the reply ended
+                    music.set_volume(0.5)
+                    state = 'idle_dialog'
+            elif 'done_speaking' in events and reply_done:
                 # The LLM is done speaking and the loop starts again
                 music.set_volume(0.5)
                 state = 'idle_dialog'
         elif state == 'idle_radio':
-            if 'release_r' in events:
-                # Change from radio to dialog mode
-                conversation = list(json_config['dialog_seed'])
-                music.set_volume(0.5)
-                state = 'idle_dialog'
-            else:
-                # I'm not doing anything, so let's generate
-                response_prompt = nlp_utils.broadcast_prompt(
-                    json_config['monologue_prompt'],
-                    conversation,
-                    context_turns=5,
-                    username=json_config['username'])
-                pipe_llm.send(response_prompt)
-                # This state is only reached at the very beginning, so let's
-                # play the opening prompt. But first we trigger a redraw
-                # because the system will be unresponsive afterwards.
-                draw_image(window, json_config['screen_width'],
-                           json_config['screen_height'], images,
-                           needle_history, speak=state in dialog_states)
-
-                music.set_volume(0.025)
-                play_time = say('; '.join(conversation), mimic, voice_file)
-                time.sleep(play_time)
-                music.set_volume(0.5)
-                state = 'thinking_radio'
-        elif state == 'thinking_radio':
-            if 'llm_uttered' in events:
-                # The LLM is done thinking and it is time to talk
-                response = pipe_llm.recv()
-                music.set_volume(0.025)
-                conversation.append(response)
-                play_time = say(response, mimic, voice_file)
-                radio_end_time = time.time() + play_time
-                # We can start thinking the next sentence already
-                response_prompt = nlp_utils.broadcast_prompt(
-                                       json_config['monologue_prompt'],
-                                       conversation,
-                                       username=json_config['username'])
-                pipe_llm.send(response_prompt)
+            # I'm not doing anything, so let's generate
+            request_id = tracing.new_request()
+            send_prompt(pipe_llm, conversation, request_id,
+                        protocol.BACKGROUND)
+            llm_busy = True
+            # This state is only reached at the very beginning, so let's
+            # play the opening prompt. The first line is queued after it.
+            speech.say('; '.join(conversation), request_id)
+            new_line = True
+            state = 'thinking_radio'
+        elif state in ('thinking_radio', 'think_and_say'):
+            if 'llm_streamed' in events:
+                # Every sentence is synthesized as soon as it arrives and
+                # queued right after whatever is still being said. A new
+                # line enters the radio buffer once its first sentence does.
+                speech.say(llm_text, request_id, new_line=new_line)
+                new_line = False
                 state = 'think_and_say'
-            elif 'release_r' in events:
-                # We want to go back to dialog mode, but we first need
-                # to clean the utterance queue
-                state = 'clear_queue'
-        elif state == 'think_and_say':
-            if 'llm_uttered' in events:
-                # The LLM is done thinking the next sentence,
-                # but we are not done talking yet
-                state = 'slow_tongue'
+            elif 'llm_uttered' in events:
+                # The LLM is done thinking this line. We think the next one
+                # unless enough lines are already waiting to be played.
+                conversation.append(llm_text)
+                new_line = True
+                if radio_buffer.full():
+                    state = 'slow_tongue'
+                else:
+                    request_id = tracing.new_request()
+                    send_prompt(pipe_llm, conversation, request_id,
+                                protocol.BACKGROUND)
+                    llm_busy = True
             elif 'done_speaking' in events:
-                # The system is done speaking, but the next utterance is not
-                # there yet.
+                if state == 'think_and_say':
+                    # The system is done speaking, but the next utterance is
+                    # not there yet
+                    radio_buffer.underruns += 1
+                    logger.debug(f"Radio buffer underrun: "
+                                 f"{radio_buffer.stats()}")
+                # Otherwise, the opening is over
                 music.set_volume(0.5)
                 state = 'thinking_radio'
-            elif 'release_r' in events:
-                # We want to go back to dialog mode, but we first need
-                # to clean the utterance queue.
-                # Note that the system is still speaking. This is technically
-                # a bug to be solved with an extra state
-                state = 'clear_queue'
         elif state == 'slow_tongue':
-            if 'done_speaking' in events:
-                # I am ready to speak some more
-                state = 'thinking_radio'
-            elif 'release_r' in events:
-                # I want to go back to dialog mode, but the system is still
-                # talking
-                state = 'finish_talking'
-        elif state == 'finish_talking':
-            if 'done_speaking' in events:
-                # Go back to dialog mode
-                music.set_volume(0.5)
-                conversation = list(json_config['dialog_seed'])
-                state = 'idle_dialog'
-        elif state == 'clear_queue':
-            if 'llm_uttered' in events:
-                # The queue is clear and I can go back to dialog mode
-                _ = pipe_llm.recv()
-                conversation = list(json_config['dialog_seed'])
-                state = 'idle_dialog'
+            if 'line_started' in events and not radio_buffer.full():
+                # A line started playing, so there is room for another one
+                request_id = tracing.new_request()
+                send_prompt(pipe_llm, conversation, request_id,
+                            protocol.BACKGROUND)
+                llm_busy = True
+                state = 'think_and_say'
         # Is this correct?
         events = []
+        voice_active = speech.busy()
         if state != old_state:
             logger.debug(f"{old_state} -> {state}")
         # Finally, redraw the screen at an astonishing 5 FPS
         if time.time() > last_redraw + 0.2:
             last_redraw = time.time()
-            draw_image(window, json_config['screen_width'],
-                       json_config['screen_height'], images,
-                       needle_history, speak=state in dialog_states)
+            radio_screen.draw(speak=state in dialog_states,
+                              level=voice_meter.level(time.time()),
+                              loading=state == 'loading')
+    logger.debug(f"Radio buffer: {radio_buffer.stats()}")
     # Output the last dialog for debugging
     logger.debug("Last chat log")
     for utterance in conversation:
         logger.debug(f"- {utterance}")
+    for log in (dialog_log, monologue_log):
+        if log is not None:
+            log.close()
 
 
-def _run_main_loop_txt(pipe_llm, pipe_speech_to_text, json_config,
-                       mimic, voice_file):
+def _run_main_loop_txt(pipe_llm, pipe_speech_to_text, pipe_tts, json_config,
+                       voice_channel, count_tokens, resume=False, radio=None):
     """ Runs the main loop of the progran in text-only mode.
     The input is provided via keyboard instead of speech.
 
@@ -350,161 +640,257 @@ def _run_main_loop_txt(pipe_llm, pipe_speech_to_text, json_config,
     """
     logger = logging.getLogger('radiobot')
 
-    # Seed of the initial conversation
-    conversation = list(json_config['dialog_seed'])
+    # Seed of the initial conversation, or the end of the previous one.
+    # Every conversation is also kept on disk.
+    dialog_log = conversation_log.from_config(json_config, 'dialog')
+    monologue_log = conversation_log.from_config(json_config, 'monologue')
+    conversation = nlp_utils.dialog_window(json_config, count_tokens,
+                                           log=dialog_log, resume=resume)
+    # The radio also continues where it left off, the first time
+    resume_radio = resume
 
     # List of possible states plus the current one
     dialog_states = {'idle_dialog', 'thinking', 'speaking'}
     radio_states = {'idle_radio', 'thinking_radio', 'think_and_say',
-                    'slow_tongue', 'clear_queue', 'finish_talking'}
-    all_states = dialog_states.union(radio_states)
+                    'slow_tongue'}
+    all_states = dialog_states.union(radio_states).union({'loading'})
 
-    state = 'idle_dialog' 
+    # The servers are still loading their models. There is no recording in
+    # this mode, so the speech-to-text is not waited for.
+    state = 'loading'
+    loading = {'LLM', 'Text-to-speech'}
+    print("Loading...")
     events = []
-    # Time until the current radio line is done playing
-    radio_end_time = 0
+    # Speech being synthesized or played, and whether there was any the last
+    # time we checked
+    speech = SpeechQueue(pipe_tts, voice_channel, radio)
+    voice_active = False
+    # Text of the last message from the LLM, plus whether the reply that is
+    # being streamed is complete
+    llm_text = ''
+    reply_done = True
+    # Radio lines that are waiting to be played, and whether the next chunk
+    # from the LLM starts a new line
+    radio_buffer = RadioBuffer(json_config.get('radio_lookahead', 2))
+    new_line = True
+    # Whether the LLM is generating a reply. Only the reply to the current
+    # request is listened to, the rest were cancelled.
+    llm_busy = False
+    # Request that the LLM is working on, for tracing
+    request_id = None
     # To know when to finish the loop. This should be part of the
     # state machine, but it's easier this way.
     running = True
     while running:
         assert state in all_states, f'Invalid state {state}'
         old_state = state
-        # First, collect all possible events.
-
-        # Check whether we were talking but then finished.
-        # Note: this event could get lost
-        if 0 < time.time() - radio_end_time < 1:
+        # First, wait until something happens: a message from the LLM, a
+        # key press in radio mode or a timer. The idle states read their
+        # input themselves.
+        if state not in ('idle_dialog', 'idle_radio'):
+            inputs = [pipe_llm, pipe_tts]
+            if state in radio_states:
+                inputs.append(sys.stdin)
+            timeout = None
+            if len(radio_buffer) > 0:
+                timeout = max(0, radio_buffer.starts[0] - time.time())
+            if voice_active:
+                # A channel can only queue a single sound, so we need to
+                # check on it regularly while it speaks
+                timeout = 0.1 if timeout is None else min(timeout, 0.1)
+            ready = connection.wait(inputs, timeout)
+        else:
+            ready = []
+        # In radio mode, pressing Enter takes us back to dialog mode
+        if sys.stdin in ready:
+            sys.stdin.readline()
+            events.append('release_r')
+        # Check whether the LLM said something. Replies arrive as a stream of
+        # chunks followed by the complete reply.
+        if pipe_llm in ready:
+            message = pipe_llm.recv()
+            if isinstance(message, protocol.Ready):
+                loading.discard('LLM')
+                logger.debug(f"LLM ready in {message.seconds:.1f}s")
+            elif message.request != request_id:
+                # Nobody is waiting for this reply anymore
+                pass
+            elif isinstance(message, protocol.Chunk):
+                llm_text = message.text
+                events.append('llm_streamed')
+            else:
+                llm_text = message.text
+                llm_busy = False
+                events.append('llm_uttered')
+        # Speech is played as soon as it is synthesized
+        if pipe_tts in ready:
+            message = pipe_tts.recv()
+            queued = None
+            if message[0] == 'ready':
+                loading.discard('Text-to-speech')
+                logger.debug(f"Text-to-speech ready in {message[1]:.1f}s")
+            else:
+                queued = speech.receive(message)
+            if queued is not None:
+                start_time, starts_line = queued
+                if starts_line:
+                    radio_buffer.add(start_time)
+                music.set_volume(0.025)
+                events.append('synthesized')
+        # Keep the voice channel busy
+        speech.feed()
+        # Check whether we were talking but then finished
+        if voice_active and not speech.busy():
+            voice_active = False
             events.append('done_speaking')
-        # Check whether the LLM said something
-        if pipe_llm.poll():
-            events.append('llm_uttered')
+        # A radio line begins when everything before it has been said
+        if radio_buffer.update(time.time()):
+            events.append('line_started')
 
         # Now that I'm done with all the events, it is time to compare them
         # to my current state
-        if state == 'idle_dialog':
+        if state in radio_states and 'release_r' in events:
+            # Change from radio to dialog mode. Whatever was queued or is
+            # being generated is dropped.
+            speech.clear()
+            radio_buffer.clear()
+            if llm_busy:
+                pipe_llm.send(protocol.Cancel(request_id))
+                llm_busy = False
+            request_id = None
+            logger.debug(f"Radio buffer: {radio_buffer.stats()}")
+            conversation = nlp_utils.dialog_window(json_config,
+                                                   count_tokens,
+                                                   log=dialog_log)
+            music.set_volume(0.5)
+            state = 'idle_dialog'
+        elif state == 'loading':
+            if len(loading) == 0:
+                state = 'idle_dialog'
+        elif state == 'idle_dialog':
+            # The LLM can evaluate the conversation so far while the user
+            # is typing
+            pipe_llm.send(protocol.Prefill(conversation.prefix()))
             text = input('[Quit/Radio/Utterance] ')
             if text.casefold().strip() == 'quit':
                 running = False
             elif text.casefold().strip() == 'radio':
                 state = 'idle_radio'
-                conversation = list(json_config['monologue_seed'])
+                conversation = nlp_utils.monologue_window(json_config,
+                                                          count_tokens,
+                                                          log=monologue_log,
+                                                          resume=resume_radio)
+                resume_radio = False
             else:
                 # Add this text to the prompt and send it to the LLM
+                request_id = tracing.new_request()
                 new_utterance = text
                 conversation.append(new_utterance)
-                response_prompt = nlp_utils.build_reply_prompt(
-                                       json_config['dialog_prompt'],
-                                       conversation,
-                                       context_turns=5,
-                                       username=json_config['username'])
-                pipe_llm.send(response_prompt)
+                send_prompt(pipe_llm, conversation, request_id)
+                llm_busy = True
+                reply_done = False
                 state = 'thinking'
         elif state == 'thinking':
-            if 'llm_uttered' in events:
-                # The LLM is done thinking and it is time to talk
-                response = pipe_llm.recv()
-                music.set_volume(0.025)
-                conversation.append(response)
-                play_time = say(response, mimic, voice_file, text_output=True)
-                radio_end_time = time.time() + play_time
+            if 'llm_streamed' in events:
+                # The LLM has the first sentence ready. It is synthesized
+                # while the LLM keeps generating.
+                speech.say(llm_text, request_id, text_output=True)
+            elif 'llm_uttered' in events:
+                conversation.append(llm_text)
+                reply_done = True
+                if not speech.busy():
+                    # The LLM had nothing to say
+                    state = 'idle_dialog'
+            if 'synthesized' in events:
+                # The first sentence is playing
                 state = 'speaking'
         elif state == 'speaking':
-            if 'done_speaking' in events:
+            if 'llm_streamed' in events:
+                # Say the next sentence once the previous one is done
+                speech.say(llm_text, request_id, text_output=True)
+            elif 'llm_uttered' in events:
+                conversation.append(llm_text)
+                reply_done = True
+                if not speech.busy():
+                    # We were already done speaking when the reply ended
+                    music.set_volume(0.5)
+                    state = 'idle_dialog'
+            elif 'done_speaking' in events and reply_done:
                 # The LLM is done speaking and the loop starts again
                 music.set_volume(0.5)
                 state = 'idle_dialog'
         elif state == 'idle_radio':
             print("Entering Radio mode. " +
-                  "Press 'R' to return to Dialog mode or 'Esc' to quit")
+                  "Press Enter to return to Dialog mode")
             # I'm not doing anything, so let's generate
-            response_prompt = nlp_utils.broadcast_prompt(
-                json_config['monologue_prompt'],
-                conversation,
-                context_turns=5,
-                username=json_config['username'])
-            pipe_llm.send(response_prompt)
+            request_id = tracing.new_request()
+            send_prompt(pipe_llm, conversation, request_id,
+                        protocol.BACKGROUND)
+            llm_busy = True
             # This state is only reached at the very beginning, so let's
-            # play the opening prompt
-            music.set_volume(0.025)
-            play_time = say('\n'.join(conversation), mimic, voice_file,
-                            text_output=True)
-            time.sleep(play_time)
-            music.set_volume(0.5)
+            # play the opening prompt. The first line is queued after it.
+            speech.say('\n'.join(conversation), request_id,
+                       text_output=True)
+            new_line = True
             state = 'thinking_radio'
-        elif state == 'thinking_radio':
-            if 'llm_uttered' in events:
-                # The LLM is done thinking and it is time to talk
-                response = pipe_llm.recv()
-                music.set_volume(0.025)
-                conversation.append(response)
-                play_time = say(response, mimic, voice_file, text_output=True)
-                radio_end_time = time.time() + play_time
-                # We can start thinking the next sentence already
-                response_prompt = nlp_utils.broadcast_prompt(
-                                       json_config['monologue_prompt'],
-                                       conversation,
-                                       username=json_config['username'])
-                pipe_llm.send(response_prompt)
+        elif state in ('thinking_radio', 'think_and_say'):
+            if 'llm_streamed' in events:
+                # Every sentence is synthesized as soon as it arrives and
+                # queued right after whatever is still being said. A new
+                # line enters the radio buffer once its first sentence does.
+                speech.say(llm_text, request_id, new_line=new_line,
+                           text_output=True)
+                new_line = False
                 state = 'think_and_say'
-            else:
-                # We maybe want to go back to dialog mode, but we first need
-                # to clean the utterance queue
-                print("Press Enter within 3 seconds to return to dialog mode")
-                key_press, _, _ = select.select([sys.stdin], [], [], 3)
-                if key_press:
-                    # There was input, so we first clear the STDIN queue.
-                    _ = sys.stdin.readline().strip()
-                    # We now go back to dialog mode after cleaning
-                    # the queue of messages from the LLM.
-                    state = 'clear_queue'
-        elif state == 'think_and_say':
-            if 'llm_uttered' in events:
-                # The LLM is done thinking the next sentence,
-                # but we are not done talking yet
-                state = 'slow_tongue'
+            elif 'llm_uttered' in events:
+                # The LLM is done thinking this line. We think the next one
+                # unless enough lines are already waiting to be played.
+                conversation.append(llm_text)
+                new_line = True
+                if radio_buffer.full():
+                    state = 'slow_tongue'
+                else:
+                    request_id = tracing.new_request()
+                    send_prompt(pipe_llm, conversation, request_id,
+                                protocol.BACKGROUND)
+                    llm_busy = True
             elif 'done_speaking' in events:
-                # The system is done speaking, but the next utterance is not
-                # there yet.
+                if state == 'think_and_say':
+                    # The system is done speaking, but the next utterance is
+                    # not there yet
+                    radio_buffer.underruns += 1
+                    logger.debug(f"Radio buffer underrun: "
+                                 f"{radio_buffer.stats()}")
+                # Otherwise, the opening is over
                 music.set_volume(0.5)
                 state = 'thinking_radio'
-            elif 'release_r' in events:
-                # We want to go back to dialog mode, but we first need
-                # to clean the utterance queue.
-                # Note that the system is still speaking. This is technically
-                # a bug to be solved with an extra state
-                music.set_volume(0.5)
-                state = 'clear_queue'
         elif state == 'slow_tongue':
-            if 'done_speaking' in events:
-                # I am ready to speak some more
-                state = 'thinking_radio'
-            elif 'release_r' in events:
-                # I want to go back to dialog mode, but the system is still
-                # talking
-                state = 'finish_talking'
-        elif state == 'finish_talking':
-            if 'done_speaking' in events:
-                # Get ready to go back to dialog mode
-                music.set_volume(0.5)
-                conversation = list(json_config['dialog_seed'])
-                state = 'idle_dialog'
-        elif state == 'clear_queue':
-            if 'llm_uttered' in events:
-                _ = pipe_llm.recv()
-                conversation = list(json_config['dialog_seed'])
-                state = 'idle_dialog'
+            if 'line_started' in events and not radio_buffer.full():
+                # A line started playing, so there is room for another one
+                request_id = tracing.new_request()
+                send_prompt(pipe_llm, conversation, request_id,
+                            protocol.BACKGROUND)
+                llm_busy = True
+                state = 'think_and_say'
         # Is this correct?
         events = []
+        voice_active = speech.busy()
         if state != old_state:
             logger.debug(f"{old_state} -> {state}")
         # Finally, redraw the screen at an astonishing 5 FPS
+    logger.debug(f"Radio buffer: {radio_buffer.stats()}")
     # Output the last dialog for debugging
     logger.debug("Last chat log")
     for utterance in conversation:
         logger.debug(f"- {utterance}")
+    for log in (dialog_log, monologue_log):
+        if log is not None:
+            log.close()
 
 
-def run_main_loop(pipe_llm, pipe_speech_to_text, json_config, use_gui=True):
+def run_main_loop(pipe_llm, pipe_speech_to_text, pipe_tts, json_config,
+                  use_gui=True, count_tokens=nlp_utils.estimate_tokens,
+                  resume=False):
     """ Runs the main interaction loop.
 
     Parameters
@@ -513,36 +899,52 @@ def run_main_loop(pipe_llm, pipe_speech_to_text, json_config, use_gui=True):
         Pipe to send and receive messages to and from the LLM.
     pipe_speech_to_text : Pipe()
         Pipe to send and receive messages to and from the speech-to-text.
+    pipe_tts : Pipe()
+        Pipe to send and receive messages to and from the text-to-speech.
     json_config : dict()
         Dictionary with general configuration options for the system.
     use_gui : bool
         Whether to use the GUI or the text-only interface.
+    count_tokens : function
+        Function that returns the number of tokens in a text according to
+        the LLM. See `nlg.token_counter`.
+    resume : bool
+        Whether to continue the last dialog and, once radio mode starts,
+        the last monologue instead of starting new ones. See
+        `conversation_log`.
     """
     # Initialize PyGame music and sounds, and start playing static
     music.load('./sounds/gray_noise.ogg')
     music.play(loops=-1)
     music.set_volume(0.5)
 
-    # Voice configuration, including temporary file and MIMIC config
-    mimic = Mimic3TTSPlugin(config=json_config['tts'])
-    voice_file = tempfile.NamedTemporaryFile(delete=False)
-    voice_file.close()
+    # Speech goes through its own channel, so sentences can be queued one
+    # after the other without the button sounds getting in the way
+    pygame.mixer.set_reserved(1)
+    voice_channel = pygame.mixer.Channel(0)
+    # Everything that is said can also be streamed to other listeners
+    radio = broadcast.from_config(json_config)
+    if radio is not None:
+        radio.start()
 
     # There are two ways to run the main loop depending on whether
     # you are using the GUI or not. We split the code here because
     # the code for processing inputs is different in each case,
     # and better to have two functions that lots of nested ifs.
     if use_gui:
-        _run_main_loop_gui(pipe_llm, pipe_speech_to_text, json_config,
-                           mimic, voice_file.name)
+        _run_main_loop_gui(pipe_llm, pipe_speech_to_text, pipe_tts,
+                           json_config, voice_channel, count_tokens, resume,
+                           radio)
     else:
-        _run_main_loop_txt(pipe_llm, pipe_speech_to_text, json_config,
-                           mimic, voice_file.name)
+        _run_main_loop_txt(pipe_llm, pipe_speech_to_text, pipe_tts,
+                           json_config, voice_channel, count_tokens, resume,
+                           radio)
 
     # Cleanup
-    pipe_llm.send('quit')
+    pipe_llm.send(protocol.Quit())
     pipe_speech_to_text.send('quit')
+    pipe_tts.send('quit')
+    if radio is not None:
+        radio.close()
     music.stop()
     pygame.quit()
-    # Delete the voice temporary file
-    os.unlink(voice_file.name)
@@ -0,0 +1,179 @@
+import json
+import os
+import time
+import uuid
+
+
+class ConversationLog:
+    """ Utterances of every conversation, appended to a file on disk.
+
+    The file holds one compact JSON object per line with the conversation it
+    belongs to (`s`), the position of the utterance in that conversation
+    (`i`), the time (`t`) and the utterance itself (`u`). Once the file
+    grows too large it is rotated, keeping a few older files around.
+
+    Parameters
+    ----------
+    path : str
+        File where the utterances are appended. Created if it doesn't exist,
+        along with its directory.
+    max_mb : float
+        Size of the file at which it is rotated.
+    backups : int
+        Number of rotated files that are kept, named `path.1` (the most
+        recent one) to `path.N`.
+
+    Notes
+    -----
+    Resuming a conversation only reads the end of the log, so it takes the
+    same time no matter how long the history is.
+    """
+    def __init__(self, path, max_mb=1, backups=3):
+        self.path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                    exist_ok=True)
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.backups = backups
+        self.session = None
+        self._file = None
+
+    def start_session(self, session=None):
+        """ Starts logging a new conversation, or continues an old one.
+
+        Parameters
+        ----------
+        session : str
+            Conversation to continue. If None, a new one is started.
+        """
+        self.session = session or uuid.uuid4().hex[:12]
+
+    def append(self, index, utterance):
+        """ Appends an utterance to the current conversation.
+
+        Parameters
+        ----------
+        index : int
+            Position of the utterance in the conversation.
+        utterance : str
+            The utterance.
+        """
+        if self.session is None:
+            self.start_session()
+        if self._file is None:
+            self._file = open(self.path, 'ab', buffering=0)
+        line = json.dumps({'s': self.session, 'i': index,
+                           't': round(time.time(), 1), 'u': utterance},
+                          separators=(',', ':')).encode('utf-8') + b'\n'
+        if self._file.tell() > 0 and \
+                self._file.tell() + len(line) > self.max_bytes:
+            self._rotate()
+        # Every line is written with a single call, so an interrupted run
+        # leaves at most one broken line behind
+        self._file.write(line)
+
+    def _rotate(self):
+        """ Moves the current file to the backups and starts a new one. """
+        self._file.close()
+        if self.backups == 0:
+            os.unlink(self.path)
+        for idx in range(self.backups, 0, -1):
+            older = self.path if idx == 1 else f'{self.path}.{idx - 1}'
+            if os.path.exists(older):
+                os.replace(older, f'{self.path}.{idx}')
+        self._file = open(self.path, 'ab', buffering=0)
+
+    def last_session(self, max_turns):
+        """ Reads the end of the last conversation in the log.
+
+        Parameters
+        ----------
+        max_turns : int
+            Maximum number of utterances to read.
+
+        Returns
+        -------
+        (str, list((int, str)))
+            The conversation and its last utterances in order, each one with
+            its position in the conversation. (None, []) if the log is empty.
+        """
+        session, turns = None, []
+        for record in self._records_backwards():
+            if session is None:
+                session = record['s']
+            elif record['s'] != session:
+                break
+            elif record['i'] >= turns[-1][0]:
+                # Replaced by the utterances that follow it, because the
+                # conversation was resumed before it
+                continue
+            turns.append((record['i'], record['u']))
+            if len(turns) >= max_turns or record['i'] == 0:
+                break
+        turns.reverse()
+        return session, turns
+
+    def _records_backwards(self):
+        """ Yields the records of the log from the newest to the oldest. """
+        paths = [self.path] + [f'{self.path}.{idx}'
+                               for idx in range(1, self.backups + 1)]
+        for path in paths:
+            if not os.path.exists(path):
+                continue
+            for line in _lines_backwards(path):
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # Cut short when the program was interrupted
+                    continue
+
+    def close(self):
+        """ Closes the file. """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _lines_backwards(path, block_size=4096):
+    """ Yields the lines of a file from the last one to the first one,
+    reading only as much of the file as needed. """
+    with open(path, 'rb') as fp:
+        position = fp.seek(0, os.SEEK_END)
+        rest = b''
+        while position > 0:
+            size = min(block_size, position)
+            position -= size
+            fp.seek(position)
+            lines = (fp.read(size) + rest).split(b'\n')
+            # The first line could continue in the previous block
+            rest = lines[0]
+            for line in reversed(lines[1:]):
+                if line:
+                    yield line.decode('utf-8', 'replace')
+        if rest:
+            yield rest.decode('utf-8', 'replace')
+
+
+def from_config(json_config, name):
+    """ Creates the conversation log described in the configuration.
+
+    Parameters
+    ----------
+    json_config : dict
+        Dictionary with general configuration options for the system. The
+        optional `conversation_log` block can set the `directory`, `max_mb`
+        and `backups` of the log, or be set to false to disable it.
+    name : str
+        Name of the log, such as 'dialog' or 'monologue'.
+
+    Returns
+    -------
+    ConversationLog or None
+        The configured log, or None if it is disabled.
+    """
+    config = json_config.get('conversation_log', dict())
+    if config is False:
+        return None
+    config = dict(config)
+    directory = config.pop(
+        'directory', os.path.join('~', '.local', 'share', 'radiobot'))
+    return ConversationLog(os.path.join(directory, name + '.jsonl'), **config)
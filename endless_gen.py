@@ -1,12 +1,19 @@
 #!/usr/bin/env python3
 import argparse
+import conversation_log
 import json
+import nlg_daemon
 import nlp_utils
 import os
+import prerender
+import protocol
+import queue
 import random
 import signal
 import sys
-from multiprocessing import Pipe
+import tempfile
+import time
+from multiprocessing import Event, Pipe, Process, Queue
 
 
 # A list of animal names, used to generate the output files and give them
@@ -21,55 +28,406 @@ def signal_handler(sig, frame):
     # End the program
     # Delete the voice temporary file
     print("Ending the program")
-    llm_pipe[0].send('quit')
-    os.waitpid(llm_pid, 0)
+    llm_pipe[0].send(protocol.Quit())
+    if llm_pid is not None:
+        os.waitpid(llm_pid, 0)
     with open(ssml_output, 'a') as fp:
         print('</speak>', file=fp)
+    if renderer is not None:
+        print("Waiting for the audio to be rendered")
+        renderer.close()
+    log.close()
     sys.exit(0)
 
 
+def _reopen_ssml(filename):
+    """ Removes the closing tag of an SSML file, so more sentences can be
+    appended to it. """
+    with open(filename, 'rb+') as fp:
+        content = fp.read()
+        end = content.rstrip().rfind(b'</speak>')
+        if end >= 0:
+            fp.truncate(end)
+
+
+def _free_name(base, extension):
+    """ Returns `base.extension`, or `base_N.extension` with the first N
+    that doesn't overwrite an existing file. """
+    filename, n = f'{base}.{extension}', 1
+    while os.path.exists(filename):
+        n += 1
+        filename = f'{base}_{n}.{extension}'
+    return filename
+
+
+def _write_atomic(filename, content):
+    """ Writes a file under a temporary name and then renames it, so other
+    programs never see half a file.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_name = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    with os.fdopen(fd, 'w') as fp:
+        fp.write(content)
+    os.replace(tmp_name, filename)
+
+
+class RotatingOutput:
+    """ Writes a monologue as numbered pairs of text and SSML files.
+
+    Parameters
+    ----------
+    basename : str
+        Beginning of the name of every file.
+    lines_per_file : int
+        Number of lines in every file.
+
+    Notes
+    -----
+    Lines are kept in memory until a file is complete, and then both files
+    are written atomically.
+    """
+    def __init__(self, basename, lines_per_file=100):
+        self.basename = basename
+        self.lines_per_file = lines_per_file
+        self.lines = []
+        self.part = 0
+
+    def add(self, line):
+        """ Adds a line to the monologue, writing the files if they are
+        complete.
+
+        Parameters
+        ----------
+        line : str
+            New line.
+        """
+        self.lines.append(line.strip())
+        if len(self.lines) >= self.lines_per_file:
+            self.flush()
+
+    def flush(self):
+        """ Writes the lines so far, even if there are not enough of them to
+        complete a file.
+        """
+        if len(self.lines) == 0:
+            return
+        _write_atomic(f'{self.basename}_{self.part:04d}.txt',
+                      ''.join(line + '\n' for line in self.lines))
+        _write_atomic(f'{self.basename}_{self.part:04d}.ssml',
+                      '<speak>\n' +
+                      ''.join(f'<s>{line}</s><break time="1s" />\n'
+                              for line in self.lines) +
+                      '</speak>\n')
+        self.part += 1
+        self.lines = []
+
+
+def worker_config(app_config, idx):
+    """ Returns the configuration used by a worker in throughput mode.
+
+    Parameters
+    ----------
+    app_config : dict
+        Dictionary with general configuration options for the system.
+    idx : int
+        Number of the worker.
+
+    Returns
+    -------
+    dict
+        The same configuration, with the monologue seed in a different order
+        for every worker. If the optional `monologue_personas` key lists
+        several prompts, every worker also uses a different one.
+    """
+    config = dict(app_config)
+    personas = app_config.get('monologue_personas', [])
+    if len(personas) > 0:
+        config['monologue_prompt'] = personas[idx % len(personas)]
+    seed = list(app_config['monologue_seed'])
+    random.Random(idx).shuffle(seed)
+    config['monologue_seed'] = seed
+    return config
+
+
+def run_worker(idx, llm_path, app_config, basename, lines_per_file,
+               n_threads, cores, stats, stop, audio=None, tts_workers=2):
+    """ Generates a monologue until it is asked to stop. Every worker runs
+    its own LLM server.
+
+    Parameters
+    ----------
+    idx : int
+        Number of the worker. Used as the seed of the LLM.
+    llm_path : str
+        Path to the language model.
+    app_config : dict
+        Dictionary with general configuration options for the system.
+    basename : str
+        Beginning of the name of the output files.
+    lines_per_file : int
+        Number of lines in every output file.
+    n_threads : int
+        Number of threads of the language model.
+    cores : list(int)
+        CPU cores that the worker and its LLM server can use. If None, they
+        can use any.
+    stats : multiprocessing.Queue
+        Queue where the worker puts (idx, tokens) for every line.
+    stop : multiprocessing.Event
+        Set when the workers should stop, after finishing their current line.
+    audio : str
+        If given, the monologue is also rendered as audio in this format
+        ('ogg' or 'wav').
+    tts_workers : int
+        Number of processes rendering the audio.
+    """
+    # Ctrl-C is handled by the parent, which tells the workers to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if cores is not None:
+        os.sched_setaffinity(0, cores)
+    import autotune
+    import nlg
+    config = worker_config(app_config, idx)
+    llm_pipe = Pipe()
+    server = Process(target=nlg.run_nlg_server,
+                     args=(llm_path, llm_pipe[1]),
+                     kwargs={'username': config['username'],
+                             'prefixes': [nlp_utils.persona_prefixes(
+                                 config)['monologue']],
+                             'seed': idx,
+                             'n_threads': n_threads,
+                             'profile': autotune.load_profile(app_config,
+                                                              llm_path)})
+    server.start()
+    count_tokens = nlg.token_counter(llm_path)
+    conversation = nlp_utils.monologue_window(config, count_tokens,
+                                              context_turns=5)
+    output = RotatingOutput(basename, lines_per_file)
+    renderer = None
+    if audio is not None:
+        renderer = prerender.AudioRenderer(f'{basename}.{audio}',
+                                           config['tts'], tts_workers)
+    for utterance in conversation:
+        output.add(utterance)
+        if renderer is not None:
+            renderer.add(utterance)
+    # Wait for the model to load
+    llm_pipe[0].recv()
+    while not stop.is_set():
+        llm_pipe[0].send(protocol.Prompt(conversation.prompt()))
+        message = llm_pipe[0].recv()
+        while isinstance(message, protocol.Chunk):
+            message = llm_pipe[0].recv()
+        response = message.text
+        conversation.append(response)
+        output.add(response)
+        if renderer is not None:
+            renderer.add(response)
+        # The count includes the beginning-of-sentence token
+        stats.put((idx, max(count_tokens(response) - 1, 0)))
+    output.flush()
+    llm_pipe[0].send(protocol.Quit())
+    server.join()
+    if renderer is not None:
+        renderer.close()
+
+
+def run_throughput(llm_path, app_config, workers, threads=None, pin=False,
+                   lines_per_file=100, report_seconds=10.0, audio=None,
+                   tts_workers=2):
+    """ Generates several monologues in parallel until Ctrl-C is pressed,
+    printing the aggregated throughput as JSON every now and then.
+
+    Parameters
+    ----------
+    llm_path : str
+        Path to the language model.
+    app_config : dict
+        Dictionary with general configuration options for the system.
+    workers : int
+        Number of monologues generated in parallel.
+    threads : int
+        Number of threads of every LLM. If None, the available cores are
+        split evenly between the workers.
+    pin : bool
+        If True, every worker is pinned to its own set of cores.
+    lines_per_file : int
+        Number of lines in every output file.
+    report_seconds : float
+        Time between reports.
+    audio : str
+        If given, every monologue is also rendered as audio in this format
+        ('ogg' or 'wav').
+    tts_workers : int
+        Number of processes rendering the audio of every monologue.
+    """
+    cores = sorted(os.sched_getaffinity(0))
+    per_worker = max(1, len(cores) // workers)
+    if threads is None:
+        threads = per_worker
+    a0, a1 = random.sample(sorted(animals), 2)
+    stats = Queue()
+    stop = Event()
+    processes = []
+    for idx in range(workers):
+        if pin:
+            worker_cores = cores[idx * per_worker:(idx + 1) * per_worker] or \
+                [cores[idx % len(cores)]]
+        else:
+            worker_cores = None
+        processes.append(Process(
+            target=run_worker,
+            args=(idx, llm_path, app_config, f"monologue_{a0}_{a1}_{idx}",
+                  lines_per_file, threads, worker_cores, stats, stop,
+                  audio, tts_workers)))
+    for process in processes:
+        process.start()
+    signal.signal(signal.SIGINT, lambda sig, frame: stop.set())
+
+    start = time.time()
+    last_report = start
+    lines = 0
+    tokens = 0
+    running = True
+    while running:
+        running = any(process.is_alive() for process in processes)
+        try:
+            _, line_tokens = stats.get(timeout=1.0)
+            lines += 1
+            tokens += line_tokens
+            running = True
+        except queue.Empty:
+            pass
+        if time.time() - last_report >= report_seconds or not running:
+            last_report = time.time()
+            elapsed = last_report - start
+            print(json.dumps({'workers': workers,
+                              'threads': threads,
+                              'elapsed_seconds': elapsed,
+                              'lines': lines,
+                              'tokens': tokens,
+                              'lines_per_second': lines / elapsed,
+                              'tokens_per_second': tokens / elapsed}),
+                  flush=True)
+
+
 if __name__ == '__main__':
     """ Script for endless generation. 
     """
     # General command line options
     parser = argparse.ArgumentParser(description='Launchs the generation system')
     parser.add_argument('llm', help='LLM to use for speech generation')
+    parser.add_argument('-w', '--workers', type=int,
+                        help='Generate this many monologues in parallel')
+    parser.add_argument('--threads', type=int,
+                        help='Threads per worker (default: cores / workers)')
+    parser.add_argument('--pin', action='store_true',
+                        help='Pin every worker to its own cores')
+    parser.add_argument('--lines-per-file', type=int, default=100,
+                        help='Lines in every output file of a worker')
+    parser.add_argument('--audio', choices=['ogg', 'wav'],
+                        help='Also render the monologue as audio')
+    parser.add_argument('--tts-workers', type=int, default=2,
+                        help='Processes rendering the audio')
+    parser.add_argument('--nlg-server', nargs='?', metavar='ADDRESS',
+                        const=nlg_daemon.DEFAULT_ADDRESS,
+                        help='Use the LLM of a running nlg_daemon.py '
+                             'instead of loading it')
+    parser.add_argument('--resume', metavar='LOG',
+                        help='Continue the monologue of a previous run, '
+                             'given its .jsonl log')
     args = parser.parse_args()
 
     # Read some general parameters
     with open('config.json', 'r') as fp:
         app_config = json.load(fp)
 
-    a0, a1 = random.sample(animals, 2)
-    txt_output = "monologue_{}_{}.txt".format(a0, a1)
-    ssml_output = "monologue_{}_{}.ssml".format(a0, a1)
+    if args.workers is not None:
+        run_throughput(args.llm, app_config, args.workers,
+                       threads=args.threads, pin=args.pin,
+                       lines_per_file=args.lines_per_file,
+                       audio=args.audio, tts_workers=args.tts_workers)
+        sys.exit(0)
+
+    if args.resume is not None:
+        # Keep writing to the files of the previous run
+        base = os.path.splitext(args.resume)[0]
+    else:
+        a0, a1 = random.sample(animals, 2)
+        base = "monologue_{}_{}".format(a0, a1)
+    txt_output = base + ".txt"
+    ssml_output = base + ".ssml"
+    renderer = None
+    # Every line is also logged, so the monologue can be resumed
+    log = conversation_log.ConversationLog(base + ".jsonl")
 
     # Start the services
     llm_pipe = Pipe()
-    llm_pid = os.fork()
+    llm_pid = None
+    if args.nlg_server is not None:
+        # The model is already loaded by another process
+        llm_pipe = (nlg_daemon.connect(args.nlg_server, base,
+                                       app_config['username']), None)
+    else:
+        llm_pid = os.fork()
     if llm_pid == 0:
         # LLM server
+        import autotune
         import nlg
         nlg.run_nlg_server(args.llm, llm_pipe[1],
-                           username=app_config['username'])
+                           username=app_config['username'],
+                           prefixes=[nlp_utils.persona_prefixes(
+                               app_config)['monologue']],
+                           profile=autotune.load_profile(app_config,
+                                                         args.llm))
     else:
+        if args.audio is not None:
+            # Lines are rendered as they are generated, faster than they
+            # could be played
+            renderer = prerender.AudioRenderer(
+                _free_name(base, args.audio), app_config['tts'],
+                args.tts_workers)
         signal.signal(signal.SIGINT, signal_handler)
+        import nlg
+        count_tokens = nlg.token_counter(args.llm)
+        conversation = nlp_utils.monologue_window(
+            app_config, count_tokens, context_turns=5, log=log,
+            resume=args.resume is not None)
+        if conversation.resumed:
+            _reopen_ssml(ssml_output)
         # Begin the generation procedure
-        with open(txt_output, 'w') as fp:
-            with open(ssml_output, 'w') as fp_ssml:
-                print("<speak>", flush=True, file=fp_ssml)
-                conversation = list(app_config['monologue_seed'])
-                for utterance in conversation:
-                    print(utterance, flush=True, file=fp)
-                    print(f'<s>{utterance}</s><break time="1s" />', flush=True, file=fp_ssml)
+        with open(txt_output, 'a' if conversation.resumed else 'w') as fp:
+            with open(ssml_output, 'a' if conversation.resumed else 'w') as fp_ssml:
+                if not conversation.resumed:
+                    # The resumed lines are already in the files
+                    print("<speak>", flush=True, file=fp_ssml)
+                    for utterance in conversation:
+                        print(utterance.strip(), flush=True, file=fp)
+                        print(f'<s>{utterance}</s><break time="1s" />', flush=True, file=fp_ssml)
+                        if renderer is not None:
+                            renderer.add(utterance)
+                # Wait for the model to load
+                llm_pipe[0].recv()
                 while True:
-                    response_prompt = nlp_utils.broadcast_prompt(
-                        app_config['monologue_prompt'],
-                        conversation,
-                        context_turns=5,
-                        username=app_config['username'])
-                    llm_pipe[0].send(response_prompt)
-                    response = llm_pipe[0].recv()
-                    print(response, flush=True, file=fp)
-                    print(f'<s>{response}</s><break time="1s" />', flush=True, file=fp_ssml)
+                    response_prompt = conversation.prompt()
+                    llm_pipe[0].send(protocol.Prompt(response_prompt,
+                                                     None,
+                                                     protocol.BACKGROUND))
+                    # Write every sentence as soon as it is generated, so
+                    # the output files can be read while they grow
+                    message = llm_pipe[0].recv()
+                    separator = ''
+                    while isinstance(message, protocol.Chunk):
+                        # Same lines as the throughput mode, without a
+                        # trailing space
+                        print(separator + message.text.strip(), end='',
+                              flush=True, file=fp)
+                        separator = ' '
+                        print(f'<s>{message.text}</s>', flush=True, file=fp_ssml)
+                        message = llm_pipe[0].recv()
+                    response = message.text
+                    print(flush=True, file=fp)
+                    print('<break time="1s" />', flush=True, file=fp_ssml)
                     conversation.append(response)
+                    if renderer is not None:
+                        renderer.add(response)
@@ -1,10 +1,500 @@
 #!/usr/bin/env python3
 import logging
+import protocol
+import re
 import sys
+import time
+import tracing
+from collections import deque
 from llama_cpp import Llama
+from nlp_utils import CONTEXT_TOKENS, MAX_NEW_TOKENS, MAX_PROMPT_TOKENS
+from state_cache import StateCache
 
+# Punctuation that closes a sentence or, for long enough chunks, a clause
+_sentence_end = re.compile(r'[.!?;:]["\')\]]*$')
+_clause_end = re.compile(r'[,]["\')\]]*$')
+# Abbreviations whose period doesn't close the sentence
+_abbreviation = re.compile(
+    r'(?:^|[\s("\'])(?:e\.g|i\.e|vs|Mr|Mrs|Ms|Dr|St)\.["\')\]]*$',
+    re.IGNORECASE)
 
-def run_nlg_server(llm_path, comm_pipe, username="User"):
+
+def _clean_text(text):
+    """ Removes the characters that the speech synthesizer can't handle.
+
+    Parameters
+    ----------
+    text : str
+        Text as it was generated by the LLM.
+
+    Returns
+    -------
+    str
+        The same text without emojis and leading or trailing spaces.
+    """
+    return text.encode('ascii', 'ignore').decode('ascii').strip()
+
+
+def split_chunks(pieces, min_clause_chars=40):
+    """ Groups a stream of generated text pieces into speakable chunks.
+
+    Parameters
+    ----------
+    pieces : iterable(str)
+        Text pieces in the order in which they were generated. A piece is
+        usually a single token.
+    min_clause_chars : int
+        Minimum length that a chunk must have before it can be split at a
+        comma. Short clauses sound choppy when they are synthesized on their
+        own, so they are merged with the text that follows them.
+
+    Yields
+    ------
+    str
+        A sentence or clause as soon as it is complete. The last chunk
+        contains whatever text is left once the stream is exhausted.
+
+    Notes
+    -----
+    A chunk is only closed when the piece that follows the punctuation starts
+    with a space, which prevents "3.5" from being split in half, and never
+    after a common abbreviation such as "e.g." or "Dr.".
+    """
+    chunk = ''
+    for piece in pieces:
+        if chunk and piece[:1].isspace():
+            if (_sentence_end.search(chunk) and
+                    not _abbreviation.search(chunk)) or \
+                    (_clause_end.search(chunk) and
+                     len(chunk) >= min_clause_chars):
+                chunk = _clean_text(chunk)
+                if chunk:
+                    yield chunk
+                chunk = ''
+        chunk += piece
+    chunk = _clean_text(chunk)
+    if chunk:
+        yield chunk
+
+
+def token_counter(llm_path):
+    """ Loads the tokenizer of a language model without its weights.
+
+    Parameters
+    ----------
+    llm_path : str
+        Path to the language model.
+
+    Returns
+    -------
+    function
+        Function that returns the number of tokens in a text. The count
+        includes the beginning-of-sentence token, so it is one too many for
+        texts that are not at the beginning of a prompt.
+    """
+    vocab = Llama(model_path=llm_path, vocab_only=True, verbose=False)
+    return lambda text: len(vocab.tokenize(text.encode('utf-8')))
+
+
+class PrefixStats:
+    """ Measures how much of every prompt llama.cpp reuses from the previous
+    evaluation, which is the part that doesn't need to be evaluated again.
+
+    It also measures the time to the first generated token of every prompt,
+    and how much of it was saved by evaluating a prefix of the prompt ahead
+    of time (see `prefill`).
+    """
+    def __init__(self):
+        self.prompts = 0
+        # Prompts that reuse the whole previous evaluation
+        self.hits = 0
+        self.prompt_tokens = 0
+        self.evaluated_tokens = 0
+        self.prefills = 0
+        self.prefill_hits = 0
+        self.first_token_seconds = 0.0
+        self.saved_seconds = 0.0
+        # Tokens and evaluation time of the last prefill, until a prompt
+        # uses it
+        self._prefilled = None
+        self.first_token_time = None
+        self.generated_pieces = 0
+
+    def prefill(self, tokens, seconds):
+        """ Records the evaluation of a prompt prefix ahead of time.
+
+        Parameters
+        ----------
+        tokens : list(int)
+            Tokens of the prefix.
+        seconds : float
+            Time it took to evaluate them.
+        """
+        self.prefills += 1
+        self._prefilled = (tokens, seconds)
+
+    def update(self, llm, tokens):
+        """ Measures a new prompt. It must be called before the prompt is
+        given to the model.
+
+        Parameters
+        ----------
+        llm : Llama
+            Language model that will continue the prompt.
+        tokens : list(int)
+            Tokens of the prompt.
+
+        Returns
+        -------
+        int
+            Number of tokens that will be evaluated.
+        """
+        # Same rule as llama-cpp-python: the last token is always evaluated
+        previous = list(getattr(llm, 'eval_tokens', []))
+        reused = 0
+        for old, new in zip(previous, tokens[:-1]):
+            if old != new:
+                break
+            reused += 1
+        self.prompts += 1
+        # Every prompt starts with the same tokens, so a hit is a prompt that
+        # continues everything that was evaluated before it
+        self.hits += 1 if previous and reused >= len(previous) else 0
+        self.prompt_tokens += len(tokens)
+        self.evaluated_tokens += len(tokens) - reused
+        if self._prefilled is not None:
+            prefilled, seconds = self._prefilled
+            if reused >= len(prefilled) - 1:
+                # Without the prefill, this time would have been spent
+                # before the first token
+                self.prefill_hits += 1
+                self.saved_seconds += seconds
+            self._prefilled = None
+        return len(tokens) - reused
+
+    def timed(self, pieces, start):
+        """ Passes generated pieces through, measuring the time until the
+        first one. Afterwards, `first_token_time` holds the time at which
+        the first piece arrived (or None) and `generated_pieces` how many
+        there were.
+
+        Parameters
+        ----------
+        pieces : iterable(str)
+            Generated text pieces.
+        start : float
+            Time (as given by `time.time`) at which the prompt was received.
+
+        Yields
+        ------
+        str
+            The same pieces.
+        """
+        self.first_token_time = None
+        self.generated_pieces = 0
+        for piece in pieces:
+            if self.first_token_time is None:
+                self.first_token_time = time.time()
+                self.first_token_seconds += self.first_token_time - start
+            self.generated_pieces += 1
+            yield piece
+
+    def summary(self):
+        """ Returns the statistics so far as a dictionary. """
+        return {'prompts': self.prompts,
+                'hit_rate': self.hits / max(self.prompts, 1),
+                'prompt_tokens': self.prompt_tokens,
+                'evaluated_tokens': self.evaluated_tokens,
+                'saved_tokens': self.prompt_tokens - self.evaluated_tokens,
+                'mean_first_token_seconds':
+                    self.first_token_seconds / max(self.prompts, 1),
+                'prefills': self.prefills,
+                'prefill_hits': self.prefill_hits,
+                'first_token_seconds_saved': self.saved_seconds}
+
+
+def _fit_prompt(llm, prompt):
+    """ Ensures that a prompt leaves enough room in the context of the
+    language model for the reply.
+
+    Parameters
+    ----------
+    llm : Llama
+        Language model used to generate the responses
+    prompt : str
+        Prompt to continue.
+
+    Returns
+    -------
+    (str, list(int))
+        The same prompt, or its last tokens if it was too long, plus its
+        tokens.
+
+    Notes
+    -----
+    The prompts are built to fit already (see `nlp_utils.ContextWindow`),
+    so cutting them here is a last resort. It is still better than letting
+    the model fail halfway through the evaluation.
+    """
+    # llama-cpp-python adds a space before the prompt, so we do the same
+    tokens = llm.tokenize(b' ' + prompt.encode('utf-8'))
+    budget = MAX_PROMPT_TOKENS
+    if len(tokens) <= budget:
+        return prompt, tokens
+    logger = logging.getLogger('radiobot')
+    logger.warning(f"Prompt too long: {len(tokens)} tokens, keeping {budget}")
+    # The first token is the beginning-of-sentence, which is added again
+    text = llm.detokenize(tokens[-(budget - 1):]).decode('utf-8', 'ignore')
+    text = text[1:] if text.startswith(' ') else text
+    return text, llm.tokenize(b' ' + text.encode('utf-8'))
+
+
+def _prefill(llm, text):
+    """ Evaluates the beginning of a prompt before the prompt is known.
+
+    Parameters
+    ----------
+    llm : Llama
+        Language model used to generate the responses
+    text : str
+        Text that the next prompt will start with.
+
+    Returns
+    -------
+    list(int)
+        Tokens of the text, which are now part of the state of the model.
+        Empty if the text doesn't fit in the context.
+
+    Notes
+    -----
+    This follows the same rules as `Llama.generate`: the tokens that were
+    already evaluated are kept, and whatever comes after them is discarded.
+    The next prompt then only needs to evaluate the text after the prefix.
+    """
+    tokens = llm.tokenize(b' ' + text.encode('utf-8'))
+    if len(tokens) > MAX_PROMPT_TOKENS:
+        return []
+    reused = 0
+    for old, new in zip(llm.eval_tokens, tokens):
+        if old != new:
+            break
+        reused += 1
+    while len(llm.eval_tokens) > reused:
+        llm.eval_tokens.pop()
+        try:
+            llm.eval_logits.pop()
+        except IndexError:
+            pass
+    if reused < len(tokens):
+        llm.eval(tokens[reused:])
+    return tokens
+
+
+def _generate(llm, prompt, username, stream):
+    """ Generates the continuation of a prompt piece by piece.
+
+    Parameters
+    ----------
+    llm : Llama
+        Language model used to generate the responses
+    prompt : str
+        Prompt to continue. It must fit in the context of the model.
+    username : str
+        Name of the user that the AI is talking to.
+    stream : bool
+        If True, the text is yielded token by token as soon as it is
+        generated. Otherwise, it is yielded as a single piece once the
+        generation is complete.
+
+    Yields
+    ------
+    str
+        Pieces of generated text.
+    """
+    stop = ["</s>", "\n", f"{username}:"]
+    if stream:
+        for output in llm(prompt, max_tokens=MAX_NEW_TOKENS, stop=stop,
+                          stream=True):
+            yield output['choices'][0]['text']
+    else:
+        output = llm(prompt, max_tokens=MAX_NEW_TOKENS, stop=stop)
+        yield output['choices'][0]['text']
+
+
+class CancelWatcher:
+    """ Stops a reply as soon as the client cancels it.
+
+    Parameters
+    ----------
+    comm_pipe : Pipe()
+        Pipe of the server.
+    request : str
+        Request of the reply being generated.
+    inbox : collections.deque
+        Messages that arrive during the generation and must be handled after
+        it are appended here.
+    """
+    def __init__(self, comm_pipe, request, inbox):
+        self.comm_pipe = comm_pipe
+        self.request = request
+        self.inbox = inbox
+        self.cancelled = False
+
+    def watch(self, pieces):
+        """ Passes along the pieces of a reply until it is cancelled.
+
+        Parameters
+        ----------
+        pieces : iterable(str)
+            Pieces of the reply, as they are generated.
+
+        Yields
+        ------
+        str
+            The same pieces. The pipe is checked after every one of them, so
+            no more tokens are generated once a `protocol.Cancel` for this
+            request or a `protocol.Quit` arrives.
+        """
+        for piece in pieces:
+            yield piece
+            while self.comm_pipe.poll():
+                message = self.comm_pipe.recv()
+                if isinstance(message, protocol.Quit) or \
+                        (isinstance(message, protocol.Cancel) and
+                         message.request == self.request):
+                    self.cancelled = True
+                if not isinstance(message, protocol.Cancel):
+                    self.inbox.append(message)
+            if self.cancelled:
+                # The rest of the reply is never generated
+                return
+
+
+def load_model(llm_path, prefixes=(), seed=0, n_threads=None, profile=None):
+    """ Loads a language model and gets it ready to answer prompts.
+
+    Parameters
+    ----------
+    llm_path : str
+        Path to the language model.
+    prefixes : list(str)
+        Prompt prefixes to snapshot. See `StateCache.warm`.
+    seed : int
+        Seed for the sampling of the language model.
+    n_threads : int
+        Number of threads used by the language model. If None, the profile
+        or llama.cpp choose.
+    profile : dict
+        Tuned options of the language model. See `autotune.load_profile`.
+
+    Returns
+    -------
+    (Llama, StateCache)
+        The model, already warmed up, and the snapshots of its prefixes.
+    """
+    options = dict(profile or dict())
+    if n_threads is not None:
+        options['n_threads'] = n_threads
+    llm = Llama(model_path=llm_path, seed=seed, n_ctx=CONTEXT_TOKENS,
+                **options)
+    # The first evaluation pages in the weights, so it is done now
+    # instead of with the first prompt
+    llm.eval(llm.tokenize(b' Hello'))
+    llm.reset()
+    state_cache = StateCache(llm, llm_path, CONTEXT_TOKENS)
+    state_cache.warm(prefixes)
+    return llm, state_cache
+
+
+def prefill(llm, state_cache, prefix_stats, text):
+    """ Handles a `protocol.Prefill` message. See `_prefill`.
+
+    Parameters
+    ----------
+    llm : Llama
+        Language model used to generate the responses.
+    state_cache : StateCache
+        Snapshots of the model.
+    prefix_stats : PrefixStats
+        Statistics where the prefill is recorded.
+    text : str
+        Text that the next prompt will start with.
+    """
+    start = time.time()
+    tokens = llm.tokenize(b' ' + text.encode('utf-8'))
+    state_cache.restore(tokens)
+    tokens = _prefill(llm, text)
+    prefix_stats.prefill(tokens, time.time() - start)
+    tracing.record('prefill', start, time.time(), tokens=len(tokens))
+    logging.getLogger('radiobot').debug(
+        f"Prefilled {len(tokens)} tokens in {time.time() - start:.2f}s")
+
+
+def answer(llm, state_cache, prefix_stats, message, send, watcher,
+           username="User", stream=True, start=None):
+    """ Handles a `protocol.Prompt` message, sending the reply piece by
+    piece.
+
+    Parameters
+    ----------
+    llm : Llama
+        Language model used to generate the responses.
+    state_cache : StateCache
+        Snapshots of the model.
+    prefix_stats : PrefixStats
+        Statistics where the prompt is recorded.
+    message : protocol.Prompt
+        The prompt.
+    send : function
+        Function that sends a message to the client.
+    watcher : CancelWatcher
+        Object whose `watch` method stops the generation once the request
+        is cancelled, and whose `cancelled` attribute tells whether it was.
+    username : str
+        Name of the user that the AI is talking to.
+    stream : bool
+        If True, every sentence of the reply is sent as soon as it has been
+        generated. Otherwise the reply is sent in a single chunk.
+    start : float
+        Time at which the prompt was received. Defaults to now.
+    """
+    logger = logging.getLogger('radiobot')
+    start = time.time() if start is None else start
+    request = message.request
+    reply = []
+    prompt, tokens = _fit_prompt(llm, message.text)
+    if state_cache.restore(tokens):
+        logger.debug("Restored LLM snapshot")
+    evaluated = prefix_stats.update(llm, tokens)
+    logger.debug(f"Prompt: {len(tokens)} tokens, "
+                 f"{evaluated} to evaluate. "
+                 f"Prefix reuse: {prefix_stats.summary()}")
+    pieces = watcher.watch(_generate(llm, prompt, username, stream))
+    for chunk in split_chunks(prefix_stats.timed(pieces, start)):
+        if watcher.cancelled:
+            # Nobody wants the rest of the reply
+            break
+        send(protocol.Chunk(chunk, request))
+        reply.append(chunk)
+    send(protocol.Done(' '.join(reply), request, watcher.cancelled))
+    if watcher.cancelled:
+        logger.debug(f"Cancelled after "
+                     f"{prefix_stats.generated_pieces} tokens")
+    # Evaluating the prompt takes until the first token, and every token
+    # after that is generated one by one
+    end = time.time()
+    first_token = prefix_stats.first_token_time or end
+    tracing.record('prompt_eval', start, first_token, request,
+                   tokens=evaluated)
+    tracing.record('generate', first_token, end, request,
+                   tokens=prefix_stats.generated_pieces,
+                   tokens_per_second=prefix_stats.generated_pieces
+                   / max(end - first_token, 1e-6),
+                   cancelled=watcher.cancelled)
+
+
+def run_nlg_server(llm_path, comm_pipe, username="User", stream=True,
+                   prefixes=(), seed=0, n_threads=None, profile=None):
     """ Starts the server that generates a reply for a given prompt.
 
     Parameters
@@ -13,45 +503,64 @@ def run_nlg_server(llm_path, comm_pipe, username="User"):
         Path to the language model used to generate the responses
     comm_pipe : Pipe()
         Pipe that will be used to receive new prompts and send responses.
+    username : str
+        Name of the user that the AI is talking to.
+    stream : bool
+        If True, every sentence of the reply is sent as soon as it has been
+        generated. Otherwise the reply is sent in a single chunk.
+    prefixes : list(str)
+        Prompt prefixes that will be used often, such as the persona of
+        every mode. The model state after evaluating each of them is saved
+        to disk, so it can be restored instead of evaluated again.
+        See `nlp_utils.persona_prefixes`.
+    seed : int
+        Seed for the sampling of the language model.
+    n_threads : int
+        Number of threads used by the language model. If None, the profile
+        or llama.cpp choose.
+    profile : dict
+        Tuned options of the language model. See `autotune.load_profile`.
 
     Notes
     -----
-    To close the server send the 'quit' message through the pipe.
+    The messages are defined in `protocol`. Once the model is loaded and
+    warmed up, the server sends a `Ready` message with the time it took. To
+    close the server send a `Quit` message.
+
+    Every `Prompt` is answered with zero or more `Chunk` messages followed by
+    a single `Done` message containing the complete reply, all of them
+    tagged with the request of the prompt. A `Cancel` message for that
+    request stops the generation after the current token, and the `Done`
+    message is sent right away. The evaluation of the prompt itself can't be
+    interrupted.
+
+    To share a single model between several programs, see `nlg_daemon`.
     """
     logger = logging.getLogger('radiobot')
     try:
-        llm = Llama(model_path=llm_path, seed=0)
+        load_start = time.time()
+        llm, state_cache = load_model(llm_path, prefixes, seed, n_threads,
+                                      profile)
+        prefix_stats = PrefixStats()
+        tracing.record('load', load_start, time.time())
+        comm_pipe.send(protocol.Ready(time.time() - load_start))
+        # Messages that arrived while a reply was being generated
+        inbox = deque()
         running = True
         while running:
-            prompt = comm_pipe.recv()
-            if prompt == 'quit':
+            message = inbox.popleft() if inbox else comm_pipe.recv()
+            start = time.time()
+            if isinstance(message, protocol.Quit):
                 running = False
+            elif isinstance(message, protocol.Cancel):
+                # The reply was already sent
+                pass
+            elif isinstance(message, protocol.Prefill):
+                prefill(llm, state_cache, prefix_stats, message.text)
             else:
-                try:
-                    output = llm(prompt, max_tokens=128,
-                                 stop=["</s>", "\n"],
-                                 echo=True)
-                except ValueError:
-                    logger.debug("Prompt too long: {} words, {} characters".format(
-                        len(prompt),
-                        len(prompt.split(' '))))
-                    prompt = prompt[-500:]
-                    output = llm(prompt, max_tokens=128,
-                                 stop=[f"{username}:", "I: ", "\n"],
-                                 echo=True)
-                except RuntimeError as e:
-                    logger.warning(e)
-                    prompt = prompt[-150:]
-                    output = llm(prompt, max_tokens=128,
-                                 stop=[f"{username}:", "I: ", "\n"],
-                                 echo=True)
-                new_text = output['choices'][0]['text']
-                # Remove spaces
-                new_text = new_text.split('I: ')[-1].strip()
-                # Remove emojis
-                new_text = new_text.encode('ascii', 'ignore').decode('ascii')
-                # Send the text
-                comm_pipe.send(new_text)
+                watcher = CancelWatcher(comm_pipe, message.request, inbox)
+                answer(llm, state_cache, prefix_stats, message,
+                       comm_pipe.send, watcher, username, stream, start)
     except ValueError as e:
         logger.critical(e)
     # Finish the process nicely
@@ -0,0 +1,550 @@
+#!/usr/bin/env python3
+import argparse
+import autotune
+import itertools
+import json
+import logging
+import nlg
+import nlp_utils
+import os
+import protocol
+import threading
+import time
+import tracing
+from collections import OrderedDict
+from multiprocessing.connection import Client, Listener
+
+# Where the daemon listens unless told otherwise
+DEFAULT_ADDRESS = os.path.join('~', '.cache', 'radiobot', 'nlg.sock')
+
+
+def parse_address(address):
+    """ Turns an address given in the command line into one that
+    `multiprocessing.connection` understands.
+
+    Parameters
+    ----------
+    address : str
+        Either 'host:port' for a TCP socket or the path of a Unix socket.
+
+    Returns
+    -------
+    tuple or str
+        (host, port) for TCP, or the expanded path for a Unix socket.
+    """
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        return host, int(port)
+    return os.path.expanduser(address)
+
+
+def connect(address, name, username="User"):
+    """ Connects to a running daemon.
+
+    Parameters
+    ----------
+    address : str
+        Address of the daemon. See `parse_address`.
+    name : str
+        Name of the client, only used in the logs of the daemon.
+    username : str
+        Name of the user that the AI is talking to.
+
+    Returns
+    -------
+    multiprocessing.connection.Connection
+        Connection that speaks the same protocol as the pipe given to
+        `nlg.run_nlg_server`, so it can be used in its place. The `Ready`
+        message arrives as soon as the daemon has registered the client.
+    """
+    conn = Client(parse_address(address))
+    conn.send(protocol.Hello(name, username))
+    return conn
+
+
+class Session:
+    """ A program connected to the daemon.
+
+    Parameters
+    ----------
+    conn : multiprocessing.connection.Connection
+        Connection to the program.
+    name : str
+        Name that the program gave itself.
+    username : str
+        Name of the user that the program's AI talks to.
+    """
+    def __init__(self, conn, name, username):
+        self.conn = conn
+        self.name = name
+        self.username = username
+        self.prefix_stats = nlg.PrefixStats()
+        # Time at which the last prompt of the session was answered, so
+        # sessions with the same priority take turns
+        self.last_served = 0.0
+        # Whether a slot is handling a message of the session, the request
+        # being generated and whether it was cancelled
+        self.busy = False
+        self.active = None
+        self.cancelled = False
+        self.closed = False
+        self._send_lock = threading.Lock()
+        # Latency of the replies, for the logs
+        self.replies = 0
+        self.wait_seconds = 0.0
+        self.first_token_seconds = 0.0
+        self.tokens = 0
+
+    def send(self, message):
+        """ Sends a message to the program, unless it already left. """
+        with self._send_lock:
+            if self.closed:
+                return
+            try:
+                self.conn.send(message)
+            except OSError:
+                self.closed = True
+
+    def close(self):
+        """ Closes the connection. Nothing is sent to the program after
+        this, and the reply being generated for it stops. """
+        with self._send_lock:
+            self.closed = True
+            self.conn.close()
+
+    def summary(self):
+        """ Returns the latency of the replies so far as a dictionary. """
+        replies = max(self.replies, 1)
+        return {'replies': self.replies,
+                'mean_wait_seconds': self.wait_seconds / replies,
+                'mean_first_token_seconds':
+                    self.first_token_seconds / replies,
+                'tokens': self.tokens}
+
+
+class _SessionWatcher:
+    """ Stops a reply once its session cancels it or goes away. Works like
+    `nlg.CancelWatcher`, but the messages are read by another thread. """
+    def __init__(self, session):
+        self.session = session
+        self.cancelled = False
+
+    def watch(self, pieces):
+        for piece in pieces:
+            yield piece
+            if self.session.cancelled or self.session.closed:
+                self.cancelled = True
+                return
+
+
+class Scheduler:
+    """ Prompts and prefills waiting for the model, from every session.
+
+    The next one is the one with the highest priority (see
+    `protocol.INTERACTIVE`). Among those, the session that was served the
+    longest time ago goes first, so a busy session can't starve the others,
+    and the messages of a single session with the same priority keep their
+    order. Prefills are as urgent as dialog, because they are only useful
+    before the prompt that follows them. A session is only served by one
+    slot at a time (see `Slot`), so its replies never overlap.
+
+    Notes
+    -----
+    Replies are never interrupted by a more urgent prompt, because the
+    model would lose the work done so far. An urgent prompt waits at most
+    for one reply, which is short (see `nlg.MAX_NEW_TOKENS`).
+    """
+    def __init__(self):
+        self._pending = []
+        self._arrivals = itertools.count()
+        self._changed = threading.Condition()
+
+    def put(self, session, message):
+        """ Adds a `protocol.Prompt` or a `protocol.Prefill` to the queue. """
+        priority = getattr(message, 'priority', protocol.INTERACTIVE)
+        with self._changed:
+            if isinstance(message, protocol.Prompt):
+                # A prefill that didn't start yet would only delay the
+                # prompt it was meant for
+                self._pending = [item for item in self._pending
+                                 if item[2] is not session or
+                                 not isinstance(item[3], protocol.Prefill)]
+            self._pending.append((priority, next(self._arrivals), session,
+                                  message, time.time()))
+            self._changed.notify_all()
+
+    def get(self):
+        """ Waits for the next message to handle.
+
+        Returns
+        -------
+        (Session, namedtuple, float)
+            The session, its message and the time at which it arrived.
+        """
+        with self._changed:
+            while True:
+                ready = [item for item in self._pending
+                         if not item[2].busy]
+                if len(ready) > 0:
+                    break
+                self._changed.wait()
+            item = min(ready, key=lambda item: (item[0], item[2].last_served,
+                                                item[1]))
+            self._pending.remove(item)
+            session, message, arrival = item[2:]
+            session.busy = True
+            session.active = getattr(message, 'request', None)
+            session.cancelled = False
+            return session, message, arrival
+
+    def done(self, session):
+        """ Marks the message returned by `get` as handled. """
+        with self._changed:
+            session.busy = False
+            session.active = None
+            session.last_served = time.time()
+            self._changed.notify_all()
+
+    def cancel(self, session, request):
+        """ Cancels a request of a session.
+
+        Returns
+        -------
+        bool
+            True if the request was still waiting, so its reply must be
+            sent by the caller. False if it is being generated (and will
+            stop after the current token) or was already answered.
+        """
+        with self._changed:
+            for item in self._pending:
+                if item[2] is session and \
+                        getattr(item[3], 'request', None) == request:
+                    self._pending.remove(item)
+                    return True
+            if session.active == request:
+                session.cancelled = True
+            return False
+
+    def drop(self, session):
+        """ Forgets every message of a session that went away. """
+        with self._changed:
+            self._pending = [item for item in self._pending
+                             if item[2] is not session]
+
+
+class SessionStates:
+    """ Keeps the state of the model for the sessions that were served last,
+    so every session goes on where it left off instead of evaluating its
+    prompt from scratch after another session used the model.
+
+    Parameters
+    ----------
+    llm : Llama
+        Language model shared by the sessions.
+    max_states : int
+        Number of states kept in memory. Every state is as large as the
+        context of the model. Sessions whose state was dropped fall back to
+        the snapshots of the `StateCache`.
+    """
+    def __init__(self, llm, max_states=4):
+        self.llm = llm
+        self.max_states = max_states
+        self.current = None
+        self._states = OrderedDict()
+
+    def switch(self, session, tokens=None):
+        """ Gets the model ready for a session.
+
+        Parameters
+        ----------
+        session : Session
+            Session that is about to use the model.
+        tokens : list(int)
+            Tokens of the text that the session is about to evaluate, if
+            known. Saving and restoring states is skipped when the state of
+            the model is already as good for it.
+        """
+        if session is self.current:
+            return
+        for closed in [s for s in self._states if s.closed]:
+            del self._states[closed]
+        live = list(self.llm.eval_tokens)
+        shared = _common_prefix(live, tokens) if tokens is not None else 0
+        # The last token of a text is always evaluated again, so the context
+        # is only kept whole if the text goes beyond it
+        keeps_context = len(live) > 0 and shared == len(live) and \
+            len(tokens) > shared
+        # Saving copies the whole context, so it is only done if the
+        # session that leaves may come back and would lose its context
+        if self.current is not None and not self.current.closed and \
+                not self.current.cancelled and self.max_states > 0 and \
+                not keeps_context:
+            self._states[self.current] = self.llm.save_state()
+            self._states.move_to_end(self.current)
+            while len(self._states) > self.max_states:
+                self._states.popitem(last=False)
+        if session in self._states:
+            state = self._states.pop(session)
+            if tokens is None or \
+                    _common_prefix(state.eval_tokens, tokens) > shared:
+                self.llm.load_state(state)
+        self.current = session
+
+    def drop(self, session):
+        """ Forgets the state of a session that went away. """
+        self._states.pop(session, None)
+        if session is self.current:
+            self.current = None
+
+
+def _common_prefix(old_tokens, new_tokens):
+    """ Returns the length of the common prefix of two lists of tokens. """
+    common = 0
+    for old, new in zip(old_tokens, new_tokens):
+        if old != new:
+            break
+        common += 1
+    return common
+
+
+def _serve(conn, scheduler, load_seconds):
+    """ Reads the messages of a single program until it leaves. It is meant
+    to run in its own thread. """
+    logger = logging.getLogger('radiobot')
+    try:
+        hello = conn.recv()
+    except (EOFError, OSError):
+        return
+    if not isinstance(hello, protocol.Hello):
+        logger.warning(f"Unexpected first message: {hello}")
+        conn.close()
+        return
+    session = Session(conn, hello.name, hello.username)
+    logger.info(f"Session '{session.name}' connected")
+    session.send(protocol.Ready(load_seconds))
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+        if isinstance(message, protocol.Quit):
+            break
+        elif isinstance(message, protocol.Cancel):
+            if scheduler.cancel(session, message.request):
+                session.send(protocol.Done('', message.request, True))
+        elif isinstance(message, (protocol.Prompt, protocol.Prefill)):
+            scheduler.put(session, message)
+    # A reply being generated stops after the current token
+    scheduler.drop(session)
+    session.close()
+    logger.info(f"Session '{session.name}' disconnected. "
+                f"Latency: {session.summary()}. "
+                f"Prefix reuse: {session.prefix_stats.summary()}")
+
+
+def _accept(listener, scheduler, load_seconds):
+    """ Accepts new programs until the listener is closed. """
+    while True:
+        try:
+            conn = listener.accept()
+        except OSError:
+            break
+        threading.Thread(target=_serve, args=(conn, scheduler, load_seconds),
+                         daemon=True).start()
+
+
+class Throughput:
+    """ Tokens generated by every slot, to measure the throughput of the
+    whole daemon. """
+    def __init__(self):
+        self.tokens = 0
+        self.replies = 0
+        self._lock = threading.Lock()
+
+    def add(self, tokens):
+        with self._lock:
+            self.tokens += tokens
+            self.replies += 1
+
+
+class Slot:
+    """ A context of the language model that answers one prompt at a time.
+
+    Every slot has its own copy of the context and of the state of the
+    sessions it served last, but the weights are mapped from the same file,
+    so they are in memory only once.
+
+    Parameters
+    ----------
+    number : int
+        Number of the slot, for the logs and the trace.
+    llm : Llama
+        Language model of the slot.
+    state_cache : StateCache
+        Snapshots of the persona prefixes for `llm`.
+    max_states : int
+        Number of sessions whose state the slot keeps. See `SessionStates`.
+    """
+    def __init__(self, number, llm, state_cache, max_states=4):
+        self.number = number
+        self.llm = llm
+        self.state_cache = state_cache
+        self.states = SessionStates(llm, max_states)
+
+    def run(self, scheduler, throughput):
+        """ Answers the messages of the scheduler forever. It is meant to
+        run in its own thread. """
+        while True:
+            session, message, arrival = scheduler.get()
+            start = time.time()
+            # llama-cpp-python adds a space before the prompt
+            self.states.switch(session, self.llm.tokenize(
+                b' ' + message.text.encode('utf-8')))
+            if isinstance(message, protocol.Prefill):
+                nlg.prefill(self.llm, self.state_cache, session.prefix_stats,
+                            message.text)
+            else:
+                tracing.record('queue', arrival, start, message.request,
+                               session=session.name, slot=self.number)
+                nlg.answer(self.llm, self.state_cache, session.prefix_stats,
+                           message, session.send, _SessionWatcher(session),
+                           session.username, True, arrival)
+                stats = session.prefix_stats
+                first_token = stats.first_token_time or time.time()
+                session.replies += 1
+                session.wait_seconds += start - arrival
+                session.first_token_seconds += first_token - arrival
+                session.tokens += stats.generated_pieces
+                throughput.add(stats.generated_pieces)
+            if session.closed:
+                self.states.drop(session)
+            scheduler.done(session)
+
+
+def run_daemon(llm_path, address, json_config, max_states=4, seed=0,
+               n_threads=None, slots=1, report_seconds=60):
+    """ Serves a single language model to every program that connects.
+
+    Parameters
+    ----------
+    llm_path : str
+        Path to the language model.
+    address : str
+        Where to listen. See `parse_address`.
+    json_config : dict
+        Dictionary with general configuration options for the system. The
+        prefixes of its personas are snapshotted (see `StateCache`).
+    max_states : int
+        Number of sessions whose model state is kept in memory by every
+        slot. See `SessionStates`.
+    seed : int
+        Seed for the sampling of the language model.
+    n_threads : int
+        Number of threads used by the language model, split between the
+        slots. If None, the ones in the tuned profile (see `autotune`) or
+        all the cores are used.
+    slots : int
+        Number of prompts answered at the same time. See `Slot`.
+    report_seconds : float
+        How often the throughput of the daemon is logged.
+
+    Notes
+    -----
+    Programs connect with `connect`, and then use the same messages as with
+    `nlg.run_nlg_server`. A `Quit` message only closes the session of that
+    program. The daemon runs until it is interrupted with Ctrl-C.
+
+    With a single slot, the prompts are answered one after the other using
+    all the threads. With several slots, the prompts of different sessions
+    are decoded at the same time, each with its share of the threads. A
+    single reply is then slower, but the tokens per second of the whole
+    daemon are higher, because one stream doesn't scale to many cores.
+    """
+    logger = logging.getLogger('radiobot')
+    load_start = time.time()
+    prefixes = list(nlp_utils.persona_prefixes(json_config).values())
+    profile = autotune.load_profile(json_config, llm_path)
+    if slots > 1 and not profile.get('use_mmap', True):
+        # Without memory-mapping every slot would load its own copy of the
+        # weights
+        logging.getLogger('radiobot').warning(
+            "Memory-mapping the weights, because they are shared by "
+            "several slots")
+        profile['use_mmap'] = True
+    threads = n_threads or profile.get('n_threads') or os.cpu_count()
+    slot_threads = max(1, threads // slots)
+    # The weights are memory-mapped, so every slot shares them
+    all_slots = [Slot(number, *nlg.load_model(llm_path, prefixes, seed,
+                                              slot_threads, profile),
+                      max_states)
+                 for number in range(slots)]
+    load_seconds = time.time() - load_start
+    tracing.record('load', load_start, time.time())
+    address = parse_address(address)
+    if isinstance(address, str):
+        os.makedirs(os.path.dirname(address), exist_ok=True)
+        if os.path.exists(address):
+            # Left behind by a daemon that didn't finish nicely
+            os.unlink(address)
+    listener = Listener(address)
+    if isinstance(address, str):
+        os.chmod(address, 0o600)
+    scheduler = Scheduler()
+    throughput = Throughput()
+    for slot in all_slots:
+        threading.Thread(target=slot.run, args=(scheduler, throughput),
+                         daemon=True).start()
+    threading.Thread(target=_accept, args=(listener, scheduler, load_seconds),
+                     daemon=True).start()
+    logger.info(f"Model loaded in {load_seconds:.1f}s with {slots} slots of "
+                f"{slot_threads} threads, listening on {address}")
+    try:
+        last_tokens, last_time = 0, time.time()
+        while True:
+            time.sleep(report_seconds)
+            now = time.time()
+            if throughput.tokens > last_tokens:
+                logger.info(json.dumps({
+                    'replies': throughput.replies,
+                    'tokens_per_second':
+                        (throughput.tokens - last_tokens) / (now - last_time)
+                }))
+            last_tokens, last_time = throughput.tokens, now
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+
+
+if __name__ == '__main__':
+    """ Loads a language model once and shares it between several copies of
+    `radiobot.py` and `endless_gen.py` (see their `--nlg-server` flag).
+    """
+    logging.basicConfig()
+    logger = logging.getLogger('radiobot')
+    logger.setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser(
+        description='Shares a language model between several programs')
+    parser.add_argument('llm', help='LLM to use for speech generation')
+    parser.add_argument('-a', '--address', default=DEFAULT_ADDRESS,
+                        help='Unix socket or host:port to listen on')
+    parser.add_argument('--session-states', type=int, default=4,
+                        help='Sessions whose model state is kept in memory')
+    parser.add_argument('--threads', type=int,
+                        help='Threads used by the language model')
+    parser.add_argument('--slots', type=int, default=1,
+                        help='Prompts answered at the same time')
+    parser.add_argument('--trace',
+                        help='Write the latency of every stage to this file')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Log every prompt')
+    args = parser.parse_args()
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+
+    with open('config.json', 'r') as fp:
+        app_config = json.load(fp)
+    tracing.configure(args.trace)
+    run_daemon(args.llm, args.address, app_config, args.session_states,
+               n_threads=args.threads, slots=args.slots)
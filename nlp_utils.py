@@ -1,25 +1,189 @@
-import math
 import logging
+from collections import deque
 
+# Size of the context of the language model, and how much of it is reserved
+# for the reply. They are here rather than in `nlg` so that the prompts can
+# be built without loading llama.cpp.
+CONTEXT_TOKENS = 512
+MAX_NEW_TOKENS = 128
+# Tokens available for the prompt
+MAX_PROMPT_TOKENS = CONTEXT_TOKENS - MAX_NEW_TOKENS
 
-def best_idx(initial_prompt, conversation_log, desired_context, max_chars=1300):
-    """ Returns the index to use in a conversation log in order to keep
-    the maximum number of utterances possible from turn to turn.
-    See "Notes" for more details.
+
+def estimate_tokens(text):
+    """ Estimates the number of tokens in a text when no tokenizer is
+    available. It errs on the side of caution.
+
+    Parameters
+    ----------
+    text : str
+        Text to measure.
+
+    Returns
+    -------
+    int
+        Estimated number of tokens.
+    """
+    return len(text) // 3 + 1
+
+
+class PromptBuilder:
+    """ Assembles prompts from a context window, appending only the new
+    utterances to the previous prompt whenever possible.
+
+    Parameters
+    ----------
+    prefix : str
+        Text that comes before the conversation in every prompt.
+
+    Notes
+    -----
+    llama.cpp reuses the evaluation of the longest common prefix between
+    the new prompt and the previous one (including the text it generated).
+    To make the most of it, a prompt is the prefix followed by one segment
+    per utterance, and a segment never changes once it has been written.
+    Prompts end right before the space that starts the reply, because the
+    model generates that space as part of its first token. This way the next
+    prompt is byte-for-byte the previous prompt plus the generated reply.
+
+    The builder counts how many prompts could be built by appending to the
+    previous one. See also `nlg.PrefixStats` for the savings as measured by
+    the LLM.
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        # The last prompt, plus the window it was built from
+        self._text = prefix
+        self._start = 0
+        self._end = 0
+        self.prompts = 0
+        self.appended = 0
+
+    def segment(self, position, utterance):
+        """ Returns the text of an utterance in the prompt.
+
+        Parameters
+        ----------
+        position : int
+            Position of the utterance within the window.
+        utterance : str
+            The utterance.
+
+        Returns
+        -------
+        str
+            Text to append to the prompt.
+        """
+        raise NotImplementedError
+
+    def render(self, window):
+        """ Returns the prompt for a context window.
+
+        Parameters
+        ----------
+        window : ContextWindow
+            Conversation to build the prompt from.
+
+        Returns
+        -------
+        str
+            The prompt.
+        """
+        self.prompts += 1
+        if window.start == self._start and self._end <= len(window):
+            # The window didn't move, so the previous prompt is still valid
+            self.appended += 1
+        else:
+            self._text = self.prefix
+            self._start = window.start
+            self._end = window.start
+        for idx in range(self._end, len(window)):
+            self._text += self.segment(idx - window.start, window[idx])
+        self._end = len(window)
+        return self._text
+
+    def reuse_rate(self):
+        """ Returns the fraction of prompts that extended the previous one.
+
+        Returns
+        -------
+        float
+            Number between 0 and 1.
+        """
+        return self.appended / max(self.prompts, 1)
+
+
+class DialogPrompt(PromptBuilder):
+    """ Prompts in the Llama-2 chat format.
 
     Parameters
     ----------
     initial_prompt : str
-        Prompt for the overall dialogue
-    conversation_log : list(str)
-        Log of all utterances in the program's history.
+        Text used at the beginning of the prompt, right before the dialog.
+    username : str
+        Name of the user that the AI is talking to.
+    """
+    def __init__(self, initial_prompt, username="User"):
+        super().__init__("<s>[INST] <<SYS>> " +
+                         initial_prompt.format(username=username) +
+                         " <</SYS>> ")
+
+    def segment(self, position, utterance):
+        # The user turns are the even ones, while the odd ones are from the
+        # computer
+        if position % 2 == 1:
+            return f" {utterance} </s>"
+        elif position == 0:
+            return f"{utterance} [/INST]"
+        else:
+            return f" <s>[INST] {utterance} [/INST]"
+
+    def render(self, window):
+        assert len(window) % 2 == 1, \
+            "The conversation should start and end with the user"
+        return super().render(window)
+
+
+class MonologuePrompt(PromptBuilder):
+    """ Prompts for a monologue, where every line starts with "I:".
+
+    Parameters
+    ----------
+    initial_prompt : str
+        Text used at the beginning of the prompt, right before the speech.
+    username : str
+        Name of the user that the AI is talking to.
+    """
+    def __init__(self, initial_prompt, username="User"):
+        super().__init__(initial_prompt.format(username=username) + "\nI:")
+
+    def segment(self, position, utterance):
+        return f" {utterance}\nI:"
+
+
+class ContextWindow:
+    """ Conversation plus the window of it that is used in the prompt.
+
+    Parameters
+    ----------
+    builder : PromptBuilder
+        Builder for the prompts made from this window.
+    count_tokens : function
+        Function that returns the number of tokens in a text.
+    max_tokens : int
+        Maximum number of tokens for the prompt, including the prefix.
     desired_context : int
         Ideal desired length for a prompt. Once this number of utterances have
-        been reached, the pointer will be moved forward.
-    max_chars : int
-        Maximum number of characters supported by the LLM. Note that the LLM
-        uses tokens instead of characters, so this measure is just an
-        approximation.
+        been reached, the window will be moved forward.
+    keep : int
+        Number of utterances that are kept when the window moves forward.
+    align : int
+        The window always starts at a multiple of this number. In a dialog
+        this ensures that the window begins with the user.
+    turn_overhead : int
+        Number of tokens used to format each utterance in the prompt.
+    log : conversation_log.ConversationLog
+        If given, every utterance is also appended to this log on disk.
 
     Notes
     -----
@@ -27,101 +191,290 @@ def best_idx(initial_prompt, conversation_log, desired_context, max_chars=1300):
     context unaltered, as this will save computation and generate faster.
     Given that there is a maximum number of tokens, we would like to keep the
     context as long as possible.
-    This algorithm takes a conversation log and returns the index of the first
-    utterance to use. This index is "sticky" in the sense that it will always
-    remain the same except in two situation: either when the number of
-    utterances reaches the desired context, or when the number of characters
-    exceeds max_chars. When that happens we move the window forward, keeping
-    only the last two utterances as context.
+    The start of the window is therefore "sticky": it remains the same except
+    in two situations, either when the number of utterances reaches the
+    desired context or when the prompt would not fit in `max_tokens`. When
+    that happens the window moves forward keeping only the last `keep`
+    utterances, or fewer if they still don't fit.
+
+    Token counts are computed once per utterance and the total is updated as
+    the window moves, so appending an utterance costs O(1) amortized time
+    regardless of the length of the conversation.
+
+    The window never moves back, so only the utterances in it are kept in
+    memory. Indices and `len` still count every utterance since the
+    beginning of the conversation, while iterating only goes through the
+    utterances in memory. The complete conversation can be kept on disk
+    instead (see `log`).
     """
-    word_accum = len(initial_prompt)
-    pointer_safe = 0
-    pointer_unsafe = 0
-
-    while pointer_unsafe < len(conversation_log):
-        new_words = len(conversation_log[pointer_unsafe])
-        if word_accum + new_words < max_chars:
-            if pointer_unsafe - pointer_safe == desired_context:
-                pointer_safe = pointer_unsafe - 2
-                word_accum = len(initial_prompt) + \
-                             len(conversation_log[pointer_unsafe]) + \
-                             len(conversation_log[pointer_unsafe-1])
-        else:
-            pointer_safe = pointer_unsafe - 2
-            word_accum = len(initial_prompt) + \
-                         len(conversation_log[pointer_unsafe]) + \
-                         len(conversation_log[pointer_unsafe - 1])
-        pointer_unsafe += 1
-    return pointer_safe
+    def __init__(self, builder, count_tokens, max_tokens, desired_context,
+                 keep=2, align=1, turn_overhead=0, log=None):
+        self.builder = builder
+        self.count_tokens = count_tokens
+        self.max_tokens = max_tokens
+        self.desired_context = desired_context
+        self.keep = keep
+        self.align = align
+        self.turn_overhead = turn_overhead
+        self.prefix_tokens = count_tokens(builder.prefix)
+        self.log = log
+        # Utterances in the window and their cached token counts, plus how
+        # many utterances came before them
+        self.utterances = deque()
+        self.counts = deque()
+        self.dropped = 0
+        # Index of the first utterance in the window, and the number of tokens
+        # in the prompt made from it
+        self.start = 0
+        self.total = self.prefix_tokens
+        # Whether the conversation continues one from a previous run
+        self.resumed = False
+
+    def __len__(self):
+        return self.dropped + len(self.utterances)
+
+    def __iter__(self):
+        return iter(self.utterances)
+
+    def __getitem__(self, idx):
+        if idx < self.dropped:
+            raise IndexError(f"Utterance {idx} is no longer in memory")
+        return self.utterances[idx - self.dropped]
+
+    def _drop_until(self, new_start):
+        """ Moves the start of the window forward, forgetting everything
+        before it. """
+        new_start -= new_start % self.align
+        new_start = max(new_start, self.start)
+        for _ in range(new_start - self.start):
+            self.utterances.popleft()
+            self.total -= self.counts.popleft()
+        self.dropped = self.start = new_start
+
+    def append(self, utterance):
+        """ Adds an utterance to the log, moving the window if needed.
+
+        Parameters
+        ----------
+        utterance : str
+            New utterance.
+        """
+        if self.log is not None:
+            self.log.append(len(self), utterance)
+        self._add(utterance)
+
+    def _add(self, utterance):
+        """ Adds an utterance to the window, moving it if needed. """
+        tokens = self.count_tokens(utterance) + self.turn_overhead
+        self.utterances.append(utterance)
+        self.counts.append(tokens)
+        self.total += tokens
+        if len(self) - self.start > self.desired_context or \
+                self.total > self.max_tokens:
+            self._drop_until(len(self) - self.keep)
+            # Even the last few utterances could be too long
+            while self.total > self.max_tokens and \
+                    self.start + self.align < len(self):
+                self._drop_until(self.start + self.align)
+            if self.total > self.max_tokens:
+                logging.getLogger('radiobot').warning(
+                    f"Utterance too long for the prompt: {tokens} tokens")
+
+    def extend(self, utterances):
+        """ Adds several utterances to the log.
+
+        Parameters
+        ----------
+        utterances : list(str)
+            New utterances, in order.
+        """
+        for utterance in utterances:
+            self.append(utterance)
+
+    def resume(self):
+        """ Continues the last conversation in the log instead of starting a
+        new one. Only the end of the log is read.
+
+        Returns
+        -------
+        bool
+            True if there was a conversation to continue. Otherwise the
+            window is left untouched.
+        """
+        if self.log is None:
+            return False
+        session, turns = self.log.last_session(self.desired_context +
+                                               self.align)
+        # The window must start and end at the same point of a turn as
+        # usual, so an unanswered utterance at the end is left out
+        while len(turns) > 0 and turns[0][0] % self.align != 0:
+            turns.pop(0)
+        while len(turns) > 0 and (turns[-1][0] + 1) % self.align != 0:
+            turns.pop()
+        if len(turns) == 0:
+            return False
+        self.log.start_session(session)
+        self.dropped = self.start = turns[0][0]
+        for _, utterance in turns:
+            self._add(utterance)
+        self.resumed = True
+        return True
+
+    def turns(self):
+        """ Returns the utterances in the window.
+
+        Returns
+        -------
+        list(str)
+            Utterances that should be used in the prompt, in order.
+        """
+        return list(self.utterances)
+
+    def prefix(self):
+        """ Returns the text that the prompt will start with once the next
+        utterance is appended, as far as it can be known in advance.
 
+        Returns
+        -------
+        str
+            The prefix of the prompt plus the utterances that will remain in
+            the window. It can be wrong if the next utterance is so long that
+            the window needs to move further.
+        """
+        start = self.start
+        if len(self) + 1 - start > self.desired_context:
+            # Same as `_drop_until`
+            new_start = len(self) + 1 - self.keep
+            start = max(new_start - new_start % self.align, start)
+        return self.builder.prefix + ''.join(
+            self.builder.segment(idx - start, self[idx])
+            for idx in range(start, len(self)))
 
-def build_reply_prompt(initial_prompt, conversation_log, context_turns=5, username="User"):
-    """ Generates an LLM reply for a given conversation. The conversation
-    should be structured such that it is now the LLM's turn.
+    def prompt(self):
+        """ Builds the prompt for the LLM to continue the conversation.
+
+        Returns
+        -------
+        str
+            Prompt made from the utterances in the window.
+        """
+        prompt = self.builder.render(self)
+        logging.getLogger('radiobot').debug(
+            f"Current idx: {self.start}/{len(self)} - {self.total} tokens, "
+            f"{100*self.builder.reuse_rate():.0f}% of prompts appended")
+        return prompt
+
+
+def dialog_window(json_config, count_tokens=estimate_tokens,
+                  max_tokens=MAX_PROMPT_TOKENS, context_turns=5, log=None,
+                  resume=False):
+    """ Creates the context window for dialog mode, already containing the
+    dialog seed.
 
     Parameters
     ----------
-    initial_prompt : str
-        Text used at the beginning of the prompt, right before the dialog.
-    conversation_log : list(str)
-        List of utterances in this dialog, switching between the text between
-        the user and the AI. The user always goes first and last.
+    json_config : dict()
+        Dictionary with general configuration options for the system.
+    count_tokens : function
+        Function that returns the number of tokens in a text.
+    max_tokens : int
+        Maximum number of tokens for the prompt.
     context_turns : int
         How many turns to use in the prompt for context. One turn consists of
         one utterance for the User and one for the AI.
-    username : str
-        Name of the user that the AI is talking to.
+    log : conversation_log.ConversationLog
+        Log on disk where the conversation is stored.
+    resume : bool
+        If True, the last conversation in `log` is continued instead of
+        starting with the seed. See `ContextWindow.resume`.
 
     Returns
     -------
-    str
-        An utterance that the AI generates in response to the given dialog.
+    ContextWindow
+        The new window.
     """
-    assert len(conversation_log) % 2 == 1, \
-        "The conversation should start and end with the user"
-    idx = best_idx(prompt, conversation_log, 2*context_turns, max_chars=1280)
-    # The user turns are the even ones, while the odd ones are from the computer
-    prompt = ""
-    user_turns = [conversation_log[::2]
-    response_turns = [conversation_log[1::2]
-    for user, resp in zip(user_turns, response_turns):
-        if prompt == "":
-            prompt = "<s>[INST] <<SYS>> " + 
-                     initial_prompt.format(username=username) + " <</SYS>> " +
-                     user + " [/INST] " + answer + " </s>"
-        else:
-            prompt += " <s>[INST] {} [/INST] {} </s>".format(user, resp)
-    prompt += "<s>[INST] " + conversation_log[-1] + " [/INST]"
-    return prompt
+    builder = DialogPrompt(json_config['dialog_prompt'],
+                           json_config['username'])
+    overhead = count_tokens(builder.segment(2, '') +
+                            builder.segment(3, '')) // 2 + 1
+    window = ContextWindow(builder, count_tokens, max_tokens,
+                           2*context_turns, keep=2, align=2,
+                           turn_overhead=overhead, log=log)
+    _start(window, json_config['dialog_seed'], resume)
+    return window
 
 
-def broadcast_prompt(initial_prompt, speech_log, context_turns=10, username="User"):
-    """ Generates an LLM reply for a given broadcast.
+def monologue_window(json_config, count_tokens=estimate_tokens,
+                     max_tokens=MAX_PROMPT_TOKENS, context_turns=10, log=None,
+                     resume=False):
+    """ Creates the context window for radio mode, already containing the
+    monologue seed.
 
     Parameters
     ----------
-    llm : Llama()
-        Language model used to generate the responses
-    initial_prompt : str
-        Text used at the beginning of the prompt, right before the speech.
-    speech_log : list(str)
-        List of utterances in this dialog so far.
+    json_config : dict()
+        Dictionary with general configuration options for the system.
+    count_tokens : function
+        Function that returns the number of tokens in a text.
+    max_tokens : int
+        Maximum number of tokens for the prompt.
     context_turns : int
         How many turns to use in the prompt for context. One turn consists
         of roughly one sentence of the AI.
-    username : str
-        Name of the user that the AI is talking to.
+    log : conversation_log.ConversationLog
+        Log on disk where the monologue is stored.
+    resume : bool
+        If True, the last monologue in `log` is continued instead of
+        starting with the seed. See `ContextWindow.resume`.
+
+    Returns
+    -------
+    ContextWindow
+        The new window.
+    """
+    builder = MonologuePrompt(json_config['monologue_prompt'],
+                              json_config['username'])
+    overhead = count_tokens(builder.segment(1, ''))
+    window = ContextWindow(builder, count_tokens, max_tokens,
+                           context_turns, keep=2, align=1,
+                           turn_overhead=overhead, log=log)
+    _start(window, json_config['monologue_seed'], resume)
+    return window
+
+
+def _start(window, seed, resume):
+    """ Fills a new window with the seed, unless it resumes a previous
+    conversation. """
+    if resume and window.resume():
+        return
+    if window.log is not None:
+        window.log.start_session()
+    window.extend(seed)
+
+
+def persona_prefixes(json_config):
+    """ Returns the text that the first prompt of every mode starts with.
+
+    Parameters
+    ----------
+    json_config : dict()
+        Dictionary with general configuration options for the system.
 
     Returns
     -------
-    str
-        An utterance that the AI generates in response to the given speech
-        history.
+    dict
+        The prefixes for the 'dialog' and 'monologue' modes, including the
+        persona prompt and the seed utterances.
     """
-    prompt = initial_prompt.format(username=username) + "\n"
-    idx = best_idx(prompt, speech_log, context_turns, max_chars=1300)
-    for utterance in speech_log[idx:]:
-        prompt += f"I: {utterance}\n"
-    prompt += "I: "
-    print(f"Current idx: {idx}/{len(speech_log)} - {len(prompt)} chars")
-    return prompt
+    prefixes = dict()
+    for mode, builder, seed in [
+            ('dialog', DialogPrompt(json_config['dialog_prompt'],
+                                    json_config['username']),
+             json_config['dialog_seed']),
+            ('monologue', MonologuePrompt(json_config['monologue_prompt'],
+                                          json_config['username']),
+             json_config['monologue_seed'])]:
+        prefixes[mode] = builder.prefix + ''.join(
+            builder.segment(idx, utterance)
+            for idx, utterance in enumerate(seed))
+    return prefixes
@@ -0,0 +1,169 @@
+import numpy
+import queue
+import signal
+import soundfile as sf
+import threading
+import tts
+from multiprocessing import Process, Queue
+
+# Seconds between checks that the workers are still alive
+_POLL_SECONDS = 1.0
+
+
+def _run_tts_worker(tts_config, tasks, results):
+    """ Synthesizes lines until it receives None.
+
+    Parameters
+    ----------
+    tts_config : dict
+        The `tts` block of the configuration file.
+    tasks : multiprocessing.Queue
+        Queue of (index, text) to synthesize.
+    results : multiprocessing.Queue
+        Queue where the (index, pcm, sample_rate, channels) of every line
+        are put.
+    """
+    # Ctrl-C is handled by whoever owns the renderer
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    voice = tts.load_voice(tts_config)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        idx, text = task
+        results.put((idx,) + tts.synthesize(voice, text))
+
+
+class AudioRenderer:
+    """ Renders a monologue into a single audio file, synthesizing its lines
+    in parallel.
+
+    Parameters
+    ----------
+    filename : str
+        Output file. The format depends on the extension, for instance
+        '.ogg' or '.wav'.
+    tts_config : dict
+        The `tts` block of the configuration file.
+    workers : int
+        Number of processes synthesizing speech.
+    pause : float
+        Silence between lines, in seconds.
+
+    Notes
+    -----
+    Lines are written in the order in which they were added, no matter which
+    worker finishes first. Only a few lines per worker can be waiting to be
+    synthesized, so `add` blocks when the generation of text goes faster
+    than the synthesis.
+
+    If a worker dies (for instance, because the voice can't be loaded or
+    the machine runs out of memory), the lines stop being written and the
+    next call to `add` or `close` raises a RuntimeError.
+    """
+    def __init__(self, filename, tts_config, workers=2, pause=1.0):
+        self.sample_rate = tts.mixer_settings(tts_config)['frequency']
+        self._file = sf.SoundFile(filename, 'w', samplerate=self.sample_rate,
+                                  channels=1)
+        self._silence = numpy.zeros((int(pause * self.sample_rate), 1),
+                                    dtype=numpy.int16)
+        self._tasks = Queue(maxsize=2 * workers)
+        self._results = Queue()
+        self._workers = [Process(target=_run_tts_worker,
+                                 args=(tts_config, self._tasks,
+                                       self._results))
+                         for _ in range(workers)]
+        for worker in self._workers:
+            worker.start()
+        self._added = 0
+        self.seconds = 0.0
+        self.error = None
+        self._writer = threading.Thread(target=self._write)
+        self._writer.start()
+
+    def add(self, text):
+        """ Adds a line to the end of the audio.
+
+        Parameters
+        ----------
+        text : str
+            Line to synthesize.
+        """
+        self._put((self._added, text))
+        self._added += 1
+
+    def _put(self, task):
+        """ Queues a task for the workers, unless one of them died. """
+        while self.error is None:
+            try:
+                self._tasks.put(task, timeout=_POLL_SECONDS)
+                return
+            except queue.Full:
+                pass
+        raise self.error
+
+    def _check_workers(self):
+        """ Sets `error` if a worker died.
+
+        Returns
+        -------
+        bool
+            True if a worker died.
+        """
+        failed = [worker for worker in self._workers
+                  if worker.exitcode not in (None, 0)]
+        if len(failed) > 0 and self.error is None:
+            self.error = RuntimeError(
+                f"A speech synthesis worker exited with code "
+                f"{failed[0].exitcode}, some lines are missing")
+            # Nobody may read the lines that are still queued, and they
+            # must not keep the program from exiting
+            self._tasks.cancel_join_thread()
+        return len(failed) > 0
+
+    def _write(self):
+        """ Writes the synthesized lines to the file, in order. """
+        waiting = dict()
+        next_idx = 0
+        while True:
+            try:
+                result = self._results.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                # The line of a worker that died would never arrive
+                if self._check_workers():
+                    break
+                continue
+            if result is None:
+                break
+            waiting[result[0]] = result[1:]
+            while next_idx in waiting:
+                samples = tts.convert(*waiting.pop(next_idx),
+                                      self.sample_rate, 1)
+                self._file.write(samples)
+                self._file.write(self._silence)
+                self.seconds += (len(samples) + len(self._silence)) / \
+                    self.sample_rate
+                next_idx += 1
+            # Make the audio available to whoever is streaming the file
+            self._file.flush()
+
+    def close(self):
+        """ Waits until every line has been written and closes the file.
+        Raises a RuntimeError if a worker died. """
+        try:
+            for _ in self._workers:
+                self._put(None)
+            for worker in self._workers:
+                while worker.is_alive() and self.error is None:
+                    worker.join(_POLL_SECONDS)
+            self._check_workers()
+        finally:
+            self._results.put(None)
+            self._writer.join()
+            for worker in self._workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+            self._file.close()
+        if self.error is not None:
+            raise self.error
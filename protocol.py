@@ -0,0 +1,42 @@
+from collections import namedtuple
+
+# Messages exchanged with the LLM server (see `nlg.run_nlg_server`) through
+# its pipe. Every reply carries the request it belongs to, so the client can
+# recognize and drop the replies it is no longer waiting for.
+
+# Priorities of the prompts. A server shared by several programs (see
+# `nlg_daemon`) answers the prompts with a lower value first, so somebody
+# waiting for a reply is not stuck behind radio lines.
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# Client to server
+
+# Asks for a reply to a prompt. The request identifies the reply, and is
+# also used to correlate the trace spans (see `tracing.new_request`).
+Prompt = namedtuple('Prompt', ['text', 'request', 'priority'],
+                    defaults=(None, INTERACTIVE))
+# Asks the server to evaluate the text that the next prompt will start with,
+# so that less work remains once the prompt arrives. No reply is sent.
+Prefill = namedtuple('Prefill', ['text'])
+# Asks the server to stop generating the reply to a request. The reply ends
+# with a `Done` message right away. Cancelling a reply that is already done
+# has no effect.
+Cancel = namedtuple('Cancel', ['request'])
+# Closes the server, cancelling the reply being generated if there is one.
+# A shared server only closes the connection of the client.
+Quit = namedtuple('Quit', [])
+# First message to a shared server, naming the client (for the logs) and
+# the user that it talks to. The server replies with `Ready`.
+Hello = namedtuple('Hello', ['name', 'username'])
+
+# Server to client
+
+# The model is loaded and warmed up. Sent once, before anything else.
+Ready = namedtuple('Ready', ['seconds'])
+# A sentence or clause of a reply, as soon as it is generated.
+Chunk = namedtuple('Chunk', ['text', 'request'])
+# The end of a reply, with the complete text. Every prompt gets exactly one,
+# even if it was cancelled.
+Done = namedtuple('Done', ['text', 'request', 'cancelled'],
+                  defaults=(False,))
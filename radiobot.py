@@ -3,9 +3,13 @@ import argparse
 import control
 import json
 import logging
+import nlg_daemon
+import nlp_utils
 import os
 import pygame
 import sys
+import tracing
+import tts
 from multiprocessing import Pipe
 
 
@@ -22,12 +26,22 @@ if __name__ == '__main__':
     parser.add_argument('-t', '--no-gui',
                         action='store_true',
                         help='Use the console-ony interface.')
+    parser.add_argument('--trace',
+                        help='Write the latency of every stage to this file')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue the last dialog and monologue')
+    parser.add_argument('--nlg-server', nargs='?', metavar='ADDRESS',
+                        const=nlg_daemon.DEFAULT_ADDRESS,
+                        help='Use the LLM of a running nlg_daemon.py '
+                             'instead of loading it')
     args = parser.parse_args()
     logger.debug(args)
 
     # Read some general parameters
     with open('config.json', 'r') as fp:
         app_config = json.load(fp)
+    # Every process appends its spans to the same trace file
+    tracing.configure(args.trace)
 
     # Start the services
     # First, the speech-to-Text server
@@ -42,29 +56,59 @@ if __name__ == '__main__':
             sys.exit(0)
         else:
             speech_to_text.run_speech_server(speech_to_text_pipe[1],
-                                         device=args.mic_device)
+                                         device=args.mic_device,
+                                         vad_config=app_config.get('vad'))
     else:
         logger.debug(f'Speech-to-text: process {speech_pid}')
         llm_pipe = Pipe()
-        llm_pid = os.fork()
+        llm_pid = None
+        if args.nlg_server is not None:
+            # The model is already loaded by another process
+            llm_pipe = (nlg_daemon.connect(args.nlg_server, 'radiobot',
+                                           app_config['username']), None)
+        else:
+            llm_pid = os.fork()
         if llm_pid == 0:
             # LLM server
+            import autotune
             import nlg
+            prefixes = nlp_utils.persona_prefixes(app_config)
             nlg.run_nlg_server(args.llm, llm_pipe[1],
-                               username=app_config['username'])
+                               username=app_config['username'],
+                               prefixes=prefixes.values(),
+                               profile=autotune.load_profile(app_config,
+                                                             args.llm))
         else:
             # Control and screen thread
-            logger.debug(f'LLM: process {llm_pid}')
+            logger.debug(f'LLM: process {llm_pid or args.nlg_server}')
+            # The text-to-speech server is forked before PyGame starts, so
+            # it doesn't inherit the mixer or the display
+            tts_pipe = Pipe()
+            tts_pid = os.fork()
+            if tts_pid == 0:
+                tts.run_tts_server(app_config, tts_pipe[1])
+                sys.exit(0)
+            logger.debug(f'Text-to-speech: process {tts_pid}')
 
-            # Set up the screen if needed
+            # Set up the screen if needed. The mixer uses the same format
+            # as the voice, so speech can be played without conversions.
+            pygame.mixer.pre_init(**tts.mixer_settings(app_config['tts']))
             pygame.init()
             if args.no_gui:
                 print("Display disabled")
             else:
                 print("Using PyGame for display")
+            # The prompts are measured with the tokenizer of the LLM, so
+            # they always fit in its context
+            import nlg
+            count_tokens = nlg.token_counter(args.llm)
             control.run_main_loop(llm_pipe[0], speech_to_text_pipe[0],
-                                  app_config, not args.no_gui)
+                                  tts_pipe[0], app_config, not args.no_gui,
+                                  count_tokens=count_tokens,
+                                  resume=args.resume)
             # Wait for the subprocesses to finish
             os.waitpid(speech_pid, 0)
-            os.waitpid(llm_pid, 0)
+            if llm_pid is not None:
+                os.waitpid(llm_pid, 0)
+            os.waitpid(tts_pid, 0)
             sys.exit(0)
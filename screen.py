@@ -0,0 +1,234 @@
+import math
+import numpy
+import pygame
+import random
+import time
+from collections import deque
+from pygame.mixer import music
+
+# Where every piece of the radio goes on the screen
+NEEDLE_CENTER = (377, 200)
+NEEDLE_RADIUS = 50
+NEEDLE_SUPPORT_POS = (365, 194)
+WHITE_BUTTON_POS = (344, 239)
+RED_BUTTON_POS = (386, 239)
+MIC_POS = (-5, 107)
+# Range of the needle, in radians
+MIN_ANGLE = math.pi / 4.0
+MAX_ANGLE = 3.0 * math.pi / 4.0
+# RMS level (relative to full scale) that moves the needle all the way
+FULL_SCALE_LEVEL = 0.2
+# Time (in seconds) it takes the needle to sweep the dial and back while the
+# radio is loading
+TUNING_PERIOD = 4.0
+
+
+class VoiceMeter:
+    """ Measures the level of the speech that the voice channel is playing.
+
+    Parameters
+    ----------
+    channel : pygame.mixer.Channel
+        Channel reserved for speech.
+    step : float
+        Length (in seconds) of the windows in which the level is measured.
+
+    Notes
+    -----
+    PyGame doesn't say how far into a sound a channel is, so the meter
+    assumes that a sound started playing the first time it sees it. Calling
+    `level` whenever a sound ends (see `control.VOICE_DONE`) keeps this
+    accurate.
+    """
+    def __init__(self, channel, step=0.05):
+        self.channel = channel
+        self.step = step
+        self._sound = None
+        self._start = 0
+        self._envelope = None
+
+    def level(self, now):
+        """ Returns the level of the speech being played.
+
+        Parameters
+        ----------
+        now : float
+            Current time.
+
+        Returns
+        -------
+        float or None
+            RMS level of the speech between 0 and 1, or None if the channel
+            is not playing anything.
+        """
+        sound = self.channel.get_sound() if self.channel.get_busy() else None
+        if sound is not self._sound:
+            self._sound = sound
+            self._start = now
+            self._envelope = None if sound is None else \
+                rms_envelope(sound, self.step)
+        if self._envelope is None or len(self._envelope) == 0:
+            return None
+        idx = int((now - self._start) / self.step)
+        return float(self._envelope[min(idx, len(self._envelope) - 1)])
+
+
+def rms_envelope(sound, step):
+    """ Computes the level of a sound over time.
+
+    Parameters
+    ----------
+    sound : pygame.mixer.Sound
+        Sound to measure. Its samples must be signed 16-bit.
+    step : float
+        Length (in seconds) of every window.
+
+    Returns
+    -------
+    numpy.ndarray
+        RMS level of every window, between 0 and 1.
+    """
+    rate, _, _ = pygame.mixer.get_init()
+    samples = pygame.sndarray.array(sound).astype(numpy.float32) / 32768.0
+    if samples.ndim > 1:
+        samples = samples.mean(axis=1)
+    window = max(1, int(rate * step))
+    frames = len(samples) // window
+    if frames == 0:
+        return numpy.zeros(0, dtype=numpy.float32)
+    samples = samples[:frames * window].reshape(frames, window)
+    return numpy.sqrt(numpy.mean(samples ** 2, axis=1))
+
+
+class RadioScreen:
+    """ Draws the radio on the screen, redrawing only the parts that change.
+
+    Parameters
+    ----------
+    window : pygame.Surface
+        Display where everything is drawn.
+    history_steps : int
+        Number of needle positions that are averaged. The larger this value,
+        the slower the needle will move.
+
+    Notes
+    -----
+    The images are converted to the format of the display once, and the
+    static part of the radio is kept in its own surface. Every frame only
+    redraws the area around the needle (plus the buttons, if they changed)
+    and hands that rectangle to `pygame.display.update`.
+    """
+    def __init__(self, window, history_steps=4):
+        self.images = dict()
+        self.images['red_button'] = pygame.image.load(
+            "./images/red_button_on.png").convert_alpha()
+        self.images['white_button'] = pygame.image.load(
+            "./images/white_button_on.png").convert_alpha()
+        self.images['needle_thingy'] = pygame.image.load(
+            "./images/needle_support.png").convert_alpha()
+        self.images['mic'] = pygame.image.load(
+            "./images/mic.png").convert_alpha()
+        self._bg = pygame.image.load("./images/background.png").convert()
+        self.needle_history = deque(maxlen=history_steps)
+        # Everything that can change on the screen
+        self._needle_rect = pygame.Rect(
+            NEEDLE_CENTER[0] - NEEDLE_RADIUS - 1,
+            NEEDLE_CENTER[1] - NEEDLE_RADIUS - 1,
+            2 * NEEDLE_RADIUS + 3, NEEDLE_RADIUS + 2).union(
+                self.images['needle_thingy'].get_rect(
+                    topleft=NEEDLE_SUPPORT_POS))
+        self._buttons_rect = self.images['white_button'].get_rect(
+            topleft=WHITE_BUTTON_POS).unionall([
+                self.images['red_button'].get_rect(topleft=RED_BUTTON_POS),
+                self.images['mic'].get_rect(topleft=MIC_POS)])
+        self.set_window(window)
+
+    def set_window(self, window):
+        """ Changes the display, for instance when switching to fullscreen.
+        The next frame redraws the whole screen.
+
+        Parameters
+        ----------
+        window : pygame.Surface
+            New display.
+        """
+        self.window = window
+        width, height = window.get_size()
+        bg_w, bg_h = self._bg.get_size()
+        self.background = pygame.Surface((width, height)).convert()
+        self.background.fill((0, 0, 0))
+        self.background.blit(self._bg, ((width - bg_w) / 2,
+                                        (height - bg_h) / 2))
+        self._mode = None
+
+    def _needle_angle(self, level, loading):
+        """ Returns the next position of the needle. """
+        if loading:
+            # The radio is looking for a station
+            phase = 2.0 * math.pi * time.time() / TUNING_PERIOD
+            new_angle = MIN_ANGLE + (MAX_ANGLE - MIN_ANGLE) * \
+                (0.5 - 0.5 * math.cos(phase))
+        elif level is not None:
+            # The needle follows the speech
+            position = min(level / FULL_SCALE_LEVEL, 1.0)
+            new_angle = random.gauss(
+                MIN_ANGLE + position * (MAX_ANGLE - MIN_ANGLE), 0.02)
+        elif music.get_volume() > 0.3:
+            # The static is high, so no one is talking
+            new_angle = random.gauss(MIN_ANGLE, 0.07)
+        else:
+            # The static is low, so someone is talking
+            new_angle = random.gauss(MAX_ANGLE, 0.07)
+        # Clamp the values to the valid range
+        new_angle = min(max(new_angle, MIN_ANGLE), MAX_ANGLE)
+        self.needle_history.append(new_angle)
+        return sum(self.needle_history) / len(self.needle_history)
+
+    def draw(self, speak=True, level=None, loading=False):
+        """ Draws a new frame.
+
+        Parameters
+        ----------
+        speak : bool
+            Whether to draw the image with or without the microphone.
+        level : float
+            RMS level of the speech being played, as given by
+            `VoiceMeter.level`. If None, the needle moves according to the
+            volume of the static.
+        loading : bool
+            Whether the models are still loading. If True, both buttons are
+            off and the needle sweeps the dial.
+        """
+        # Only the needle changes on every frame
+        mode = (speak, loading)
+        if self._mode is None:
+            dirty = self.window.get_rect()
+        elif mode != self._mode:
+            dirty = self._needle_rect.union(self._buttons_rect)
+        else:
+            dirty = self._needle_rect
+        self._mode = mode
+        self.window.set_clip(dirty)
+        self.window.blit(self.background, dirty, dirty)
+        # Draws the needle
+        angle = self._needle_angle(level, loading)
+        # My favorite equations of all time: convert angles and radius
+        # into (x,y) coordinates.
+        # Also, we flip the angle around (MIN_ANGLE + MAX_ANGLE - angle)
+        # because otherwise the needle moves in the opposite direction
+        end = (NEEDLE_CENTER[0] + int(NEEDLE_RADIUS *
+                                      math.cos(MIN_ANGLE + MAX_ANGLE - angle)),
+               NEEDLE_CENTER[1] - int(NEEDLE_RADIUS *
+                                      math.sin(MIN_ANGLE + MAX_ANGLE - angle)))
+        pygame.draw.line(self.window, (200, 50, 50), NEEDLE_CENTER, end, 1)
+        self.window.blit(self.images['needle_thingy'], NEEDLE_SUPPORT_POS)
+        # Draws the microphone and buttons. The microphone covers part of
+        # the needle, so it is drawn again on every frame. Neither button is
+        # lit while loading.
+        if speak and not loading:
+            self.window.blit(self.images['white_button'], WHITE_BUTTON_POS)
+            self.window.blit(self.images['mic'], MIC_POS)
+        elif not loading:
+            self.window.blit(self.images['red_button'], RED_BUTTON_POS)
+        self.window.set_clip(None)
+        pygame.display.update(dirty)
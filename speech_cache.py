@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import json
+import logging
+import os
+import queue
+import tempfile
+import threading
+import tts
+import wave
+from collections import OrderedDict
+
+# Keys of the `tts` configuration block that change how the speech sounds
+VOICE_KEYS = ('voice', 'speaker', 'length_scale')
+# Fraction of the size limit that the disk cache is brought down to when it
+# is full, so that not every new sentence has to evict
+DISK_LOW_WATER = 0.9
+
+
+class SpeechCache:
+    """ Cache of synthesized speech, kept both in memory and on disk.
+
+    Speech is identified by its normalized text plus the voice configuration
+    used to synthesize it, so changing the voice never returns stale audio.
+    Both levels are bounded in size and evict the least recently used speech
+    first.
+
+    Parameters
+    ----------
+    tts_config : dict
+        The `tts` block of the configuration file.
+    directory : str
+        Directory for the cached audio. Created if it doesn't exist.
+    max_memory_mb : float
+        Maximum size of the speech kept in memory.
+    max_disk_mb : float
+        Maximum size of the speech kept on disk.
+    voice : Mimic3TextToSpeechSystem
+        Voice to use for the speech that is not in the cache. If None, it is
+        loaded the first time it is needed.
+
+    Notes
+    -----
+    New speech is written to disk by a background thread, so a miss only
+    costs the synthesis. Call `flush` before exiting to wait for the writes.
+    The files on disk are indexed once, when the cache is created, and
+    evicted using that index from then on.
+    """
+    def __init__(self, tts_config,
+                 directory=os.path.join('~', '.cache', 'radiobot', 'speech'),
+                 max_memory_mb=32, max_disk_mb=256, voice=None):
+        self.tts_config = tts_config
+        self.directory = os.path.expanduser(directory)
+        self.max_memory = int(max_memory_mb * 1024 * 1024)
+        self.max_disk = int(max_disk_mb * 1024 * 1024)
+        self.voice = voice
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        # Speech in memory, from least to most recently used
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        os.makedirs(self.directory, exist_ok=True)
+        # Sizes of the speech on disk, from least to most recently used
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.wav'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, entry.name[:-4],
+                                stat.st_size))
+        self._disk = OrderedDict((key, size) for _, key, size in
+                                 sorted(entries))
+        self._disk_size = sum(self._disk.values())
+        self._disk_lock = threading.Lock()
+        # Speech waiting to be written to disk
+        self._pending = queue.Queue()
+        threading.Thread(target=self._write, daemon=True).start()
+        voice_config = {key: tts_config.get(key, None) for key in VOICE_KEYS}
+        self._voice_id = json.dumps(voice_config, sort_keys=True)
+
+    def key(self, text):
+        """ Returns the key under which a text is cached.
+
+        Parameters
+        ----------
+        text : str
+            Text to synthesize.
+
+        Returns
+        -------
+        str
+            Hexadecimal hash of the normalized text and voice configuration.
+        """
+        normalized = ' '.join(text.split())
+        content = self._voice_id + '\n' + normalized
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.wav')
+
+    def _remember(self, key, audio):
+        """ Stores speech in memory, evicting old speech if needed. """
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        self._memory[key] = audio
+        self._memory_size += len(audio[0])
+        while self._memory_size > self.max_memory and len(self._memory) > 1:
+            _, (pcm, _, _) = self._memory.popitem(last=False)
+            self._memory_size -= len(pcm)
+
+    def _store(self, key, audio):
+        """ Stores speech on disk, evicting old speech if needed. """
+        pcm, sample_rate, channels = audio
+        fd, tmp_name = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        with os.fdopen(fd, 'wb') as fp:
+            with wave.open(fp, 'wb') as wav:
+                wav.setnchannels(channels)
+                wav.setsampwidth(2)
+                wav.setframerate(sample_rate)
+                wav.writeframes(pcm)
+        # Renaming is atomic, so other processes never see half a file
+        os.replace(tmp_name, self._path(key))
+        self._touch_disk(key, os.path.getsize(self._path(key)))
+
+    def _write(self):
+        """ Stores the speech added with `put`, in the background. """
+        while True:
+            key, audio = self._pending.get()
+            try:
+                self._store(key, audio)
+            except OSError as e:
+                logging.getLogger('radiobot').warning(
+                    f"Speech cache: {e}")
+            finally:
+                self._pending.task_done()
+
+    def _touch_disk(self, key, size):
+        """ Marks speech on disk as the most recently used, evicting old
+        speech if needed. """
+        with self._disk_lock:
+            self._disk_size += size - self._disk.pop(key, 0)
+            self._disk[key] = size
+            if self._disk_size > self.max_disk:
+                self._evict_disk()
+
+    def _evict_disk(self):
+        """ Removes the least recently used speech until the disk cache is
+        a bit below its size limit. The modification time of a file is also
+        updated on every hit, so other processes that index the directory
+        later see the same order.
+        """
+        while len(self._disk) > 1 and \
+                self._disk_size > DISK_LOW_WATER * self.max_disk:
+            key, size = self._disk.popitem(last=False)
+            self._disk_size -= size
+            try:
+                os.unlink(self._path(key))
+            except FileNotFoundError:
+                # Someone else evicted it first
+                pass
+
+    def get(self, text):
+        """ Looks for speech in the cache.
+
+        Parameters
+        ----------
+        text : str
+            Text that was synthesized.
+
+        Returns
+        -------
+        (bytes, int, int) or None
+            The same values returned by `tts.synthesize`, or None if the text
+            is not in the cache.
+        """
+        key = self.key(text)
+        path = self._path(key)
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.hits_memory += 1
+            # The disk is evicted by modification time, so the phrases that
+            # are used the most must look recent there too
+            try:
+                os.utime(path)
+                self._touch_disk(key, os.path.getsize(path))
+            except FileNotFoundError:
+                # Evicted from disk by another process, or not written yet
+                self._pending.put((key, self._memory[key]))
+            return self._memory[key]
+        try:
+            with wave.open(path, 'rb') as wav:
+                audio = (wav.readframes(wav.getnframes()),
+                         wav.getframerate(), wav.getnchannels())
+            os.utime(path)
+            self._touch_disk(key, os.path.getsize(path))
+        except (FileNotFoundError, EOFError, wave.Error):
+            self.misses += 1
+            return None
+        self.hits_disk += 1
+        self._remember(key, audio)
+        return audio
+
+    def put(self, text, audio):
+        """ Adds speech to the cache.
+
+        Parameters
+        ----------
+        text : str
+            Text that was synthesized.
+        audio : (bytes, int, int)
+            Speech as returned by `tts.synthesize`.
+        """
+        key = self.key(text)
+        self._remember(key, audio)
+        self._pending.put((key, audio))
+
+    def flush(self):
+        """ Waits until all the speech added so far is stored on disk. """
+        self._pending.join()
+
+    def synthesize(self, text):
+        """ Returns the speech for a text, synthesizing it only if it isn't
+        already in the cache.
+
+        Parameters
+        ----------
+        text : str
+            Text to synthesize.
+
+        Returns
+        -------
+        (bytes, int, int)
+            The same values returned by `tts.synthesize`.
+        """
+        audio = self.get(text)
+        if audio is None:
+            if self.voice is None:
+                self.voice = tts.load_voice(self.tts_config)
+            audio = tts.synthesize(self.voice, text)
+            self.put(text, audio)
+        return audio
+
+    def stats(self):
+        """ Returns the hit and miss counters plus the size of the cache.
+
+        Returns
+        -------
+        dict
+            Counters and sizes (in bytes) of the cache.
+        """
+        lookups = self.hits_memory + self.hits_disk + self.misses
+        return {'hits_memory': self.hits_memory,
+                'hits_disk': self.hits_disk,
+                'misses': self.misses,
+                'hit_rate': (lookups - self.misses) / max(lookups, 1),
+                'memory_bytes': self._memory_size,
+                'disk_bytes': self._disk_size}
+
+
+def from_config(json_config, voice=None):
+    """ Creates the speech cache described in the configuration.
+
+    Parameters
+    ----------
+    json_config : dict
+        Dictionary with general configuration options for the system. The
+        optional `speech_cache` block can set the `directory`,
+        `max_memory_mb` and `max_disk_mb` of the cache.
+    voice : Mimic3TextToSpeechSystem
+        Voice to use for the speech that is not in the cache.
+
+    Returns
+    -------
+    SpeechCache
+        The configured cache.
+    """
+    return SpeechCache(json_config['tts'], voice=voice,
+                       **json_config.get('speech_cache', dict()))
+
+
+def seed_texts(json_config):
+    """ Returns the texts that are spoken in every run of the program.
+
+    Parameters
+    ----------
+    json_config : dict
+        Dictionary with general configuration options for the system.
+
+    Returns
+    -------
+    list(str)
+        Seed utterances, plus the openings of radio mode as they are spoken
+        by the GUI and the text-only interface.
+    """
+    texts = list(json_config['monologue_seed'])
+    texts.extend(json_config['dialog_seed'])
+    texts.append('; '.join(json_config['monologue_seed']))
+    texts.append('\n'.join(json_config['monologue_seed']))
+    return texts
+
+
+if __name__ == '__main__':
+    """ Pre-warms the speech cache with the seeds of the configuration file.
+    """
+    logging.basicConfig()
+    parser = argparse.ArgumentParser(
+        description='Synthesizes the seed texts into the speech cache')
+    parser.add_argument('-c', '--config', default='config.json',
+                        help='Configuration file to read the seeds from')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as fp:
+        app_config = json.load(fp)
+    cache = from_config(app_config)
+    for text in seed_texts(app_config):
+        cache.synthesize(text)
+    cache.flush()
+    print(json.dumps(cache.stats()))
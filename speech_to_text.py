@@ -1,20 +1,250 @@
 import logging
+import math
 import os
 import sys
-import tempfile
-import queue
+import numpy
 import sounddevice as sd
-import soundfile as sf
-import numpy  # Make sure NumPy is loaded before it is used in the callback
+import time
+import tracing
 import whisper
+try:
+    from scipy.signal import resample_poly
+except ImportError:
+    resample_poly = None
 
-# Queue for the voice recording
-q = queue.Queue()
 
+class RingBuffer:
+    """ Preallocated circular buffer for the recorded audio.
 
-def callback(indata, frames, time, status):
-    """This is called (from a separate thread) for each audio block."""
-    q.put(indata.copy())
+    The buffer is filled from the audio thread and read from the main one.
+    Positions are absolute frame counts since the buffer was last cleared, so
+    the reader can tell which frames are still available.
+
+    Parameters
+    ----------
+    seconds : float
+        Amount of audio that the buffer can hold.
+    samplerate : int
+        Sample rate of the recorded audio.
+    """
+    def __init__(self, seconds, samplerate):
+        self.samplerate = samplerate
+        self.data = numpy.zeros(int(seconds * samplerate), dtype=numpy.float32)
+        # Number of frames written since the last time the buffer was cleared
+        self.written = 0
+
+    def clear(self):
+        """ Forgets all the audio in the buffer. """
+        self.written = 0
+
+    def callback(self, indata, frames, time, status):
+        """This is called (from a separate thread) for each audio block."""
+        size = len(self.data)
+        block = indata[-size:, 0]
+        start = (self.written + frames - len(block)) % size
+        end = start + len(block)
+        if end <= size:
+            self.data[start:end] = block
+        else:
+            self.data[start:] = block[:size - start]
+            self.data[:end - size] = block[size - start:]
+        self.written += frames
+
+    def read(self, start, end):
+        """ Returns a copy of the audio between two positions.
+
+        Parameters
+        ----------
+        start : int
+            Position of the first frame to read.
+        end : int
+            Position after the last frame to read.
+
+        Returns
+        -------
+        numpy.ndarray
+            The requested frames. Frames that were already overwritten are
+            skipped.
+        """
+        size = len(self.data)
+        if end - start > size:
+            logger = logging.getLogger('radiobot')
+            logger.warning('Recording buffer overflow: {:.1f}s lost'.format(
+                (end - start - size) / self.samplerate))
+            start = end - size
+        first = start % size
+        last = first + (end - start)
+        if last <= size:
+            return self.data[first:last].copy()
+        return numpy.concatenate((self.data[first:],
+                                  self.data[:last - size]))
+
+
+class EnergyVAD:
+    """ Detects speech in the recorded audio by its energy.
+
+    The detector is fed the same audio blocks as `RingBuffer`, and tells
+    where the speech starts and ends so that the silence around it never
+    reaches Whisper. In hands-free mode it also tells when the user is done
+    talking.
+
+    Parameters
+    ----------
+    samplerate : int
+        Sample rate of the recorded audio.
+    threshold_db : float
+        Level (in dB relative to full scale) above which a frame is
+        considered speech.
+    min_speech_ms : float
+        Time that the level must stay above the threshold before it counts as
+        speech, so that clicks and bumps are ignored.
+    hangover_ms : float
+        Silence after the speech that ends an utterance.
+    frame_ms : float
+        Length of the frames whose level is measured.
+
+    Notes
+    -----
+    Positions are frame counts since the detector was last reset, just like
+    `RingBuffer.written`.
+    """
+    def __init__(self, samplerate, threshold_db=-45.0, min_speech_ms=100,
+                 hangover_ms=800, frame_ms=30):
+        self.frame = max(1, int(samplerate * frame_ms / 1000))
+        self.threshold = 10 ** (threshold_db / 20)
+        self.min_speech = int(samplerate * min_speech_ms / 1000)
+        self.hangover = int(samplerate * hangover_ms / 1000)
+        self.reset()
+
+    def reset(self):
+        """ Forgets all the audio seen so far. """
+        self.position = 0
+        # Position of the first frame of speech and the position after the
+        # last one, or None if there was no speech yet
+        self.speech_start = None
+        self.speech_end = None
+        # Start of the current run of loud frames
+        self._run_start = None
+        # Samples that don't fill a whole frame yet
+        self._partial = numpy.zeros(0, dtype=numpy.float32)
+
+    def callback(self, indata, frames, time, status):
+        """This is called (from a separate thread) for each audio block."""
+        samples = numpy.concatenate((self._partial, indata[:, 0]))
+        start = self.position - len(self._partial)
+        count = len(samples) // self.frame
+        if count > 0:
+            blocks = samples[:count * self.frame].reshape(count, self.frame)
+            loud = numpy.sqrt(numpy.mean(blocks ** 2, axis=1)) >= \
+                self.threshold
+            for idx in range(count):
+                if not loud[idx]:
+                    self._run_start = None
+                    continue
+                frame_start = start + idx * self.frame
+                if self._run_start is None:
+                    self._run_start = frame_start
+                if self.speech_start is None and \
+                        frame_start + self.frame - self._run_start >= \
+                        self.min_speech:
+                    self.speech_start = self._run_start
+                if self.speech_start is not None:
+                    self.speech_end = frame_start + self.frame
+        self._partial = samples[count * self.frame:].copy()
+        self.position += frames
+
+    def ended(self):
+        """ Returns whether there was speech followed by enough silence to
+        consider the utterance finished. """
+        return self.speech_end is not None and \
+            self.position - self.speech_end >= self.hangover
+
+
+def to_whisper_rate(audio, samplerate):
+    """ Resamples audio to the sample rate expected by Whisper.
+
+    Parameters
+    ----------
+    audio : numpy.ndarray
+        Mono audio samples.
+    samplerate : int
+        Sample rate of `audio`.
+
+    Returns
+    -------
+    numpy.ndarray
+        The same audio as float32 samples at `whisper.audio.SAMPLE_RATE`.
+
+    Notes
+    -----
+    If SciPy is installed the audio goes through a polyphase filter, which
+    is both fast and free of aliasing. Otherwise we fall back to linear
+    interpolation.
+    """
+    if samplerate == whisper.audio.SAMPLE_RATE:
+        return audio.astype(numpy.float32, copy=False)
+    if resample_poly is not None:
+        divisor = math.gcd(samplerate, whisper.audio.SAMPLE_RATE)
+        audio = resample_poly(audio, whisper.audio.SAMPLE_RATE // divisor,
+                              samplerate // divisor)
+        return audio.astype(numpy.float32, copy=False)
+    duration = len(audio) / samplerate
+    positions = numpy.arange(0, duration, 1.0 / whisper.audio.SAMPLE_RATE)
+    return numpy.interp(positions, numpy.arange(len(audio)) / samplerate,
+                        audio).astype(numpy.float32)
+
+
+def capture_rate(device):
+    """ Chooses the sample rate for recording.
+
+    Parameters
+    ----------
+    device : int
+        Device used as microphone.
+
+    Returns
+    -------
+    int
+        The sample rate used by Whisper if the device supports it, or the
+        default sample rate of the device otherwise.
+    """
+    try:
+        sd.check_input_settings(device=device,
+                                samplerate=whisper.audio.SAMPLE_RATE,
+                                channels=1, dtype='float32')
+        return whisper.audio.SAMPLE_RATE
+    except (sd.PortAudioError, ValueError):
+        device_info = sd.query_devices(device, 'input')
+        return int(device_info['default_samplerate'])
+
+
+def _transcribe(model, audio, samplerate, previous_text):
+    """ Transcribes a piece of a recording.
+
+    Parameters
+    ----------
+    model : whisper.Whisper
+        Speech-to-text model.
+    audio : numpy.ndarray
+        Recorded audio.
+    samplerate : int
+        Sample rate of `audio`.
+    previous_text : str
+        Text transcribed from the audio right before this one. Whisper uses
+        it as context, so words are not transcribed differently on each side
+        of a cut.
+
+    Returns
+    -------
+    dict
+        The result of `model.transcribe`.
+    """
+    # The audio goes to Whisper straight from memory. Passing a file instead
+    # would make Whisper decode and resample it with ffmpeg.
+    return model.transcribe(to_whisper_rate(audio, samplerate),
+                            language="en",
+                            initial_prompt=previous_text or None,
+                            fp16=False)
 
 
 def setup_mic():
@@ -44,16 +274,73 @@ def setup_mic():
     return device
 
 
-def run_speech_server(comm_pipe, device=None):
+def run_speech_server(comm_pipe, device=None, window_seconds=5.0,
+                      buffer_seconds=60.0, vad_config=None):
+    """ Starts the server that records and transcribes speech.
+
+    Parameters
+    ----------
+    comm_pipe : Pipe()
+        Pipe that will be used to receive commands and send transcriptions.
+    device : int
+        Device to use as microphone. If None, it is detected automatically.
+    window_seconds : float
+        Amount of new audio that triggers a transcription while the user is
+        still talking.
+    buffer_seconds : float
+        Amount of audio that is kept in memory. It must be larger than
+        `window_seconds` plus the time it takes to transcribe it.
+    vad_config : dict
+        The `vad` block of the configuration file. The optional
+        `threshold_db`, `min_speech_ms` and `hangover_ms` keys configure the
+        `EnergyVAD`, `padding_ms` is the silence kept around the speech, and
+        `trim` can be set to False to transcribe everything.
+
+    Notes
+    -----
+    Once the model is loaded and warmed up, the server sends a
+    ('ready', seconds) message with the time it took. Send 'start_recording'
+    and 'stop_recording' through the pipe to record an utterance, whose
+    transcription is then sent back. To close the server send the 'quit'
+    message. The recording can also be started with a
+    ('start_recording', request) message, in which case its trace spans
+    belong to that request (see `tracing`).
+
+    In hands-free mode, send 'listen' (or ('listen', request)) instead. The
+    server waits for the user to talk and stops recording on its own once
+    they are done, sending an ('endpoint', seconds) message with the length
+    of the speech right before the transcription. A 'stop_recording' message
+    ends the recording early.
+
+    The silence before and after the speech is not transcribed. The seconds
+    of audio that were trimmed are logged and stored in the 'capture' trace
+    span of every recording.
+
+    Audio is transcribed in windows while it is being recorded. Every
+    transcribed segment except for the last one, which could have been cut in
+    the middle of a word, is considered final and is never transcribed again.
+    This leaves only a short tail to transcribe once the recording stops.
+    """
     # Parameters for the recording
     logger = logging.getLogger('radiobot')
+    vad_config = dict(vad_config or dict())
+    trim = vad_config.pop('trim', True)
+    padding_ms = vad_config.pop('padding_ms', 200)
+    vad_config.pop('hands_free', None)
+    load_start = time.time()
     if device is None:
         device = setup_mic()
-    device_info = sd.query_devices(device, 'input')
-    samplerate = int(device_info['default_samplerate'])
-    fd, filename = tempfile.mkstemp(suffix='.wav')
-    os.close(fd)
+    samplerate = capture_rate(device)
+    logger.debug(f'Recording at {samplerate} Hz')
     channels = 1
+    ring = RingBuffer(buffer_seconds, samplerate)
+    vad = EnergyVAD(samplerate, **vad_config)
+    padding = int(samplerate * padding_ms / 1000)
+    window = int(window_seconds * samplerate)
+
+    def callback(*args):
+        ring.callback(*args)
+        vad.callback(*args)
     # Initialize the speech-to-text system and ensure it only runs on CPU
     # (the GPU will be needed for the language model)
     os.environ['CUDA_VISIBLE_DEVICES'] = ""
@@ -63,32 +350,108 @@ def run_speech_server(comm_pipe, device=None):
     except RuntimeError:
         model = whisper.load_model('base')
         logger.debug("Loaded internet Whisper model")
+    # The first transcription is much slower than the rest, so it is done
+    # now with a second of silence instead of with the first utterance
+    _transcribe(model, numpy.zeros(samplerate, dtype=numpy.float32),
+                samplerate, '')
+    tracing.record('load', load_start, time.time())
+    comm_pipe.send(('ready', time.time() - load_start))
+    # Seconds of audio recorded and trimmed so far
+    captured_seconds = 0.0
+    trimmed_seconds = 0.0
     running = True
     while running:
         control_msg = comm_pipe.recv()
-        if control_msg == 'start_recording':
-            # Make sure the temporary file is empty
-            if os.path.isfile(filename):
-                os.unlink(filename)
+        request = None
+        if isinstance(control_msg, tuple):
+            control_msg, request = control_msg
+        if control_msg in ('start_recording', 'listen'):
+            hands_free = control_msg == 'listen'
+            ring.clear()
+            vad.reset()
+            capture_start = time.time()
+            # Position of the first frame that hasn't been transcribed yet,
+            # plus the text of all frames before it
+            committed = 0
+            text = []
+            # End of the audio that was transcribed last time
+            attempted = 0
             # Begin the recording process
-            with sf.SoundFile(filename, mode='x', samplerate=samplerate,
-                              channels=channels, subtype='PCM_24') as file:
-                with sd.InputStream(samplerate=samplerate, device=device,
-                                    channels=channels, callback=callback):
-                    recording = True
-                    while recording:
-                        file.write(q.get())
-                        if comm_pipe.poll():
-                            control_msg = comm_pipe.recv()
-                            if control_msg == 'stop_recording':
-                                recording = False
-                    # Convert the speech to text and return it via pipe
-                    result = model.transcribe(filename, language="en")
-                    logger.debug('You said: ' + result["text"].strip())
-                    comm_pipe.send(result["text"].strip())
+            with sd.InputStream(samplerate=samplerate, device=device,
+                                channels=channels, dtype='float32',
+                                callback=callback):
+                recording = True
+                while recording:
+                    if trim and vad.speech_start is not None:
+                        # The silence before the speech is never transcribed
+                        committed = max(committed,
+                                        vad.speech_start - padding)
+                        attempted = max(attempted, committed)
+                    if comm_pipe.poll(0.05):
+                        control_msg = comm_pipe.recv()
+                        if control_msg == 'stop_recording':
+                            recording = False
+                    elif hands_free and vad.ended():
+                        # The user is done talking
+                        recording = False
+                        comm_pipe.send(('endpoint',
+                                        (vad.speech_end - vad.speech_start) /
+                                        samplerate))
+                    elif trim and vad.speech_start is None:
+                        # Nobody is talking yet
+                        pass
+                    elif ring.written - attempted >= window:
+                        # Transcribe what we have so far
+                        end = ring.written
+                        attempted = end
+                        with tracing.span('transcribe', request,
+                                          seconds=(end - committed) /
+                                          samplerate):
+                            result = _transcribe(model,
+                                                 ring.read(committed, end),
+                                                 samplerate, ' '.join(text))
+                        segments = result['segments']
+                        if len(segments) > 1:
+                            text.extend(segment['text'].strip()
+                                        for segment in segments[:-1])
+                            committed += int(segments[-1]['start'] *
+                                             samplerate)
+                        elif end - committed > len(ring.data) // 2:
+                            # No pauses at all. We can't wait forever.
+                            text.append(result['text'].strip())
+                            committed = end
+            # The silence after the speech isn't transcribed either. If there
+            # was no speech at all, there is nothing to transcribe.
+            start, end = 0, ring.written
+            if trim:
+                if vad.speech_start is None:
+                    start = end
+                else:
+                    start = max(0, vad.speech_start - padding)
+                    end = min(end, vad.speech_end + padding)
+                committed = max(committed, start)
+            trimmed = (ring.written - (end - start)) / samplerate
+            captured_seconds += ring.written / samplerate
+            trimmed_seconds += trimmed
+            tracing.record('capture', capture_start, time.time(), request,
+                           seconds=ring.written / samplerate,
+                           trimmed=trimmed)
+            logger.debug(f"Trimmed {trimmed:.1f}s of silence out of "
+                         f"{ring.written / samplerate:.1f}s")
+            # Convert the rest of the speech to text and return it via pipe
+            if end > committed:
+                with tracing.span('transcribe', request, final=True,
+                                  seconds=(end - committed) / samplerate):
+                    result = _transcribe(model, ring.read(committed, end),
+                                         samplerate, ' '.join(text))
+                text.append(result['text'].strip())
+            text = ' '.join(t for t in text if t)
+            logger.debug('You said: ' + text)
+            comm_pipe.send(text)
         elif control_msg == 'quit':
-            # Stop the loop and remove the temporary file
+            # Stop the loop
             running = False
-            os.unlink(filename)
+    logger.debug(f"Trimmed {trimmed_seconds:.1f}s of silence out of "
+                 f"{captured_seconds:.1f}s recorded")
     # Finish the process nicely
     sys.exit(0)
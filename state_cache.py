@@ -0,0 +1,208 @@
+import ctypes
+import hashlib
+import llama_cpp
+import logging
+import os
+import pickle
+import tempfile
+from array import array
+from collections import deque
+
+# Version of the format of the snapshot files. Changing it makes the old
+# snapshots look like they were made for another version of the model.
+SNAPSHOT_FORMAT = 2
+
+
+class StateCache:
+    """ Snapshots of the LLM after evaluating a prompt prefix, stored on disk
+    so they survive between runs.
+
+    Evaluating the persona prompt plus the seed utterances is the slowest
+    part of the first generation in every mode. With a snapshot, the model
+    restores its state instead and only evaluates what comes after.
+
+    Parameters
+    ----------
+    llm : Llama
+        Language model whose state is saved and restored.
+    llm_path : str
+        Path to the language model.
+    n_ctx : int
+        Size of the context of the language model.
+    directory : str
+        Directory for the snapshots. Created if it doesn't exist.
+    max_snapshots : int
+        Maximum number of snapshots kept in the directory, for all models.
+        The ones that were used least recently are removed first.
+
+    Notes
+    -----
+    Snapshots are keyed by the model file (path, size and modification
+    time), the version of llama-cpp-python, the size of the context and the
+    text of the prefix. Any change to either the model or the configuration
+    therefore produces a different key. Snapshots made for an older version
+    of the same model are removed by `warm`, and so are the least recently
+    used snapshots beyond `max_snapshots`, such as the ones of prompts that
+    were edited since.
+    """
+    def __init__(self, llm, llm_path, n_ctx,
+                 directory=os.path.join('~', '.cache', 'radiobot', 'states'),
+                 max_snapshots=8):
+        self.llm = llm
+        self.directory = os.path.expanduser(directory)
+        self.max_snapshots = max_snapshots
+        os.makedirs(self.directory, exist_ok=True)
+        llm_path = os.path.abspath(llm_path)
+        stat = os.stat(llm_path)
+        self._model_id = hashlib.sha256(
+            llm_path.encode('utf-8')).hexdigest()[:16]
+        model_version = '\n'.join([
+            str(stat.st_size), str(stat.st_mtime_ns),
+            getattr(llama_cpp, '__version__', ''), str(n_ctx),
+            str(SNAPSHOT_FORMAT)])
+        self._version_id = hashlib.sha256(
+            model_version.encode('utf-8')).hexdigest()[:16]
+        # Tokens of every available snapshot, by path
+        self._snapshots = dict()
+
+    def _path(self, prefix):
+        key = hashlib.sha256(prefix.encode('utf-8')).hexdigest()[:32]
+        return os.path.join(
+            self.directory, f'{self._model_id}-{self._version_id}-{key}.state')
+
+    def _save(self, path):
+        """ Writes the current state of the model to disk. """
+        state = self.llm.save_state()
+        # The model always evaluates the last token of a prompt again, so
+        # only the logits of the last evaluation are ever used
+        last_logits = array('f', state.eval_logits[-1]
+                            if len(state.eval_logits) > 0 else [])
+        data = {'eval_tokens': list(state.eval_tokens),
+                'last_logits': last_logits.tobytes(),
+                'llama_state': bytes(state.llama_state),
+                'llama_state_size': state.llama_state_size}
+        fd, tmp_name = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        with os.fdopen(fd, 'wb') as fp:
+            pickle.dump(data, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_name, path)
+        return data['eval_tokens']
+
+    def _load(self, path):
+        """ Restores the state of the model from disk. """
+        with open(path, 'rb') as fp:
+            data = pickle.load(fp)
+        size = len(data['llama_state'])
+        llama_state = (ctypes.c_uint8 * size).from_buffer_copy(
+            data['llama_state'])
+        last_logits = array('f')
+        last_logits.frombytes(data['last_logits'])
+        eval_logits = deque([last_logits.tolist()] if last_logits else [])
+        self.llm.load_state(llama_cpp.LlamaState(
+            deque(data['eval_tokens']), eval_logits,
+            llama_state, data['llama_state_size']))
+        # The least recently used snapshots are removed first
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return data['eval_tokens']
+
+    def warm(self, prefixes):
+        """ Makes sure that there is a snapshot for every prefix, evaluating
+        the ones that are not on disk yet.
+
+        Parameters
+        ----------
+        prefixes : list(str)
+            Prompt prefixes to snapshot.
+        """
+        logger = logging.getLogger('radiobot')
+        self._snapshots = dict()
+        for prefix in prefixes:
+            path = self._path(prefix)
+            try:
+                self._snapshots[path] = self._load(path)
+                logger.debug(f"Restored LLM snapshot {path}")
+            except (OSError, EOFError, pickle.UnpicklingError,
+                    KeyError, RuntimeError):
+                self.llm.reset()
+                self.llm.eval(self.llm.tokenize(b' ' +
+                                                prefix.encode('utf-8')))
+                self._snapshots[path] = self._save(path)
+                logger.debug(f"Saved LLM snapshot {path}")
+        # Snapshots of an older version of this model will never be used
+        # again. Snapshots of other prefixes are kept, because other
+        # processes (such as `endless_gen.py`) could be using them.
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith(self._model_id + '-') and \
+                    not entry.name.startswith(f'{self._model_id}-'
+                                              f'{self._version_id}-'):
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    # Someone else removed it first
+                    pass
+        self._prune()
+
+    def _prune(self):
+        """ Removes the least recently used snapshots beyond
+        `max_snapshots`, except the ones this cache uses. """
+        snapshots = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.state') and \
+                    entry.path not in self._snapshots:
+                try:
+                    snapshots.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    pass
+        excess = len(snapshots) + len(self._snapshots) - self.max_snapshots
+        for _, path in sorted(snapshots)[:max(excess, 0)]:
+            try:
+                os.unlink(path)
+                logging.getLogger('radiobot').debug(
+                    f"Removed unused LLM snapshot {path}")
+            except FileNotFoundError:
+                pass
+
+    def restore(self, tokens):
+        """ Restores the snapshot that shares the longest prefix with a
+        prompt, if that is better than the current state of the model.
+
+        Parameters
+        ----------
+        tokens : list(int)
+            Tokens of the prompt that is about to be evaluated.
+
+        Returns
+        -------
+        bool
+            True if a snapshot was restored.
+        """
+        current = _common_prefix(self.llm.eval_tokens, tokens)
+        best_path, best = None, current
+        for path, snapshot_tokens in self._snapshots.items():
+            # Whatever comes after the shared tokens is evaluated again, so
+            # a partial match is still useful
+            shared = _common_prefix(snapshot_tokens, tokens)
+            if shared > best:
+                best_path, best = path, shared
+        if best_path is None:
+            return False
+        try:
+            self._load(best_path)
+        except (OSError, EOFError, pickle.UnpicklingError,
+                KeyError, RuntimeError) as e:
+            logging.getLogger('radiobot').warning(e)
+            del self._snapshots[best_path]
+            return False
+        return True
+
+
+def _common_prefix(old_tokens, new_tokens):
+    """ Returns the length of the common prefix of two lists of tokens. """
+    common = 0
+    for old, new in zip(old_tokens, new_tokens):
+        if old != new:
+            break
+        common += 1
+    return common
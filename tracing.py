@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import statistics
+import time
+import uuid
+from contextlib import contextmanager
+
+# File where the spans are written, or None if tracing is disabled
+_path = None
+# Open trace file of this process, plus the process that opened it. Forked
+# processes open their own.
+_file = None
+_file_pid = None
+
+
+def configure(path):
+    """ Enables or disables tracing for this process and the processes that
+    are forked from it afterwards.
+
+    Parameters
+    ----------
+    path : str
+        JSONL file where the spans are appended. If None, tracing is
+        disabled.
+    """
+    global _path, _file
+    _path = path
+    _file = None
+
+
+def enabled():
+    """ Returns whether spans are being recorded. """
+    return _path is not None
+
+
+def new_request():
+    """ Returns a new identifier for a request, such as a question from the
+    user or a line of radio. It is passed along with the messages between
+    processes so their spans can be correlated.
+
+    Returns
+    -------
+    str
+        Unique identifier.
+    """
+    return uuid.uuid4().hex[:12]
+
+
+def record(stage, start, end, request=None, **fields):
+    """ Writes a span to the trace file.
+
+    Parameters
+    ----------
+    stage : str
+        Name of the stage, for instance 'transcribe' or 'tts'.
+    start : float
+        Time (as given by `time.time`) at which the stage started.
+    end : float
+        Time at which the stage ended.
+    request : str
+        Request the stage belongs to. See `new_request`.
+    fields : dict
+        Extra values to store in the span, such as the number of tokens.
+    """
+    global _file, _file_pid
+    if _path is None:
+        return
+    if _file is None or _file_pid != os.getpid():
+        # Every line is written with a single call to an append-only file,
+        # so processes don't mix their spans
+        _file = open(_path, 'a', buffering=1)
+        _file_pid = os.getpid()
+    span = {'stage': stage, 'request': request, 'pid': os.getpid(),
+            'start': start, 'duration': end - start}
+    span.update(fields)
+    _file.write(json.dumps(span) + '\n')
+
+
+@contextmanager
+def span(stage, request=None, **fields):
+    """ Records a span for the code inside a `with` block.
+
+    Parameters
+    ----------
+    stage : str
+        Name of the stage.
+    request : str
+        Request the stage belongs to.
+    fields : dict
+        Extra values to store in the span.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(stage, start, time.time(), request, **fields)
+
+
+def percentile(values, fraction):
+    """ Returns a percentile of a list of values, with linear
+    interpolation.
+
+    Parameters
+    ----------
+    values : list(float)
+        Values, in any order.
+    fraction : float
+        Percentile as a number between 0 and 1.
+
+    Returns
+    -------
+    float
+        The percentile.
+    """
+    values = sorted(values)
+    position = fraction * (len(values) - 1)
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * \
+        (position - lower)
+
+
+def summarize(path):
+    """ Computes the latency of every stage in a trace file.
+
+    Parameters
+    ----------
+    path : str
+        JSONL file written by `record`.
+
+    Returns
+    -------
+    list(dict)
+        Number of spans, mean, p50 and p95 duration (in milliseconds) of
+        every stage, in the order in which the stages first appear.
+    """
+    durations = dict()
+    with open(path, 'r') as fp:
+        for line in fp:
+            line = line.strip()
+            if line:
+                span = json.loads(line)
+                durations.setdefault(span['stage'], []).append(
+                    span['duration'])
+    return [{'stage': stage,
+             'count': len(values),
+             'mean_ms': 1000 * statistics.mean(values),
+             'p50_ms': 1000 * percentile(values, 0.5),
+             'p95_ms': 1000 * percentile(values, 0.95)}
+            for stage, values in durations.items()]
+
+
+if __name__ == '__main__':
+    """ Prints the latency of every stage of a trace, one JSON object per
+    line.
+    """
+    parser = argparse.ArgumentParser(
+        description='Summarizes the latency of every stage in a trace file')
+    parser.add_argument('trace', help='Trace file written by radiobot.py')
+    args = parser.parse_args()
+    for stage in summarize(args.trace):
+        print(json.dumps(stage))
@@ -0,0 +1,201 @@
+import logging
+import numpy
+import pygame
+import time
+import tracing
+from mimic3_tts import AudioResult, Mimic3Settings, Mimic3TextToSpeechSystem
+
+# Sample rate of the default voice. Used to configure the mixer so that
+# speech can be handed to it without being resampled.
+DEFAULT_SAMPLE_RATE = 22050
+
+
+def load_voice(tts_config):
+    """ Loads the MIMIC-3 voice described in the configuration.
+
+    Parameters
+    ----------
+    tts_config : dict
+        The `tts` block of the configuration file. Only the `voice`,
+        `speaker` and `length_scale` keys are used.
+
+    Returns
+    -------
+    Mimic3TextToSpeechSystem
+        Speech synthesizer ready to be used with `synthesize`.
+    """
+    settings = Mimic3Settings(
+        length_scale=tts_config.get('length_scale', None))
+    voice = Mimic3TextToSpeechSystem(settings)
+    voice.voice = tts_config['voice']
+    if tts_config.get('speaker', None) is not None:
+        voice.speaker = tts_config['speaker']
+    return voice
+
+
+def synthesize(voice, text):
+    """ Synthesizes a text in memory.
+
+    Parameters
+    ----------
+    voice : Mimic3TextToSpeechSystem
+        Speech synthesizer, as returned by `load_voice`.
+    text : str
+        Text to synthesize.
+
+    Returns
+    -------
+    (bytes, int, int)
+        Raw signed PCM samples of the speech, their sample rate (in Hz)
+        and the number of channels. Samples are always 16 bits long.
+    """
+    voice.begin_utterance()
+    voice.speak_text(text)
+    results = [result for result in voice.end_utterance()
+               if isinstance(result, AudioResult)]
+    if len(results) == 0:
+        return b'', DEFAULT_SAMPLE_RATE, 1
+    # MIMIC-3 returns one result per sentence. We only pay for a copy when
+    # there is more than one.
+    if len(results) == 1:
+        pcm = results[0].audio_bytes
+    else:
+        pcm = b''.join(result.audio_bytes for result in results)
+    assert results[0].sample_width_bytes == 2, "Only 16-bit audio is supported"
+    return pcm, results[0].sample_rate_hz, results[0].num_channels
+
+
+def convert(pcm, sample_rate, channels, target_rate, target_channels):
+    """ Converts raw PCM samples to another sample rate and number of
+    channels.
+
+    Parameters
+    ----------
+    pcm : bytes
+        Raw signed 16-bit PCM samples.
+    sample_rate : int
+        Sample rate of `pcm`, in Hz.
+    channels : int
+        Number of interleaved channels in `pcm`.
+    target_rate : int
+        Sample rate of the result, in Hz.
+    target_channels : int
+        Number of channels of the result.
+
+    Returns
+    -------
+    numpy.ndarray
+        Signed 16-bit samples with one row per frame and one column per
+        channel.
+    """
+    samples = numpy.frombuffer(pcm, dtype=numpy.int16).reshape(-1, channels)
+    if target_rate != sample_rate:
+        # Nearest-neighbour resampling is good enough for speech
+        positions = numpy.arange(0, len(samples),
+                                 sample_rate / target_rate)
+        samples = samples[positions.astype(numpy.int64)]
+    if target_channels != channels:
+        samples = numpy.repeat(samples.mean(axis=1, keepdims=True),
+                               target_channels, axis=1).astype(numpy.int16)
+    return samples
+
+
+def to_sound(pcm, sample_rate, channels):
+    """ Wraps raw PCM samples in a PyGame sound.
+
+    Parameters
+    ----------
+    pcm : bytes
+        Raw signed 16-bit PCM samples.
+    sample_rate : int
+        Sample rate of `pcm`, in Hz.
+    channels : int
+        Number of interleaved channels in `pcm`.
+
+    Returns
+    -------
+    pygame.mixer.Sound
+        Sound ready to be played.
+
+    Notes
+    -----
+    When the mixer was initialized with the same format as the speech (see
+    `mixer_settings`) the samples are handed over as they are. Otherwise they
+    are converted with NumPy, which costs one extra copy.
+    """
+    mixer_rate, mixer_size, mixer_channels = pygame.mixer.get_init()
+    assert mixer_size == -16, "The mixer must use signed 16-bit samples"
+    if mixer_rate == sample_rate and mixer_channels == channels:
+        return pygame.mixer.Sound(buffer=pcm)
+    samples = convert(pcm, sample_rate, channels, mixer_rate, mixer_channels)
+    if mixer_channels == 1:
+        samples = samples[:, 0]
+    return pygame.sndarray.make_sound(numpy.ascontiguousarray(samples))
+
+
+def mixer_settings(tts_config):
+    """ Returns the mixer settings that match the voice in the configuration.
+
+    Parameters
+    ----------
+    tts_config : dict
+        The `tts` block of the configuration file. The optional `sample_rate`
+        key overrides the sample rate of the default voice.
+
+    Returns
+    -------
+    dict
+        Keyword arguments for `pygame.mixer.pre_init`.
+    """
+    return {'frequency': tts_config.get('sample_rate', DEFAULT_SAMPLE_RATE),
+            'size': -16,
+            'channels': 1}
+
+
+def run_tts_server(json_config, comm_pipe, voice=None):
+    """ Starts the server that synthesizes speech.
+
+    Parameters
+    ----------
+    json_config : dict()
+        Dictionary with general configuration options for the system.
+    comm_pipe : Pipe()
+        Pipe that will be used to receive texts and send speech.
+    voice : SpeechCache
+        Synthesizer to use. If None, the voice in the configuration is loaded
+        behind a speech cache (see `speech_cache.from_config`).
+
+    Notes
+    -----
+    Once the voice is loaded and warmed up, the server sends a
+    ('ready', seconds) message with the time it took.
+
+    Send ('synthesize', text, request) through the pipe to synthesize a text.
+    The server replies with ('synthesized', pcm, sample_rate, channels), where
+    the last three values are the ones returned by `synthesize`. Texts are
+    synthesized in the order in which they arrive, and the request is only
+    used for tracing (see `tracing`). To close the server send the 'quit'
+    message.
+    """
+    logger = logging.getLogger('radiobot')
+    load_start = time.time()
+    if voice is None:
+        # The speech cache is built on top of this module
+        import speech_cache
+        mimic = load_voice(json_config['tts'])
+        # The first synthesis loads the model of the voice, so it is done
+        # now instead of with the first utterance
+        synthesize(mimic, 'Hello.')
+        voice = speech_cache.from_config(json_config, voice=mimic)
+    tracing.record('load', load_start, time.time())
+    comm_pipe.send(('ready', time.time() - load_start))
+    while True:
+        message = comm_pipe.recv()
+        if message == 'quit':
+            break
+        _, text, request = message
+        with tracing.span('tts', request, chars=len(text)):
+            pcm, sample_rate, channels = voice.synthesize(text)
+        comm_pipe.send(('synthesized', pcm, sample_rate, channels))
+    voice.flush()
+    logger.debug(f"Speech cache: {voice.stats()}")